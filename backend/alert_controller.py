@@ -1,16 +1,26 @@
 import random
 import json
 import asyncio
+import concurrent.futures
+import hashlib
 import os
-from typing import List, Dict, Any, Optional, Tuple
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import List, Dict, Any, Mapping, Optional, Tuple
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 
-from small_leakage_model import analyze_leakage_with_consumption_data
+from small_leakage_model import analyze_leakage_with_consumption_data, analyze_leakage_batch
 
 # Используем загрузчик данных и симулятор из consumption_loader.py
-from consumption_loader import load_data, get_consumption_for_period_unom, get_consumption_for_period_ctp
+from consumption_loader import (
+    load_data, get_consumption_for_period_unom, get_consumption_for_period_ctp,
+    get_unom_index, get_excedents_index, get_real_consumption_rows, get_ctp_aggregates,
+    CtpAggregates, HOUSE_NOISE_LEVEL, CTP_NOISE_LEVEL,
+)
+from alert_state import get_alert_state_store
 
 # --- Load house addresses from GeoJSON ---
 def load_house_addresses(geojson_path='data/МКД_полигоны.geojson') -> Dict[int, str]:
@@ -118,33 +128,44 @@ CONFIG = {
     'pump_cavitation_lookback_hours': 24,  # Hours to look back for max predicted consumption (alert 6)
 }
 
+def alert_config(overrides: Optional[Mapping[str, Any]] = None) -> Mapping[str, Any]:
+    """
+    Read-only snapshot of CONFIG with per-call overrides. An evaluation reads only its snapshot,
+    so concurrent calls with other overrides (or a PUT /config/alert_parameters) do not change
+    the thresholds of an evaluation in progress.
+    """
+    return MappingProxyType({**CONFIG, **(overrides or {})})
+
+# Overrides of the canonical live evaluation that feeds the alert lifecycle store (see refresh_alert_state)
+FEED_CONFIG = {'event_duration_threshold': 4}
+
 # --- Data Structures ---
 
 # --- Helper Functions ---
 
-def is_zero_consumption(consumption: float) -> bool:
+def is_zero_consumption(consumption: float, config: Mapping[str, Any] = CONFIG) -> bool:
     """Check if consumption is effectively zero"""
-    return consumption <= CONFIG['zero_consumption_threshold']
+    return consumption <= config['zero_consumption_threshold']
 
-def is_consumption_much_higher(real: float, predicted: float) -> bool:
+def is_consumption_much_higher(real: float, predicted: float, config: Mapping[str, Any] = CONFIG) -> bool:
     """Check if real consumption is much higher than predicted"""
     if predicted <= 0:
-        return real > CONFIG['zero_consumption_threshold']
-    return real > predicted * CONFIG['high_consumption_multiplier']
+        return real > config['zero_consumption_threshold']
+    return real > predicted * config['high_consumption_multiplier']
 
-def is_consumption_leak_level(real: float, predicted: float) -> bool:
+def is_consumption_leak_level(real: float, predicted: float, config: Mapping[str, Any] = CONFIG) -> bool:
     """Check if real consumption indicates a leak (more sensitive threshold)"""
     if predicted <= 0:
-        return real > CONFIG['zero_consumption_threshold']
+        return real > config['zero_consumption_threshold']
     
     # Only consider leak if consumption is above minimum threshold
-    if real < CONFIG['min_consumption_for_leak']:
+    if real < config['min_consumption_for_leak']:
         return False
         
-    return real > predicted * CONFIG['leak_detection_threshold']
+    return real > predicted * config['leak_detection_threshold']
 
 
-def has_excedents_leak(unom: int, start_ts, end_ts, excedents_df: pd.DataFrame) -> bool:
+def has_excedents_leak(unom: int, start_ts, end_ts, excedents_df: pd.DataFrame, config: Mapping[str, Any] = CONFIG) -> bool:
     """Check if there's a significant leak recorded in excedents data for this house"""
     if excedents_df is None or excedents_df.empty:
         return False
@@ -160,7 +181,7 @@ def has_excedents_leak(unom: int, start_ts, end_ts, excedents_df: pd.DataFrame)
     house_excedents['leakage_numeric'] = pd.to_numeric(house_excedents['leakage'], errors='coerce')
     
     # Filter for significant leakage
-    house_excedents = house_excedents[house_excedents['leakage_numeric'] > CONFIG['min_leakage_threshold']]
+    house_excedents = house_excedents[house_excedents['leakage_numeric'] > config['min_leakage_threshold']]
     
     if house_excedents.empty:
         return False
@@ -176,17 +197,17 @@ def has_excedents_leak(unom: int, start_ts, end_ts, excedents_df: pd.DataFrame)
     
     return False
 
-def is_consumption_approximately_equal(real: float, predicted: float) -> bool:
+def is_consumption_approximately_equal(real: float, predicted: float, config: Mapping[str, Any] = CONFIG) -> bool:
     """Check if real consumption is approximately equal to predicted (±5%)"""
     if predicted <= 0:
-        return is_zero_consumption(real)
-    tolerance = CONFIG['consumption_tolerance']
+        return is_zero_consumption(real, config)
+    tolerance = config['consumption_tolerance']
     return abs(real - predicted) / predicted <= tolerance
 
 def get_house_address(unom: int) -> str:
     """Get house address by UNOM from loaded GeoJSON data"""
     # Используем реальный адрес из загруженных данных
-    address = HOUSE_ADDRESSES.get(unom)
+    address = HOUSE_ADDRESSES.get(int(unom))
     if address:
         return address
     # Если адрес не найден, возвращаем UNOM
@@ -200,14 +221,14 @@ def get_ctp_name(ctp_id: str) -> str:
 
 async def check_alert_condition_1(unom: int, ctp_id: str, consumption_df: pd.DataFrame, 
                                  ctp_to_unom_map: Dict[str, List[int]], 
-                                 alert_time: datetime, excedents_df: pd.DataFrame = None) -> Optional[Dict[str, Any]]:
+                                 alert_time: datetime, excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Optional[Dict[str, Any]]:
     """
     Alert Condition 1: расход воды в доме=0 AND расход воды на выходе из ЦТП = 0 
     AND В других домах подключенных к ЦТП расход = 0
     """
     try:
         # Get consumption data for the house
-        start_time = alert_time - timedelta(hours=CONFIG['event_duration_threshold'])
+        start_time = alert_time - timedelta(hours=config['event_duration_threshold'])
         house_data = await get_consumption_for_period_unom(unom, start_time, alert_time, consumption_df, excedents_df=excedents_df)
         
         if house_data.empty:
@@ -215,7 +236,7 @@ async def check_alert_condition_1(unom: int, ctp_id: str, consumption_df: pd.Dat
             
         # Check if house consumption is zero
         latest_house_consumption = house_data['реальный'].iloc[-1]
-        if not is_zero_consumption(latest_house_consumption):
+        if not is_zero_consumption(latest_house_consumption, config):
             return None
             
         # Get CTP consumption data
@@ -226,7 +247,7 @@ async def check_alert_condition_1(unom: int, ctp_id: str, consumption_df: pd.Dat
             
         # Check if CTP outlet consumption is zero
         latest_ctp_consumption = ctp_data['реальный'].iloc[-1]
-        if not is_zero_consumption(latest_ctp_consumption):
+        if not is_zero_consumption(latest_ctp_consumption, config):
             return None
             
         # Check other houses connected to the same CTP
@@ -239,7 +260,7 @@ async def check_alert_condition_1(unom: int, ctp_id: str, consumption_df: pd.Dat
             other_house_data = await get_consumption_for_period_unom(other_unom, start_time, alert_time, consumption_df, excedents_df=excedents_df)
             if not other_house_data.empty:
                 other_consumption = other_house_data['реальный'].iloc[-1]
-                if not is_zero_consumption(other_consumption):
+                if not is_zero_consumption(other_consumption, config):
                     return None
         
         # All conditions met - generate alert
@@ -262,13 +283,13 @@ async def check_alert_condition_1(unom: int, ctp_id: str, consumption_df: pd.Dat
 
 async def check_alert_condition_2(unom: int, ctp_id: str, consumption_df: pd.DataFrame,
                                  ctp_to_unom_map: Dict[str, List[int]], 
-                                 alert_time: datetime, excedents_df: pd.DataFrame = None) -> Optional[Dict[str, Any]]:
+                                 alert_time: datetime, excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Optional[Dict[str, Any]]:
     """
     Alert Condition 2: расход воды в доме=0 AND расход воды на выходе из ЦТП > 0 
     AND В других домах подключенных к ЦТП расход > 0
     """
     try:
-        start_time = alert_time - timedelta(hours=CONFIG['event_duration_threshold'])
+        start_time = alert_time - timedelta(hours=config['event_duration_threshold'])
         
         # Get consumption data for the house
         house_data = await get_consumption_for_period_unom(unom, start_time, alert_time, consumption_df, excedents_df=excedents_df)
@@ -278,7 +299,7 @@ async def check_alert_condition_2(unom: int, ctp_id: str, consumption_df: pd.Dat
             
         # Check if house consumption is zero
         latest_house_consumption = house_data['реальный'].iloc[-1]
-        if not is_zero_consumption(latest_house_consumption):
+        if not is_zero_consumption(latest_house_consumption, config):
             return None
             
         # Get CTP consumption data
@@ -288,7 +309,7 @@ async def check_alert_condition_2(unom: int, ctp_id: str, consumption_df: pd.Dat
             
         # Check if CTP outlet consumption is greater than zero
         latest_ctp_consumption = ctp_data['реальный'].iloc[-1]
-        if is_zero_consumption(latest_ctp_consumption):
+        if is_zero_consumption(latest_ctp_consumption, config):
             return None
             
         # Check other houses connected to the same CTP
@@ -302,7 +323,7 @@ async def check_alert_condition_2(unom: int, ctp_id: str, consumption_df: pd.Dat
             other_house_data = await get_consumption_for_period_unom(other_unom, start_time, alert_time, consumption_df, excedents_df=excedents_df)
             if not other_house_data.empty:
                 other_consumption = other_house_data['реальный'].iloc[-1]
-                if not is_zero_consumption(other_consumption):
+                if not is_zero_consumption(other_consumption, config):
                     other_houses_with_consumption += 1
                     
         if other_houses_with_consumption == 0:
@@ -329,13 +350,13 @@ async def check_alert_condition_2(unom: int, ctp_id: str, consumption_df: pd.Dat
 
 async def check_alert_condition_3(unom: int, ctp_id: str, consumption_df: pd.DataFrame,
                                  ctp_to_unom_map: Dict[str, List[int]], 
-                                 alert_time: datetime, excedents_df: pd.DataFrame = None) -> Optional[Dict[str, Any]]:
+                                 alert_time: datetime, excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Optional[Dict[str, Any]]:
     """
     Alert Condition 3: расход воды в доме=0 AND расход воды на выходе из ЦТП > 0 
     AND если п.2 не подтвердилось отключение
     """
     try:
-        start_time = alert_time - timedelta(hours=CONFIG['event_duration_threshold'])
+        start_time = alert_time - timedelta(hours=config['event_duration_threshold'])
         
         # Get consumption data for the house
         house_data = await get_consumption_for_period_unom(unom, start_time, alert_time, consumption_df)
@@ -344,7 +365,7 @@ async def check_alert_condition_3(unom: int, ctp_id: str, consumption_df: pd.Dat
             
         # Check if house consumption is zero
         latest_house_consumption = house_data['реальный'].iloc[-1]
-        if not is_zero_consumption(latest_house_consumption):
+        if not is_zero_consumption(latest_house_consumption, config):
             return None
             
         # Get CTP consumption data
@@ -354,7 +375,7 @@ async def check_alert_condition_3(unom: int, ctp_id: str, consumption_df: pd.Dat
             
         # Check if CTP outlet consumption is greater than zero
         latest_ctp_consumption = ctp_data['реальный'].iloc[-1]
-        if is_zero_consumption(latest_ctp_consumption):
+        if is_zero_consumption(latest_ctp_consumption, config):
             return None
             
         # Check if condition 2 would not be met (i.e., other houses don't have consumption)
@@ -365,7 +386,7 @@ async def check_alert_condition_3(unom: int, ctp_id: str, consumption_df: pd.Dat
             other_house_data = await get_consumption_for_period_unom(other_unom, start_time, alert_time, consumption_df)
             if not other_house_data.empty:
                 other_consumption = other_house_data['реальный'].iloc[-1]
-                if not is_zero_consumption(other_consumption):
+                if not is_zero_consumption(other_consumption, config):
                     other_houses_with_consumption += 1
                     
         # Condition 3 is met if condition 2 would NOT be met (no other houses with consumption)
@@ -392,14 +413,14 @@ async def check_alert_condition_3(unom: int, ctp_id: str, consumption_df: pd.Dat
 
 async def check_alert_condition_4(unom: int, ctp_id: str, consumption_df: pd.DataFrame,
                                  ctp_to_unom_map: Dict[str, List[int]], 
-                                 alert_time: datetime, excedents_df: pd.DataFrame = None) -> Optional[Dict[str, Any]]:
+                                 alert_time: datetime, excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Optional[Dict[str, Any]]:
     """
     Alert Condition 4: расход воды намного больше прогнозируемого AND 
     расход воды на выходе из ЦТП ≈ сумме расходов воды на входе в дома (+/-5%) AND
     В других домах подключенных к ЦТП расход ≈ прогнозируемому
     """
     try:
-        start_time = alert_time - timedelta(hours=CONFIG['event_duration_threshold'])
+        start_time = alert_time - timedelta(hours=config['event_duration_threshold'])
         
         # Get consumption data for the house
         house_data = await get_consumption_for_period_unom(unom, start_time, alert_time, consumption_df)
@@ -411,8 +432,8 @@ async def check_alert_condition_4(unom: int, ctp_id: str, consumption_df: pd.Dat
         latest_house_predicted = house_data['прогноз'].iloc[-1]
         
         # Check for leak either by consumption pattern or excedents data
-        has_consumption_leak = is_consumption_leak_level(latest_house_real, latest_house_predicted)
-        has_excedents_leak_data = has_excedents_leak(unom, start_time, alert_time, excedents_df)
+        has_consumption_leak = is_consumption_leak_level(latest_house_real, latest_house_predicted, config)
+        has_excedents_leak_data = has_excedents_leak(unom, start_time, alert_time, excedents_df, config)
         
         if not (has_consumption_leak or has_excedents_leak_data):
             return None
@@ -437,7 +458,7 @@ async def check_alert_condition_4(unom: int, ctp_id: str, consumption_df: pd.Dat
                 total_house_predicted += house_data_temp['прогноз'].iloc[-1]
         
         # Check if CTP consumption is approximately equal to sum of house consumptions
-        if not is_consumption_approximately_equal(latest_ctp_real, total_house_consumption):
+        if not is_consumption_approximately_equal(latest_ctp_real, total_house_consumption, config):
             return None
             
         # Check other houses (excluding current house)
@@ -449,7 +470,7 @@ async def check_alert_condition_4(unom: int, ctp_id: str, consumption_df: pd.Dat
             if not other_house_data.empty:
                 other_real = other_house_data['реальный'].iloc[-1]
                 other_predicted = other_house_data['прогноз'].iloc[-1]
-                if is_consumption_approximately_equal(other_real, other_predicted):
+                if is_consumption_approximately_equal(other_real, other_predicted, config):
                     other_houses_normal += 1
                     
         # At least some other houses should have normal consumption
@@ -479,12 +500,12 @@ async def check_alert_condition_4(unom: int, ctp_id: str, consumption_df: pd.Dat
 
 async def check_alert_condition_7(unom: int, ctp_id: str, consumption_df: pd.DataFrame,
                                  ctp_to_unom_map: Dict[str, List[int]], 
-                                 alert_time: datetime, excedents_df: pd.DataFrame = None) -> Optional[Dict[str, Any]]:
+                                 alert_time: datetime, excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Optional[Dict[str, Any]]:
     """
     Alert Condition 7: Дефицит воды в доме - расход более чем в 2 раза меньше прогнозируемого
     """
     try:
-        start_time = alert_time - timedelta(hours=CONFIG['event_duration_threshold'])
+        start_time = alert_time - timedelta(hours=config['event_duration_threshold'])
         
         # Get consumption data for the house
         house_data = await get_consumption_for_period_unom(unom, start_time, alert_time, consumption_df, excedents_df=excedents_df)
@@ -496,14 +517,14 @@ async def check_alert_condition_7(unom: int, ctp_id: str, consumption_df: pd.Dat
         latest_house_predicted = house_data['прогноз'].iloc[-1]
         
         # Проверяем: реальный расход не должен быть нулевым (это другой тип алерта)
-        if is_zero_consumption(latest_house_real):
+        if is_zero_consumption(latest_house_real, config):
             return None
         
         # Проверяем: реальный расход должен быть более чем в 2 раза меньше прогнозируемого
         if latest_house_predicted <= 0:
             return None
             
-        if latest_house_real >= latest_house_predicted * CONFIG['water_deficit_threshold']:
+        if latest_house_real >= latest_house_predicted * config['water_deficit_threshold']:
             return None
         # Условие выполнено - генерируем алерт
         return {
@@ -526,23 +547,39 @@ async def check_alert_condition_7(unom: int, ctp_id: str, consumption_df: pd.Dat
 
 async def check_alert_condition_5(unom: int, ctp_id: str, consumption_df: pd.DataFrame,
                                  ctp_to_unom_map: Dict[str, List[int]], 
-                                 alert_time: datetime, excedents_df: pd.DataFrame = None) -> Optional[Dict[str, Any]]:
+                                 alert_time: datetime, excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Optional[Dict[str, Any]]:
     """
     Alert Condition 5: Маленькая утечка, обнаруженная ML-моделью
     Использует оптимизированную модель из small_leakage_model.py
     """
     try:
         
-        start_time = alert_time - timedelta(hours=CONFIG['event_duration_threshold'])
+        start_time = alert_time - timedelta(hours=config['event_duration_threshold'])
         
         # Используем ML-модель для анализа утечек
         analysis_result = await analyze_leakage_with_consumption_data(
             unom=unom,
             start_ts=start_time.isoformat(),
             end_ts=alert_time.isoformat(),
-            threshold=CONFIG['small_leakage_threshold']
+            threshold=config['small_leakage_threshold'],
+            consumption_df=consumption_df,
+            excedents_df=excedents_df
         )
         
+        return build_alert_5_data(unom, ctp_id, analysis_result, start_time, alert_time, excedents_df, config)
+        
+    except Exception as e:
+        print(f"Error in check_alert_condition_5: {e}")
+        return None
+
+def build_alert_5_data(unom: int, ctp_id: str, analysis_result: Dict[str, Any],
+                       start_time: datetime, alert_time: datetime,
+                       excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Optional[Dict[str, Any]]:
+    """
+    Decides condition 5 for a house from the ML analysis result
+    (analyze_leakage_with_consumption_data or analyze_leakage_batch) and excedents data.
+    """
+    try:
         # Проверяем, обнаружена ли утечка ML-моделью
         ml_leakage = analysis_result.get('is_leakage', False)
         ml_probability = analysis_result.get('leakage_probability', 0.0)
@@ -565,8 +602,8 @@ async def check_alert_condition_5(unom: int, ctp_id: str, consumption_df: pd.Dat
             if not house_excedents.empty:
                 house_excedents['leakage_numeric'] = pd.to_numeric(house_excedents['leakage'], errors='coerce')
                 small_leaks = house_excedents[
-                    (house_excedents['leakage_numeric'] >= CONFIG['small_leakage_excedents_threshold']) &
-                    (house_excedents['leakage_numeric'] < CONFIG['min_leakage_threshold'])
+                    (house_excedents['leakage_numeric'] >= config['small_leakage_excedents_threshold']) &
+                    (house_excedents['leakage_numeric'] < config['min_leakage_threshold'])
                 ]
                 
                 # Проверяем пересечение с периодом
@@ -599,25 +636,25 @@ async def check_alert_condition_5(unom: int, ctp_id: str, consumption_df: pd.Dat
                 'leakage_probability': float(ml_probability),
                 'confidence': analysis_result.get('confidence', 'unknown'),
                 'data_points': data_points,
-                'threshold_used': CONFIG['small_leakage_threshold'],
+                'threshold_used': config['small_leakage_threshold'],
                 'detection_method': detection_method
             }
         }
         
     except Exception as e:
-        print(f"Error in check_alert_condition_5: {e}")
+        print(f"Error in build_alert_5_data: {e}")
         return None
 
 async def check_alert_condition_6(ctp_id: str, consumption_df: pd.DataFrame,
                                  ctp_to_unom_map: Dict[str, List[int]], 
-                                 alert_time: datetime, excedents_df: pd.DataFrame = None) -> Optional[Dict[str, Any]]:
+                                 alert_time: datetime, excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Optional[Dict[str, Any]]:
     """
     Alert Condition 6: Нештатная работа насосов ЦТП (кавитация).
     Срабатывает когда расход воды на ЦТП * multiplier > максимального прогнозируемого расхода за последние 24 часа
     """
     try:
         # Get last 24 hours of CTP consumption data to find max predicted
-        lookback_start = alert_time - timedelta(hours=CONFIG['pump_cavitation_lookback_hours'])
+        lookback_start = alert_time - timedelta(hours=config['pump_cavitation_lookback_hours'])
         ctp_data_24h = await get_consumption_for_period_ctp(ctp_id, lookback_start, alert_time, consumption_df, ctp_to_unom_map, excedents_df=excedents_df)
         
         if ctp_data_24h.empty:
@@ -633,7 +670,7 @@ async def check_alert_condition_6(ctp_id: str, consumption_df: pd.DataFrame,
         latest_ctp_consumption = ctp_data_24h['реальный'].iloc[-1]
         
         # Calculate dynamic threshold
-        dynamic_threshold = max_predicted_consumption * CONFIG['pump_cavitation_multiplier']
+        dynamic_threshold = max_predicted_consumption * config['pump_cavitation_multiplier']
         
         # Check if current consumption exceeds the dynamic threshold
         if latest_ctp_consumption <= dynamic_threshold:
@@ -649,7 +686,7 @@ async def check_alert_condition_6(ctp_id: str, consumption_df: pd.DataFrame,
                 'ctp_consumption': float(latest_ctp_consumption),
                 'max_predicted_24h': float(max_predicted_consumption),
                 'dynamic_threshold': float(dynamic_threshold),
-                'multiplier': CONFIG['pump_cavitation_multiplier']
+                'multiplier': config['pump_cavitation_multiplier']
             }
         }
         
@@ -659,12 +696,12 @@ async def check_alert_condition_6(ctp_id: str, consumption_df: pd.DataFrame,
 
 async def check_alert_condition_8(ctp_id: str, consumption_df: pd.DataFrame,
                                  ctp_to_unom_map: Dict[str, List[int]], 
-                                 alert_time: datetime, excedents_df: pd.DataFrame = None) -> Optional[Dict[str, Any]]:
+                                 alert_time: datetime, excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Optional[Dict[str, Any]]:
     """
     Alert Condition 8: Расход воды в ЦТП > суммы расхода воды в домах
     """
     try:
-        start_time = alert_time - timedelta(hours=CONFIG['event_duration_threshold'])
+        start_time = alert_time - timedelta(hours=config['event_duration_threshold'])
         
         # Check if there's a significant leak recorded in excedents data for this CTP
         has_excedents_ctp_leak = False
@@ -679,7 +716,7 @@ async def check_alert_condition_8(ctp_id: str, consumption_df: pd.DataFrame,
             ctp_excedents['leakage_numeric'] = pd.to_numeric(ctp_excedents['leakage'], errors='coerce')
             
             # Filter for significant leakage
-            ctp_excedents = ctp_excedents[ctp_excedents['leakage_numeric'] > CONFIG['min_leakage_threshold']]
+            ctp_excedents = ctp_excedents[ctp_excedents['leakage_numeric'] > config['min_leakage_threshold']]
             
             if not ctp_excedents.empty:
                 # Check if any excedent overlaps with the time period
@@ -777,8 +814,387 @@ async def check_alert_condition_9(unom: int, ctp_id: str, consumption_df: pd.Dat
         print(f"Error in check_alert_condition_9: {e}")
         return None
 
+# --- Network-wide Alert Engine ---
+
+_NO_TIMESTAMP = np.iinfo(np.int64).min
+
+def _zero_mask(values: np.ndarray, config: Mapping[str, Any] = CONFIG) -> np.ndarray:
+    """Vectorized is_zero_consumption"""
+    return values <= config['zero_consumption_threshold']
+
+def _leak_level_mask(real: np.ndarray, predicted: np.ndarray, config: Mapping[str, Any] = CONFIG) -> np.ndarray:
+    """Vectorized is_consumption_leak_level"""
+    return np.where(
+        predicted <= 0,
+        real > config['zero_consumption_threshold'],
+        (real >= config['min_consumption_for_leak']) & (real > predicted * config['leak_detection_threshold'])
+    )
+
+def _approximately_equal_mask(real: np.ndarray, predicted: np.ndarray, config: Mapping[str, Any] = CONFIG) -> np.ndarray:
+    """Vectorized is_consumption_approximately_equal"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = np.abs(real - predicted) / predicted
+    return np.where(predicted <= 0, _zero_mask(real, config), relative <= config['consumption_tolerance'])
+
+class NetworkSnapshot:
+    """
+    Latest-hour consumption for every house and CTP of the network.
+
+    For each house the latest hour is its last row in [start_time, alert_time]; a CTP reports
+    the latest hour among its houses, summed over the houses that have data for that hour
+    (same as the last row of get_consumption_for_period_ctp). Memberships (CTP, house) keep
+    the order of ctp_to_unom_map, so results line up with the per-CTP house loop.
+    """
+
+    def __init__(self, ctp_to_unom_map: Dict[str, List[int]], consumption_df: pd.DataFrame,
+                 start_time: datetime, alert_time: datetime, excedents_df: pd.DataFrame = None):
+        unom_index = get_unom_index(consumption_df)
+        self.excedents_df = excedents_df
+        self.ctp_ids = list(ctp_to_unom_map.keys())
+        member_unoms = np.array([int(unom) for ctp_id in self.ctp_ids for unom in ctp_to_unom_map[ctp_id]], dtype=np.int64)
+        self.member_ctp = np.repeat(np.arange(len(self.ctp_ids)), [len(ctp_to_unom_map[ctp_id]) for ctp_id in self.ctp_ids])
+        self.unoms, self.member_house = np.unique(member_unoms, return_inverse=True)
+        self.member_house = self.member_house.reshape(-1)
+
+        # Memberships of the same house in the same CTP (duplicates in the map)
+        member_keys = self.member_ctp * max(len(self.unoms), 1) + self.member_house
+        _, inverse, counts = np.unique(member_keys, return_inverse=True, return_counts=True)
+        self.multiplicity = counts[inverse.reshape(-1)]
+        self.ctp_size = np.bincount(self.member_ctp, minlength=len(self.ctp_ids))
+
+        # Latest hour for every house
+        rows = unom_index.last_rows(self.unoms.tolist(), start_time, alert_time)
+        self.present = rows >= 0
+        present_rows = rows[self.present]
+        self.timestamps = np.full(len(self.unoms), _NO_TIMESTAMP, dtype=np.int64)
+        self.timestamps[self.present] = unom_index.timestamps[present_rows]
+        self.predicted = self._house_values(unom_index.consumption[present_rows])
+        self.real = self._house_values(get_real_consumption_rows(consumption_df, present_rows, HOUSE_NOISE_LEVEL, excedents_df))
+        self.real_without_excedents = self._house_values(get_real_consumption_rows(consumption_df, present_rows, HOUSE_NOISE_LEVEL))
+
+        # Latest hour for every CTP (house series aggregated at the CTP noise level)
+        member_timestamps = self.timestamps[self.member_house]
+        self.ctp_timestamps = np.full(len(self.ctp_ids), _NO_TIMESTAMP, dtype=np.int64)
+        np.maximum.at(self.ctp_timestamps, self.member_ctp, member_timestamps)
+        self.ctp_present = self.ctp_timestamps != _NO_TIMESTAMP
+        at_latest = self.present[self.member_house] & (member_timestamps == self.ctp_timestamps[self.member_ctp])
+
+        ctp_house_real = self._house_values(get_real_consumption_rows(consumption_df, present_rows, CTP_NOISE_LEVEL, excedents_df))
+        ctp_house_plain = self._house_values(get_real_consumption_rows(consumption_df, present_rows, CTP_NOISE_LEVEL))
+        self.ctp_real = self._ctp_sum(ctp_house_real, at_latest)
+        self.ctp_real_without_excedents = self._ctp_sum(ctp_house_plain, at_latest)
+
+        # CTP-level excedents on top of the house sum
+        if excedents_df is not None and not excedents_df.empty:
+            excedents_index = get_excedents_index(excedents_df)
+            for position in np.flatnonzero(self.ctp_present):
+                leakage, disconnect = excedents_index.rates('ctp', self.ctp_ids[position], self.ctp_timestamps[position:position + 1])
+                self.ctp_real[position] = 0.0 if disconnect[0] else self.ctp_real[position] + leakage[0]
+
+    def _house_values(self, present_values: np.ndarray) -> np.ndarray:
+        values = np.zeros(len(self.unoms), dtype=np.float64)
+        values[self.present] = present_values
+        return values
+
+    def _ctp_sum(self, house_values: np.ndarray, member_mask: np.ndarray) -> np.ndarray:
+        """Sum of house_values over the memberships in member_mask, per CTP"""
+        return np.bincount(self.member_ctp[member_mask], weights=house_values[self.member_house[member_mask]],
+                           minlength=len(self.ctp_ids))
+
+    def ctp_sum(self, house_values: np.ndarray) -> np.ndarray:
+        """Sum of house_values over the houses of each CTP that have data"""
+        return self._ctp_sum(house_values, self.present[self.member_house])
+
+    def other_houses_count(self, house_flags: np.ndarray) -> np.ndarray:
+        """For every membership: number of other houses of the same CTP with the flag set"""
+        flags = house_flags[self.member_house].astype(np.int64)
+        per_ctp = np.bincount(self.member_ctp, weights=flags, minlength=len(self.ctp_ids)).astype(np.int64)
+        return per_ctp[self.member_ctp] - self.multiplicity * flags
+
+    def has_other_houses(self) -> np.ndarray:
+        """For every membership: whether the CTP has any other house"""
+        return self.ctp_size[self.member_ctp] - self.multiplicity > 0
+
+    def members(self):
+        """Iterates (membership, ctp_id, unom) in map order"""
+        for member, (ctp_position, house) in enumerate(zip(self.member_ctp, self.member_house)):
+            yield member, self.ctp_ids[ctp_position], int(self.unoms[house])
+
+def _excedents_overlap_mask(entity_type: str, entity_ids, start_time: datetime, alert_time: datetime,
+                            excedents_df: pd.DataFrame, config: Mapping[str, Any] = CONFIG) -> np.ndarray:
+    """Whether a significant leak (> min_leakage_threshold) recorded in excedents overlaps the period"""
+    mask = np.zeros(len(entity_ids), dtype=bool)
+    if excedents_df is None or excedents_df.empty:
+        return mask
+
+    excedents_index = get_excedents_index(excedents_df)
+    start_ns, end_ns = pd.Timestamp(start_time).value, pd.Timestamp(alert_time).value
+    for position, entity_id in enumerate(entity_ids):
+        rates = excedents_index.overlapping_rates(entity_type, entity_id, start_ns, end_ns)
+        mask[position] = bool((rates > config['min_leakage_threshold']).any())
+    return mask
+
+def evaluate_house_conditions(snapshot: NetworkSnapshot, start_time: datetime, alert_time: datetime,
+                              excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Dict[int, np.ndarray]:
+    """
+    Evaluates house-level conditions 1, 2, 3, 4 and 7 for every membership at once.
+    Same predicates as check_alert_condition_1..4 and 7, over all other houses of the CTP.
+    Returns {alert_id: boolean mask over memberships}.
+    """
+    house = snapshot.member_house
+    ctp = snapshot.member_ctp
+    present = snapshot.present[house]
+    ctp_present = snapshot.ctp_present[ctp]
+
+    # Series with excedents (conditions 1, 2, 7)
+    house_zero = snapshot.present & _zero_mask(snapshot.real, config)
+    house_consuming = snapshot.present & ~_zero_mask(snapshot.real, config)
+    ctp_zero = _zero_mask(snapshot.ctp_real, config)[ctp]
+    other_consuming = snapshot.other_houses_count(house_consuming)
+    has_others = snapshot.has_other_houses()
+
+    condition_1 = present & house_zero[house] & ctp_present & ctp_zero & has_others & (other_consuming == 0)
+    condition_2 = present & house_zero[house] & ctp_present & ~ctp_zero & has_others & (other_consuming > 0)
+
+    # Series without excedents (conditions 3, 4)
+    plain = snapshot.real_without_excedents
+    plain_zero = snapshot.present & _zero_mask(plain, config)
+    plain_consuming = snapshot.present & ~_zero_mask(plain, config)
+    ctp_plain_zero = _zero_mask(snapshot.ctp_real_without_excedents, config)[ctp]
+
+    condition_3 = (present & plain_zero[house] & ctp_present & ~ctp_plain_zero
+                   & (snapshot.other_houses_count(plain_consuming) == 0))
+
+    house_leak = _leak_level_mask(plain, snapshot.predicted, config) | _excedents_overlap_mask(
+        'mcd', snapshot.unoms, start_time, alert_time, excedents_df, config)
+    houses_total = snapshot.ctp_sum(plain)
+    ctp_matches_houses = _approximately_equal_mask(snapshot.ctp_real_without_excedents, houses_total, config)[ctp]
+    house_normal = snapshot.present & _approximately_equal_mask(plain, snapshot.predicted, config)
+
+    condition_4 = (present & house_leak[house] & ctp_present & ctp_matches_houses
+                   & (snapshot.other_houses_count(house_normal) > 0))
+
+    # Water deficit
+    condition_7 = (present & house_consuming[house] & (snapshot.predicted[house] > 0)
+                   & (snapshot.real[house] < snapshot.predicted[house] * config['water_deficit_threshold']))
+
+    return {1: condition_1, 2: condition_2, 3: condition_3, 4: condition_4, 7: condition_7}
+
+def build_house_alert_data(alert_id: int, snapshot: NetworkSnapshot, member: int,
+                           alert_time: datetime, config: Mapping[str, Any] = CONFIG) -> Dict[str, Any]:
+    """Builds the alert payload for a membership matched by evaluate_house_conditions"""
+    ctp_position, house = snapshot.member_ctp[member], snapshot.member_house[member]
+    ctp_id, unom = snapshot.ctp_ids[ctp_position], int(snapshot.unoms[house])
+
+    if alert_id in (1, 2, 7):
+        house_real = float(snapshot.real[house])
+    else:
+        house_real = float(snapshot.real_without_excedents[house])
+    house_predicted = float(snapshot.predicted[house])
+
+    if alert_id in (1, 2):
+        consumption_data = {'house_consumption': house_real, 'ctp_consumption': float(snapshot.ctp_real[ctp_position])}
+        if alert_id == 2:
+            consuming = snapshot.present & ~_zero_mask(snapshot.real, config)
+            consumption_data['other_houses_with_consumption'] = int(snapshot.other_houses_count(consuming)[member])
+    elif alert_id == 3:
+        consumption_data = {'house_consumption': house_real,
+                            'ctp_consumption': float(snapshot.ctp_real_without_excedents[ctp_position])}
+    elif alert_id == 4:
+        normal = snapshot.present & _approximately_equal_mask(snapshot.real_without_excedents, snapshot.predicted, config)
+        consumption_data = {
+            'house_consumption': house_real,
+            'house_predicted': house_predicted,
+            'ctp_consumption': float(snapshot.ctp_real_without_excedents[ctp_position]),
+            'total_houses_consumption': float(snapshot.ctp_sum(snapshot.real_without_excedents)[ctp_position]),
+            'other_houses_normal': int(snapshot.other_houses_count(normal)[member])
+        }
+    else:
+        consumption_data = {
+            'house_consumption': house_real,
+            'house_predicted': house_predicted,
+            'deficit_ratio': house_real / house_predicted if house_predicted > 0 else 0
+        }
+
+    return {
+        'alert_id': alert_id,
+        'unom': unom,
+        'ctp_id': ctp_id,
+        'address': get_house_address(unom),
+        'ctp_name': get_ctp_name(ctp_id),
+        'timestamp': alert_time.isoformat(),
+        'consumption_data': consumption_data
+    }
+
+def evaluate_ctp_conditions(snapshot: NetworkSnapshot, ctp_to_unom_map: Dict[str, List[int]],
+                            consumption_df: pd.DataFrame, start_time: datetime, alert_time: datetime,
+                            excedents_df: pd.DataFrame = None, config: Mapping[str, Any] = CONFIG) -> Dict[str, List[Optional[Dict[str, Any]]]]:
+    """
+    Evaluates CTP-level conditions 6 and 8 for every CTP at once.
+    Returns {ctp_id: [alert_6 or None, alert_8 or None]}.
+    """
+    results = {ctp_id: [None, None] for ctp_id in snapshot.ctp_ids}
+
+    # Condition 6: pump cavitation, from the CTP x hour aggregates over the lookback window
+    aggregates = get_ctp_aggregates(consumption_df)
+    if aggregates is None or not aggregates.matches(ctp_to_unom_map, CTP_NOISE_LEVEL, excedents_df):
+        selected_map = {ctp_id: ctp_to_unom_map[ctp_id] for ctp_id in snapshot.ctp_ids}
+        aggregates = CtpAggregates(consumption_df, selected_map, excedents_df)
+    ctp_rows = np.array([aggregates.positions[ctp_id] for ctp_id in snapshot.ctp_ids], dtype=np.int64)
+
+    lookback_start = alert_time - timedelta(hours=config['pump_cavitation_lookback_hours'])
+    hours = aggregates.locate(lookback_start, alert_time)
+    if hours.stop > hours.start and len(ctp_rows):
+        reporting = aggregates.reporting[ctp_rows, hours] > 0
+        max_predicted = np.where(reporting, aggregates.predicted[ctp_rows, hours], -np.inf).max(axis=1)
+        last = reporting.shape[1] - 1 - np.argmax(reporting[:, ::-1], axis=1)
+        latest_real = aggregates.real[ctp_rows, hours][np.arange(len(ctp_rows)), last]
+        dynamic_threshold = max_predicted * config['pump_cavitation_multiplier']
+        matched = reporting.any(axis=1) & (max_predicted > 0) & (latest_real > dynamic_threshold)
+
+        for position in np.flatnonzero(matched):
+            ctp_id = snapshot.ctp_ids[position]
+            results[ctp_id][0] = {
+                'alert_id': 6,
+                'ctp_id': ctp_id,
+                'ctp_name': get_ctp_name(ctp_id),
+                'timestamp': alert_time.isoformat(),
+                'consumption_data': {
+                    'ctp_consumption': float(latest_real[position]),
+                    'max_predicted_24h': float(max_predicted[position]),
+                    'dynamic_threshold': float(dynamic_threshold[position]),
+                    'multiplier': config['pump_cavitation_multiplier']
+                }
+            }
+
+    # Condition 8: CTP consumption > sum of house consumptions, or a CTP leak in excedents
+    houses_total = snapshot.ctp_sum(snapshot.real)
+    house_count = np.bincount(snapshot.member_ctp, weights=snapshot.present[snapshot.member_house],
+                              minlength=len(snapshot.ctp_ids)).astype(np.int64)
+    ctp_leak = _excedents_overlap_mask('ctp', snapshot.ctp_ids, start_time, alert_time, excedents_df, config)
+    matched = (snapshot.ctp_present & (house_count > 0)
+               & ((snapshot.ctp_real > houses_total * 1.1) | ctp_leak))  # 10% tolerance
+
+    for position in np.flatnonzero(matched):
+        ctp_id = snapshot.ctp_ids[position]
+        results[ctp_id][1] = {
+            'alert_id': 8,
+            'ctp_id': ctp_id,
+            'ctp_name': get_ctp_name(ctp_id),
+            'timestamp': alert_time.isoformat(),
+            'consumption_data': {
+                'ctp_consumption': float(snapshot.ctp_real[position]),
+                'total_houses_consumption': float(houses_total[position]),
+                'house_count': int(house_count[position]),
+                'consumption_difference': float(snapshot.ctp_real[position] - houses_total[position])
+            }
+        }
+
+    return results
+
 # --- Main Alert Generation Function ---
 
+async def evaluate_alerts(ctp_to_unom_map: Dict[str, List[int]],
+                          consumption_df: pd.DataFrame,
+                          alert_time: datetime,
+                          excedents_df: pd.DataFrame = None,
+                          ctp_ids: Optional[List[str]] = None,
+                          config: Optional[Mapping[str, Any]] = None) -> Dict[str, Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]:
+    """
+    Evaluates alerts for the CTPs in ctp_ids (all CTPs by default) with config
+    (a snapshot from alert_config; the current CONFIG by default).
+
+    Alerts of a CTP depend only on its own houses, so results for different CTPs can be
+    computed separately and merged with assemble_alerts.
+
+    Returns:
+        {ctp_id: (house_alerts, ctp_alerts)} in map order
+    """
+    if config is None:
+        config = alert_config()
+    if ctp_ids is None:
+        ctp_ids = list(ctp_to_unom_map.keys())
+    selected_map = {ctp_id: ctp_to_unom_map[ctp_id] for ctp_id in ctp_ids if ctp_id in ctp_to_unom_map}
+    results = {ctp_id: ([], []) for ctp_id in selected_map}
+
+    # Latest-hour values for the whole network, loaded once. The vectorized passes run in the
+    # loop's executor so a long-lived loop keeps serving other requests meanwhile
+    start_time = alert_time - timedelta(hours=config['event_duration_threshold'])
+    snapshot = await asyncio.to_thread(NetworkSnapshot, selected_map, consumption_df, start_time, alert_time, excedents_df)
+    house_conditions = await asyncio.to_thread(evaluate_house_conditions, snapshot, start_time, alert_time, excedents_df, config)
+
+    # Condition 5: one batched ML pass over the houses not matched by conditions 1-4
+    candidates = ~(house_conditions[1] | house_conditions[2] | house_conditions[3] | house_conditions[4])
+    leakage_analysis = None
+    try:
+        leakage_analysis = await analyze_leakage_batch(
+            [int(unom) for unom in snapshot.unoms[np.unique(snapshot.member_house[candidates])]],
+            start_ts=start_time.isoformat(),
+            end_ts=alert_time.isoformat(),
+            threshold=config['small_leakage_threshold'],
+            consumption_df=consumption_df,
+            excedents_df=excedents_df
+        )
+    except Exception as e:
+        print(f"Error in small leak analysis: {e}")
+
+    # Check individual house alerts (conditions 1-4, 5, 7)
+    for member, ctp_id, unom in snapshot.members():
+        house_alerts = results[ctp_id][0]
+        try:
+            # Check condition 9 first (high probability of emergency - predictive)
+            alert_9 = await check_alert_condition_9(unom, ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
+            if alert_9:
+                house_alerts.append(create_alert_object(alert_9))
+
+            # Conditions 1-4 in priority order: only the first match is reported
+            matched_id = next((alert_id for alert_id in (1, 2, 3, 4) if house_conditions[alert_id][member]), None)
+            if matched_id is not None:
+                house_alerts.append(create_alert_object(build_house_alert_data(matched_id, snapshot, member, alert_time, config)))
+                continue
+
+            # Check condition 5 (small leak detection with ML)
+            alert_5 = None
+            if leakage_analysis is not None:
+                alert_5 = build_alert_5_data(unom, ctp_id, leakage_analysis[unom], start_time, alert_time, excedents_df, config)
+            if alert_5:
+                house_alerts.append(create_alert_object(alert_5))
+                continue
+
+            # Check condition 7
+            if house_conditions[7][member]:
+                house_alerts.append(create_alert_object(build_house_alert_data(7, snapshot, member, alert_time, config)))
+
+        except Exception as e:
+            print(f"Error checking alerts for house {unom}: {e}")
+            continue
+
+    # Check CTP-level alerts (conditions 6 and 8)
+    ctp_conditions = await asyncio.to_thread(evaluate_ctp_conditions, snapshot, ctp_to_unom_map, consumption_df,
+                                             start_time, alert_time, excedents_df, config)
+    for ctp_id in selected_map:
+        results[ctp_id][1].extend(create_alert_object(alert_data) for alert_data in ctp_conditions[ctp_id] if alert_data)
+
+    return results
+
+def assemble_alerts(ctp_ids: List[str], results: Dict[str, Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]) -> List[Dict[str, Any]]:
+    """
+    Merges per-CTP results of evaluate_alerts into the API list: house alerts first,
+    then CTP-level alerts, sorted by level.
+    """
+    alerts = [alert for ctp_id in ctp_ids if ctp_id in results for alert in results[ctp_id][0]]
+    alerts.extend(alert for ctp_id in ctp_ids if ctp_id in results for alert in results[ctp_id][1])
+
+    # Sort alerts by level priority: Высокий (High) > Средний (Medium) > Низкий (Low)
+    level_priority = {
+        'Высокий': 0,
+        'Средний': 1,
+        'Низкий': 2
+    }
+    alerts.sort(key=lambda alert: level_priority.get(alert.get('level', 'Низкий'), 999))
+    
+    return alerts
+
 async def generate_alerts(ctp_to_unom_map: Dict[str, List[int]], 
                          consumption_df: pd.DataFrame,
                          config: Dict[str, Any] = None,
@@ -790,7 +1206,7 @@ async def generate_alerts(ctp_to_unom_map: Dict[str, List[int]],
     Args:
         ctp_to_unom_map: Mapping of CTP IDs to lists of UNOMs
         consumption_df: DataFrame with consumption data
-        config: Configuration dictionary
+        config: Overrides of CONFIG for this call (CONFIG itself is not modified)
         alert_time: Time to check for alerts (defaults to current time)
     
     Returns:
@@ -799,88 +1215,182 @@ async def generate_alerts(ctp_to_unom_map: Dict[str, List[int]],
     if alert_time is None:
         alert_time = datetime.now()
         
-    if config:
-        CONFIG.update(config)
-    
-    alerts = []
+    config = alert_config(config)
+    results = {}
     
     try:
-        # Check individual house alerts (conditions 1-4)
-        for ctp_id, unoms in ctp_to_unom_map.items():
-            for unom in unoms[:20]:  # Limit to first 20 houses per CTP for performance
-                try:
-                    # Check condition 9 first (high probability of emergency - predictive)
-                    alert_9 = await check_alert_condition_9(unom, ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
-                    if alert_9:
-                        alerts.append(create_alert_object(alert_9))
-                    
-                    # Check condition 1
-                    alert_1 = await check_alert_condition_1(unom, ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
-                    if alert_1:
-                        alerts.append(create_alert_object(alert_1))
-                        continue  # Don't check other conditions if condition 1 is met
-                    
-                    # Check condition 2
-                    alert_2 = await check_alert_condition_2(unom, ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
-                    if alert_2:
-                        alerts.append(create_alert_object(alert_2))
-                        continue
-                    
-                    # Check condition 3
-                    alert_3 = await check_alert_condition_3(unom, ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
-                    if alert_3:
-                        alerts.append(create_alert_object(alert_3))
-                        continue
-                    
-                    # Check condition 4
-                    alert_4 = await check_alert_condition_4(unom, ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
-                    if alert_4:
-                        alerts.append(create_alert_object(alert_4))
-                        continue
-                    
-                    # Check condition 5 (small leak detection with ML)
-                    alert_5 = await check_alert_condition_5(unom, ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
-                    if alert_5:
-                        alerts.append(create_alert_object(alert_5))
-                        continue
-                    
-                    # Check condition 7
-                    alert_7 = await check_alert_condition_7(unom, ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
-                    if alert_7:
-                        alerts.append(create_alert_object(alert_7))
-                        
-                except Exception as e:
-                    print(f"Error checking alerts for house {unom}: {e}")
-                    continue
-        
-        # Check CTP-level alerts (conditions 6 and 8)
-        for ctp_id in ctp_to_unom_map.keys():
-            try:
-                # Check condition 6 (pump cavitation)
-                alert_6 = await check_alert_condition_6(ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
-                if alert_6:
-                    alerts.append(create_alert_object(alert_6))
-                
-                # Check condition 8 (CTP leak)
-                alert_8 = await check_alert_condition_8(ctp_id, consumption_df, ctp_to_unom_map, alert_time, excedents_df)
-                if alert_8:
-                    alerts.append(create_alert_object(alert_8))
-            except Exception as e:
-                print(f"Error checking CTP alert for {ctp_id}: {e}")
-                continue
-                
+        results = await evaluate_alerts(ctp_to_unom_map, consumption_df, alert_time, excedents_df, config=config)
     except Exception as e:
         print(f"Error in generate_alerts: {e}")
     
-    # Sort alerts by level priority: Высокий (High) > Средний (Medium) > Низкий (Low)
-    level_priority = {
-        'Высокий': 0,
-        'Средний': 1,
-        'Низкий': 2
-    }
-    alerts.sort(key=lambda alert: level_priority.get(alert.get('level', 'Низкий'), 999))
-    
-    return alerts
+    return assemble_alerts(list(ctp_to_unom_map.keys()), results)
+
+# --- Alert Result Cache ---
+
+def _config_hash(config: Mapping[str, Any]) -> str:
+    """Hash of an alert config snapshot"""
+    return hashlib.sha1(json.dumps(dict(config), sort_keys=True, default=str).encode()).hexdigest()
+
+class AlertCache:
+    """
+    Cache of evaluate_alerts results keyed by (floored hour, config hash, excedents version).
+
+    Data is hourly, so every alert_time within an hour is evaluated at the start of that hour.
+    Concurrent callers asking for the same key (from any thread or event loop) share one
+    computation. When only excedents change, CTPs whose houses and CTP entry have the same
+    excedents fingerprints are copied from the cached result for the same hour and config;
+    a config change recomputes everything. The key and the evaluation use the same config
+    snapshot, so a result is never stored under the key of another config.
+
+    Results requested with record=True (only the canonical evaluation, see refresh_alert_state)
+    are written to the alert lifecycle store once per key, which turns them into
+    opened/updated/resolved transitions for the change feed.
+    """
+
+    def __init__(self, max_entries: int = 48, state_store_factory=get_alert_state_store):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._state_store_factory = state_store_factory
+        self._recorded_key = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    async def get_alerts(self, ctp_to_unom_map: Dict[str, List[int]],
+                         consumption_df: pd.DataFrame,
+                         alert_time: datetime = None,
+                         excedents_df: pd.DataFrame = None,
+                         record: bool = False,
+                         config: Optional[Mapping[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Returns alerts for the hour of alert_time with config (a snapshot from alert_config;
+        the current CONFIG by default), computing them at most once per key.
+        With record=True the result is also written to the alert lifecycle store.
+        """
+        if config is None:
+            config = alert_config()
+        hour = pd.Timestamp(alert_time if alert_time is not None else datetime.now()).floor('h').to_pydatetime()
+        has_excedents = excedents_df is not None and not excedents_df.empty
+        excedents_index = get_excedents_index(excedents_df) if has_excedents else None
+        fingerprints = excedents_index.fingerprints if has_excedents else {}
+        key = (id(consumption_df), id(ctp_to_unom_map), hour, _config_hash(config),
+               excedents_index.version if has_excedents else '')
+        ctp_ids = list(ctp_to_unom_map.keys())
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                future = None
+            else:
+                future = self._inflight.get(key)
+            is_owner = entry is None and future is None
+            if is_owner:
+                self.misses += 1
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+                base = self._find_base(key)
+
+        if entry is not None:
+            return await self._finish(key, hour, assemble_alerts(ctp_ids, entry['results']), record)
+        if not is_owner:
+            entry = await asyncio.wrap_future(future)
+            return await self._finish(key, hour, assemble_alerts(ctp_ids, entry['results']), record)
+
+        try:
+            results = {}
+            affected = ctp_ids
+            if base is not None:
+                affected = self._affected_ctps(ctp_to_unom_map, base['fingerprints'], fingerprints)
+                results = {ctp_id: base['results'][ctp_id] for ctp_id in ctp_ids
+                           if ctp_id not in affected and ctp_id in base['results']}
+            if affected:
+                results.update(await evaluate_alerts(ctp_to_unom_map, consumption_df, hour, excedents_df, affected, config))
+            entry = {'results': results, 'fingerprints': fingerprints}
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._inflight.pop(key, None)
+        future.set_result(entry)
+        return await self._finish(key, hour, assemble_alerts(ctp_ids, results), record)
+
+    async def _finish(self, key, hour: datetime, alerts: List[Dict[str, Any]], record: bool) -> List[Dict[str, Any]]:
+        """Records a live result in the lifecycle store (once per key in this process) and returns it"""
+        if record:
+            with self._lock:
+                is_new = self._recorded_key != key
+                self._recorded_key = key
+            if is_new:
+                try:
+                    await asyncio.to_thread(self._state_store_factory().record, alerts, hour)
+                except Exception as e:
+                    with self._lock:
+                        self._recorded_key = None
+                    print(f"Error recording alert transitions: {e}")
+        return alerts
+
+    def _find_base(self, key) -> Optional[Dict[str, Any]]:
+        """Latest entry for the same data, hour and config computed with other excedents"""
+        for other_key in reversed(self._entries):
+            if other_key[:4] == key[:4]:
+                return self._entries[other_key]
+        return None
+
+    @staticmethod
+    def _affected_ctps(ctp_to_unom_map: Dict[str, List[int]], old: Dict, new: Dict) -> List[str]:
+        """CTPs whose own or house excedents differ between two fingerprint sets"""
+        changed = {key for key in set(old) | set(new) if old.get(key) != new.get(key)}
+        changed_houses = {entity_id for entity_type, entity_id in changed if entity_type == 'mcd'}
+        return [ctp_id for ctp_id, unoms in ctp_to_unom_map.items()
+                if ('ctp', str(ctp_id)) in changed or any(str(unom) in changed_houses for unom in unoms)]
+
+ALERT_CACHE = AlertCache()
+
+async def get_alerts(ctp_to_unom_map: Dict[str, List[int]],
+                     consumption_df: pd.DataFrame,
+                     config: Dict[str, Any] = None,
+                     alert_time: datetime = None,
+                     excedents_df: pd.DataFrame = None) -> List[Dict[str, Any]]:
+    """
+    Cached generate_alerts: same arguments and result, evaluated at the start of the hour
+    of alert_time and shared between callers through ALERT_CACHE. Never writes to the alert
+    lifecycle store: any config may be requested here (see refresh_alert_state).
+    """
+    try:
+        return await ALERT_CACHE.get_alerts(ctp_to_unom_map, consumption_df, alert_time, excedents_df,
+                                            config=alert_config(config))
+    except Exception as e:
+        print(f"Error in get_alerts: {e}")
+        return []
+
+async def refresh_alert_state(ctp_to_unom_map: Dict[str, List[int]],
+                              consumption_df: pd.DataFrame,
+                              excedents_df: pd.DataFrame = None) -> List[Dict[str, Any]]:
+    """
+    Canonical live evaluation (current hour, FEED_CONFIG, with excedents) recorded in the alert
+    lifecycle store (see alert_state). Only this evaluation writes transitions, so alerts
+    requested with other settings (e.g. the duration slider of the frontend) never open or
+    resolve alerts in the change feed.
+    """
+    try:
+        return await ALERT_CACHE.get_alerts(ctp_to_unom_map, consumption_df, None, excedents_df,
+                                            record=True, config=alert_config(FEED_CONFIG))
+    except Exception as e:
+        print(f"Error in refresh_alert_state: {e}")
+        return []
 
 def create_alert_object(alert_data: Dict[str, Any]) -> Dict[str, Any]:
     """
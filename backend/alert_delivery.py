@@ -0,0 +1,477 @@
+"""
+Доставка алертов подписчикам Telegram через постоянную очередь с ограничением скорости.
+
+Алерты ставятся в очередь (SQLite рядом с данными, переживает перезапуск) по одной записи
+на подписчика. Воркеры забирают из очереди все ожидающие алерты чата и отправляют их одним
+сообщением-дайджестом, соблюдая лимиты: общий (token bucket на все чаты) и на каждый чат.
+Число одновременных отправок ограничено; при ошибке запись возвращается в очередь
+с экспоненциальной задержкой, при RetryAfter от Telegram — с задержкой, которую он указал.
+
+Транспорт подменяемый: TelegramTransport отправляет через telegram.Bot, StubTransport
+только записывает сообщения и позволяет проверять пропускную способность и лимиты офлайн
+(см. main()).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_QUEUE_PATH = os.path.join(base_dir, 'data', 'alert_outbox.db')
+
+# Лимиты Telegram Bot API: ~30 сообщений/с на бота, ~1 сообщение/с в один чат
+TELEGRAM_GLOBAL_LIMIT = 30
+TELEGRAM_CHAT_LIMIT = 1
+# Корзины токенов: за любую секунду уходит не больше rate + burst сообщений, это не выше лимитов
+GLOBAL_RATE = 25.0
+GLOBAL_BURST = 5
+CHAT_RATE = 1.0
+CHAT_BURST = 1
+# Одновременные отправки
+WORKER_CONCURRENCY = 8
+# Алертов в одном дайджесте и предел длины сообщения Telegram (4096) с запасом
+MAX_BATCH = 20
+MAX_MESSAGE_LENGTH = 4000
+# Повторы: задержка base * 2^attempt (с джиттером), не больше max; после MAX_ATTEMPTS запись отбрасывается
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 600.0
+MAX_ATTEMPTS = 8
+# Период опроса очереди, когда нет новых записей
+POLL_INTERVAL = 1.0
+
+LEVEL_EMOJI = {
+    "Критический": "🔴",
+    "Высокий": "🟠",
+    "Средний": "🟡",
+    "Низкий": "🟢"
+}
+
+
+class RetryLater(Exception):
+    """Транспорт просит повторить отправку не раньше чем через retry_after секунд"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class PermanentDeliveryError(Exception):
+    """Отправка в чат невозможна (бот заблокирован, чат не найден): записи не повторяются"""
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity накопленных"""
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Через сколько секунд будет доступен токен (0 - доступен сейчас)"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    async def acquire(self):
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                self.take()
+                return
+            await asyncio.sleep(wait)
+
+
+# Символы разметки Telegram Markdown (legacy), которые экранируются в тексте алертов
+MARKDOWN_SPECIAL = ('_', '*', '`', '[')
+ELLIPSIS = '…'
+
+
+def escape_markdown(value: Any) -> str:
+    """Текст поля алерта, безопасный для parse_mode='Markdown'"""
+    text = str(value)
+    for char in MARKDOWN_SPECIAL:
+        text = text.replace(char, '\\' + char)
+    return text
+
+
+def shorten_alert(alert: Dict[str, Any], max_field_length: int) -> Dict[str, Any]:
+    """Копия алерта, в которой строковые поля длиннее max_field_length обрезаны (до экранирования)"""
+    return {key: value[:max_field_length] + ELLIPSIS if isinstance(value, str) and len(value) > max_field_length else value
+            for key, value in alert.items()}
+
+
+# Пометки переходов из ленты изменений (alert_state); новые алерты идут без пометки
+STATUS_LABELS = {
+    'updated': "🔄 Обновлен\n",
+    'resolved': "✅ Устранен\n",
+}
+
+
+def format_alert(alert: Dict[str, Any]) -> str:
+    """Текст одного алерта (как в прежних уведомлениях бота); поля алерта экранируются"""
+    level_emoji = LEVEL_EMOJI.get(alert.get('level', ''), '⚪')
+    return (STATUS_LABELS.get(alert.get('status'), '') +
+            f"{level_emoji} **{escape_markdown(alert.get('level', 'Неизвестно'))}**\n"
+            f"🏠 {escape_markdown(alert.get('type', 'Неизвестно'))} {escape_markdown(alert.get('object_id', 'N/A'))}\n"
+            f"📝 {escape_markdown(alert.get('alert_message', 'Нет описания'))}\n"
+            f"💡 {escape_markdown(alert.get('comment', 'Нет комментария'))}")
+
+
+def format_digest(alerts: List[Dict[str, Any]]) -> str:
+    """Сообщение для одного или нескольких алертов"""
+    if all(alert.get('status') == 'resolved' for alert in alerts):
+        header = "✅ **Алерт устранен**" if len(alerts) == 1 else f"✅ **Устранено алертов: {len(alerts)}**"
+    else:
+        header = "🚨 **Новый алерт!**" if len(alerts) == 1 else f"🚨 **Новые алерты: {len(alerts)}**"
+    body = "\n\n".join(format_alert(alert) for alert in alerts)
+    return f"{header}\n\n{body}\n⏰ {datetime.now().strftime('%H:%M:%S')}"
+
+
+class TelegramTransport:
+    """Отправка через telegram.Bot с переводом ошибок Telegram в RetryLater/PermanentDeliveryError"""
+
+    def __init__(self, bot, parse_mode: Optional[str] = 'Markdown'):
+        self.bot = bot
+        self.parse_mode = parse_mode
+
+    async def send(self, chat_id: int, text: str):
+        from telegram.error import BadRequest, Forbidden, RetryAfter
+
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=self.parse_mode)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            raise RetryLater(float(retry_after)) from e
+        except Forbidden as e:
+            raise PermanentDeliveryError(str(e)) from e
+        except BadRequest as e:
+            if 'chat not found' in str(e).lower():
+                raise PermanentDeliveryError(str(e)) from e
+            raise
+
+
+class StubTransport:
+    """
+    Локальный транспорт для офлайн-проверок: записывает (время, chat_id, текст).
+    chat_interval имитирует flood-лимит Telegram (RetryLater при отправке в чат чаще),
+    latency — задержку ответа, fail_rate — долю случайных ошибок.
+    """
+
+    def __init__(self, latency: float = 0.0, chat_interval: Optional[float] = None, fail_rate: float = 0.0):
+        self.latency = latency
+        self.chat_interval = chat_interval
+        self.fail_rate = fail_rate
+        self.sent: List[Tuple[float, int, str]] = []
+        self.flood_errors = 0
+        self.failures = 0
+        self._last_sent: Dict[int, float] = {}
+
+    async def send(self, chat_id: int, text: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        if self.chat_interval is not None and now - self._last_sent.get(chat_id, -1e9) < self.chat_interval:
+            self.flood_errors += 1
+            raise RetryLater(self.chat_interval)
+        if self.fail_rate and random.random() < self.fail_rate:
+            self.failures += 1
+            raise ConnectionError("stub failure")
+        self._last_sent[chat_id] = now
+        self.sent.append((now, chat_id, text))
+
+
+class OutboxStore:
+    """Постоянная очередь алертов: строка = (канал, чат, алерт), SQLite в режиме WAL"""
+
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel TEXT NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            self._conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_outbox_channel_due
+                ON outbox (channel, next_attempt_at, chat_id)
+            ''')
+
+    def put(self, channel: str, chat_ids: Iterable[int], alerts: List[Dict[str, Any]]) -> int:
+        now = time.time()
+        rows = [(channel, int(chat_id), json.dumps(alert, ensure_ascii=False, default=str), now, now)
+                for chat_id in chat_ids for alert in alerts]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO outbox (channel, chat_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)',
+                rows)
+        return len(rows)
+
+    def due_chats(self, channel: str, exclude: Set[int], limit: int) -> List[int]:
+        """Чаты с записями, время отправки которых наступило (в порядке самой старой записи)"""
+        with self._lock:
+            rows = self._conn.execute('''
+                SELECT chat_id FROM outbox WHERE channel = ? AND next_attempt_at <= ?
+                GROUP BY chat_id ORDER BY MIN(id) LIMIT ?
+            ''', (channel, time.time(), limit + len(exclude))).fetchall()
+        return [chat_id for (chat_id,) in rows if chat_id not in exclude][:limit]
+
+    def take_batch(self, channel: str, chat_id: int, limit: int) -> List[Tuple[int, int, Dict[str, Any]]]:
+        with self._lock:
+            rows = self._conn.execute('''
+                SELECT id, attempts, payload FROM outbox
+                WHERE channel = ? AND chat_id = ? AND next_attempt_at <= ?
+                ORDER BY id LIMIT ?
+            ''', (channel, chat_id, time.time(), limit)).fetchall()
+        return [(row_id, attempts, json.loads(payload)) for row_id, attempts, payload in rows]
+
+    def delete(self, ids: List[int]):
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM outbox WHERE id = ?', [(row_id,) for row_id in ids])
+
+    def reschedule(self, ids: List[int], delay: float, count_attempt: bool = True):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'UPDATE outbox SET attempts = attempts + ?, next_attempt_at = ? WHERE id = ?',
+                [(1 if count_attempt else 0, time.time() + delay, row_id) for row_id in ids])
+
+    def delete_chat(self, channel: str, chat_id: int) -> int:
+        with self._lock, self._conn:
+            return self._conn.execute('DELETE FROM outbox WHERE channel = ? AND chat_id = ?',
+                                      (channel, chat_id)).rowcount
+
+    def pending(self, channel: str) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM outbox WHERE channel = ?', (channel,)).fetchone()[0]
+
+
+class AlertDelivery:
+    """
+    Подсистема доставки: очередь + воркеры с лимитами скорости, повторами и дайджестами.
+
+    channel разделяет очереди разных отправителей (бот, AlertNotifier) в одном файле.
+    Воркеры запускаются в текущем event loop при первом enqueue (или явно через start).
+    """
+
+    def __init__(self, transport, channel: str = 'default', store: Optional[OutboxStore] = None,
+                 global_rate: float = GLOBAL_RATE, global_burst: float = GLOBAL_BURST,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST,
+                 concurrency: int = WORKER_CONCURRENCY, max_batch: int = MAX_BATCH,
+                 formatter: Callable[[List[Dict[str, Any]]], str] = format_digest):
+        self.transport = transport
+        self.channel = channel
+        self.store = store or OutboxStore()
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_batch = max_batch
+        self.formatter = formatter
+        self.stats = {'enqueued': 0, 'messages': 0, 'alerts_delivered': 0, 'retries': 0, 'dropped': 0}
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._in_flight: Set[int] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def enqueue(self, chat_ids: Iterable[int], alerts: List[Dict[str, Any]]) -> int:
+        """Ставит алерты в очередь для каждого чата, возвращает число записей"""
+        chat_ids = list(chat_ids)
+        if not chat_ids or not alerts:
+            return 0
+        count = await asyncio.to_thread(self.store.put, self.channel, chat_ids, alerts)
+        self.stats['enqueued'] += count
+        self.start()
+        self._wakeup.set()
+        return count
+
+    def start(self):
+        """Запускает диспетчер в текущем event loop (повторный вызов ничего не делает)"""
+        if self._dispatcher is not None and not self._dispatcher.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def stop(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    async def drain(self, timeout: Optional[float] = None):
+        """Ждет, пока очередь канала опустеет (для тестов и корректной остановки)"""
+        self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.store.pending(self.channel) or self._in_flight:
+            if deadline is not None and time.monotonic() > deadline:
+                raise asyncio.TimeoutError
+            await asyncio.sleep(0.05)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        elif len(self._chat_buckets) > 10000:
+            # Полные корзины ничего не ограничивают: их можно забыть
+            for key in [key for key, value in self._chat_buckets.items() if value.delay() == 0 and key != chat_id]:
+                del self._chat_buckets[key]
+        return bucket
+
+    async def _dispatch(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            try:
+                free = self.concurrency - len(self._in_flight)
+                chats = await asyncio.to_thread(self.store.due_chats, self.channel, set(self._in_flight), free) if free else []
+                for chat_id in chats:
+                    self._in_flight.add(chat_id)
+                    await semaphore.acquire()
+                    task = asyncio.create_task(self._deliver(chat_id))
+                    task.add_done_callback(lambda _, chat_id=chat_id: (self._in_flight.discard(chat_id), semaphore.release(),
+                                                                       self._wakeup.set()))
+                if not chats:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка диспетчера доставки алертов: {e}")
+                await asyncio.sleep(POLL_INTERVAL)
+
+    def _build_batch(self, batch: List[Tuple[int, int, Dict[str, Any]]]) -> Tuple[List[Tuple[int, int, Dict[str, Any]]], str]:
+        """Берет из batch столько алертов, сколько помещается в одно сообщение"""
+        for size in range(len(batch), 1, -1):
+            text = self.formatter([alert for _, _, alert in batch[:size]])
+            if len(text) <= MAX_MESSAGE_LENGTH:
+                return batch[:size], text
+        return batch[:1], self._format_single(batch[0][2])
+
+    def _format_single(self, alert: Dict[str, Any]) -> str:
+        """
+        Сообщение для одного алерта не длиннее MAX_MESSAGE_LENGTH. Длинные поля обрезаются
+        до форматирования (самое длинное допустимое обрезание ищется двоичным поиском), поэтому
+        разметка остается парной и Telegram не отклоняет сообщение.
+        """
+        text = self.formatter([alert])
+        if len(text) <= MAX_MESSAGE_LENGTH:
+            return text
+        low, high = 0, max((len(value) for value in alert.values() if isinstance(value, str)), default=0)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if len(self.formatter([shorten_alert(alert, middle)])) <= MAX_MESSAGE_LENGTH:
+                low = middle
+            else:
+                high = middle - 1
+        return self.formatter([shorten_alert(alert, low)])
+
+    async def _deliver(self, chat_id: int):
+        batch = await asyncio.to_thread(self.store.take_batch, self.channel, chat_id, self.max_batch)
+        if not batch:
+            return
+        batch, text = self._build_batch(batch)
+        ids = [row_id for row_id, _, _ in batch]
+
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+        try:
+            await self.transport.send(chat_id, text)
+        except RetryLater as e:
+            # Лимит Telegram: ждем указанное время, попытка не считается
+            self.stats['retries'] += 1
+            await asyncio.to_thread(self.store.reschedule, ids, e.retry_after, False)
+            return
+        except PermanentDeliveryError as e:
+            logger.warning(f"Чат {chat_id} недоступен, алерты отброшены: {e}")
+            self.stats['dropped'] += await asyncio.to_thread(self.store.delete_chat, self.channel, chat_id)
+            return
+        except Exception as e:
+            attempts = max(attempts for _, attempts, _ in batch) + 1
+            if attempts >= MAX_ATTEMPTS:
+                logger.error(f"Алерты для чата {chat_id} отброшены после {attempts} попыток: {e}")
+                self.stats['dropped'] += len(ids)
+                await asyncio.to_thread(self.store.delete, ids)
+            else:
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+                logger.warning(f"Ошибка отправки в чат {chat_id} (попытка {attempts}), повтор через {delay:.1f} с: {e}")
+                self.stats['retries'] += 1
+                await asyncio.to_thread(self.store.reschedule, ids, delay)
+            return
+
+        await asyncio.to_thread(self.store.delete, ids)
+        self.stats['messages'] += 1
+        self.stats['alerts_delivered'] += len(ids)
+
+
+async def main():
+    """Офлайн-проверка пропускной способности и лимитов на StubTransport"""
+    transport = StubTransport(latency=0.01, chat_interval=1.0 / CHAT_RATE * 0.5)
+    delivery = AlertDelivery(transport, channel='benchmark', store=OutboxStore(':memory:'))
+    chats = range(1, 201)
+    alerts = [{'level': 'Высокий', 'type': 'МКД', 'object_id': i, 'alert_message': f'Тест {i}'} for i in range(5)]
+
+    started = time.monotonic()
+    await delivery.enqueue(chats, alerts)
+    await delivery.drain(timeout=120)
+    elapsed = time.monotonic() - started
+    await delivery.stop()
+
+    times = [sent_at for sent_at, _, _ in transport.sent]
+    peak = _peak_per_second(times)
+    chat_times: Dict[int, List[float]] = {}
+    for sent_at, chat_id, _ in transport.sent:
+        chat_times.setdefault(chat_id, []).append(sent_at)
+    chat_peak = max((_peak_per_second(chat) for chat in chat_times.values()), default=0)
+    print(f"Алертов: {len(chats) * len(alerts)}, сообщений: {len(transport.sent)}, за {elapsed:.1f} с")
+    print(f"Пик сообщений в секунду: {peak} (лимит {TELEGRAM_GLOBAL_LIMIT}/с), в один чат: {chat_peak} "
+          f"(лимит {TELEGRAM_CHAT_LIMIT}/с), flood-ошибок: {transport.flood_errors}, статистика: {delivery.stats}")
+
+    if peak > TELEGRAM_GLOBAL_LIMIT or chat_peak > TELEGRAM_CHAT_LIMIT:
+        print("❌ Превышен лимит Telegram Bot API")
+        return 1
+    return 0
+
+
+def _peak_per_second(times: List[float]) -> int:
+    """Наибольшее число отправок в любом окне длиной 1 с"""
+    return max(sum(1 for t in times if start <= t < start + 1) for start in times) if times else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
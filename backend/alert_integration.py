@@ -10,7 +10,9 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Set, Optional, Any
 import requests
 from telegram import Bot
-from alert_controller import generate_alerts
+from alert_controller import get_alerts, refresh_alert_state
+from alert_delivery import AlertDelivery, TelegramTransport
+from alert_state import get_alert_state_store
 from consumption_loader import load_data
 
 logger = logging.getLogger(__name__)
@@ -23,15 +25,20 @@ class AlertNotifier:
         self.api_base_url = api_base_url
         self.bot = Bot(token=bot_token)
         self.subscribed_users: Set[int] = set()
-        self.last_alerts: List[Dict[str, Any]] = []
         self.ctp_to_unom_map = None
         self.consumption_df = None
+        self.excedents_df = None
+        # Рассылка через очередь с лимитами скорости и дайджестами (см. alert_delivery)
+        self.delivery = AlertDelivery(TelegramTransport(self.bot), channel='notifier')
+        # Переходы алертов читаются из постоянной ленты (alert_state) с сохраненного курсора
+        self.state_store = get_alert_state_store()
+        self.feed_consumer = 'notifier'
         
     async def initialize_data(self):
         """Инициализация данных"""
         try:
             logger.info("Загрузка данных для AlertNotifier...")
-            self.ctp_to_unom_map, self.consumption_df = load_data()
+            self.ctp_to_unom_map, self.consumption_df, self.excedents_df = load_data()
             if self.ctp_to_unom_map and self.consumption_df is not None:
                 logger.info(f"Данные успешно загружены: {len(self.consumption_df)} записей")
             else:
@@ -47,6 +54,7 @@ class AlertNotifier:
     def remove_subscriber(self, user_id: int):
         """Удалить подписчика"""
         self.subscribed_users.discard(user_id)
+        self.delivery.store.delete_chat(self.delivery.channel, user_id)
         logger.info(f"Пользователь {user_id} отписался от алертов")
 
     def get_subscribers_count(self) -> int:
@@ -81,58 +89,49 @@ class AlertNotifier:
             logger.error(f"Ошибка отправки алерта пользователю {user_id}: {e}")
 
     async def send_alert_to_all_subscribers(self, alert: Dict[str, Any]):
-        """Отправить алерт всем подписчикам"""
-        if not self.subscribed_users:
-            return
-            
-        tasks = [self.send_alert_to_user(user_id, alert) for user_id in self.subscribed_users]
-        await asyncio.gather(*tasks, return_exceptions=True)
+        """Поставить алерт в очередь рассылки всем подписчикам"""
+        await self.send_alerts_to_all_subscribers([alert])
 
-    def _alerts_are_different(self, new_alerts: List[Dict], old_alerts: List[Dict]) -> List[Dict]:
-        """Определить новые алерты, сравнивая с предыдущими"""
-        if not old_alerts:
-            return new_alerts
-            
-        # Создаем ключи для сравнения алертов
-        old_keys = set()
-        for alert in old_alerts:
-            key = f"{alert.get('type', '')}_{alert.get('object_id', '')}_{alert.get('alert_message', '')}"
-            old_keys.add(key)
+    async def send_alerts_to_all_subscribers(self, alerts: List[Dict[str, Any]]):
+        """Поставить алерты в очередь рассылки: каждый подписчик получит их дайджестом"""
+        if not self.subscribed_users or not alerts:
+            return
             
-        new_alerts_only = []
-        for alert in new_alerts:
-            key = f"{alert.get('type', '')}_{alert.get('object_id', '')}_{alert.get('alert_message', '')}"
-            if key not in old_keys:
-                new_alerts_only.append(alert)
-                
-        return new_alerts_only
+        await self.delivery.enqueue(self.subscribed_users, alerts)
+
+    async def consume_alert_changes(self) -> int:
+        """
+        Разослать переходы алертов из ленты после сохраненного курсора.
+        Курсор сдвигается только после постановки в очередь рассылки, поэтому
+        после перезапуска ничего не теряется; возвращает число переходов.
+        """
+        cursor = await asyncio.to_thread(self.state_store.get_cursor, self.feed_consumer)
+        total = 0
+        while True:
+            page = await asyncio.to_thread(self.state_store.changes, cursor)
+            alerts = [event['alert'] for event in page['events']]
+            if alerts:
+                await self.send_alerts_to_all_subscribers(alerts)
+                total += len(alerts)
+            if page['cursor'] != cursor:
+                cursor = page['cursor']
+                await asyncio.to_thread(self.state_store.set_cursor, self.feed_consumer, cursor)
+            if not page['has_more']:
+                return total
 
     async def check_and_notify_new_alerts(self):
-        """Проверить новые алерты и уведомить подписчиков"""
+        """Проверить алерты и уведомить подписчиков об изменениях"""
         try:
             if not self.ctp_to_unom_map or self.consumption_df is None:
                 logger.warning("Данные не загружены, пропускаем проверку алертов")
                 return
                 
-            config = {'event_duration_threshold': 4}
-            current_alerts = await generate_alerts(
-                self.ctp_to_unom_map, 
-                self.consumption_df, 
-                config=config
-            )
-            
-            # Определяем новые алерты
-            new_alerts = self._alerts_are_different(current_alerts, self.last_alerts)
+            # Каноническая живая оценка текущего часа записывает переходы в ленту
+            await refresh_alert_state(self.ctp_to_unom_map, self.consumption_df, self.excedents_df)
             
-            if new_alerts:
-                logger.info(f"Обнаружено {len(new_alerts)} новых алертов")
-                
-                # Отправляем новые алерты всем подписчикам
-                for alert in new_alerts:
-                    await self.send_alert_to_all_subscribers(alert)
-                    
-            # Обновляем список последних алертов
-            self.last_alerts = current_alerts
+            changes = await self.consume_alert_changes()
+            if changes:
+                logger.info(f"Обнаружено {changes} изменений алертов")
             
         except Exception as e:
             logger.error(f"Ошибка при проверке алертов: {e}")
@@ -144,10 +143,11 @@ class AlertNotifier:
                 return {"error": "Данные не загружены"}
                 
             config = {'event_duration_threshold': 4}
-            alerts = await generate_alerts(
+            alerts = await get_alerts(
                 self.ctp_to_unom_map, 
                 self.consumption_df, 
-                config=config
+                config=config,
+                excedents_df=self.excedents_df
             )
             
             # Группируем алерты по уровням
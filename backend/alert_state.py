@@ -0,0 +1,263 @@
+"""
+Постоянное состояние алертов и лента изменений.
+
+Каждый алерт идентифицируется ключом (alert_id, тип объекта, object_id). При каждой «живой»
+оценке (текущий час) AlertStateStore.record сравнивает набор алертов с открытыми в базе
+и записывает переходы: opened (новый ключ), updated (изменились уровень, текст или
+рекомендация), resolved (ключ пропал из оценки). Переходы складываются в журнал
+alert_events с возрастающим seq; потребители (рассылка бота, AlertNotifier) читают журнал
+с сохраненного курсора и рассылают только изменения, поэтому объем сообщений
+пропорционален числу переходов, а не числу активных алертов. Состояние и курсоры хранятся
+в SQLite (WAL) и переживают перезапуск; повторная запись того же набора переходов не дает.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STATE_PATH = os.environ.get('ALERT_STATE_DB', os.path.join(base_dir, 'data', 'alert_state.db'))
+
+OPENED = 'opened'
+UPDATED = 'updated'
+RESOLVED = 'resolved'
+
+# Событий в одном ответе ленты
+FEED_PAGE_SIZE = 500
+# Сколько хранить события журнала (сек); курсор старше этого получает снимок открытых алертов
+EVENT_RETENTION = 7 * 24 * 3600
+# Поля алерта, изменение которых считается обновлением
+TRACKED_FIELDS = ('level', 'alert_message', 'comment')
+
+
+def alert_key(alert: Dict[str, Any]) -> Tuple[int, str, str]:
+    """Ключ жизненного цикла алерта: (alert_id, тип объекта, object_id)"""
+    return int(alert['alert_id']), str(alert.get('type', '')), str(alert.get('object_id', ''))
+
+
+def _fingerprint(alert: Dict[str, Any]) -> str:
+    tracked = [alert.get(field) for field in TRACKED_FIELDS]
+    return hashlib.sha1(json.dumps(tracked, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def _dumps(alert: Dict[str, Any]) -> str:
+    return json.dumps(alert, ensure_ascii=False, default=str)
+
+
+class CursorStore:
+    """Сохраненные позиции потребителей ленты (consumer -> последний обработанный seq)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS feed_cursors (
+                    consumer TEXT PRIMARY KEY,
+                    seq INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+
+    def _connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (после fork открывается заново)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_cursor(self, consumer: str) -> Optional[int]:
+        row = self._connection().execute('SELECT seq FROM feed_cursors WHERE consumer = ?', (consumer,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, consumer: str, seq: int):
+        with self._connection() as conn:
+            conn.execute('''
+                INSERT INTO feed_cursors (consumer, seq, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(consumer) DO UPDATE SET seq = excluded.seq, updated_at = excluded.updated_at
+            ''', (consumer, int(seq), time.time()))
+
+
+class AlertStateStore(CursorStore):
+    """Состояние алертов (alert_state), журнал переходов (alert_events) и курсоры потребителей"""
+
+    def __init__(self, path: str = DEFAULT_STATE_PATH, retention: float = EVENT_RETENTION):
+        super().__init__(path)
+        self.retention = retention
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS alert_state (
+                    alert_id INTEGER NOT NULL,
+                    object_type TEXT NOT NULL,
+                    object_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    opened_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    resolved_at TEXT,
+                    PRIMARY KEY (alert_id, object_type, object_id)
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_alert_state_status ON alert_state (status)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS alert_events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    alert_id INTEGER NOT NULL,
+                    object_type TEXT NOT NULL,
+                    object_id TEXT NOT NULL,
+                    transition TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    hour TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS alert_state_meta (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            ''')
+
+    def record(self, alerts: Iterable[Dict[str, Any]], hour: datetime) -> List[Dict[str, Any]]:
+        """
+        Записывает результат оценки за час hour и возвращает переходы (события ленты).
+        Оценки за час раньше последнего записанного игнорируются, чтобы запоздавший
+        воркер не откатил состояние.
+        """
+        hour_str = hour.isoformat()
+        current = {}
+        for alert in alerts:
+            current[alert_key(alert)] = alert
+
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT value FROM alert_state_meta WHERE name = 'last_hour'").fetchone()
+            if row is not None and row[0] > hour_str:
+                return []
+
+            open_rows = conn.execute('''
+                SELECT alert_id, object_type, object_id, fingerprint, payload
+                FROM alert_state WHERE status = 'open'
+            ''').fetchall()
+            opened = {(alert_id, object_type, object_id): (fingerprint, payload)
+                      for alert_id, object_type, object_id, fingerprint, payload in open_rows}
+
+            transitions = []
+            for key, alert in current.items():
+                fingerprint = _fingerprint(alert)
+                if key not in opened:
+                    transitions.append((key, OPENED, alert, fingerprint))
+                elif opened[key][0] != fingerprint:
+                    transitions.append((key, UPDATED, alert, fingerprint))
+            for key, (fingerprint, payload) in opened.items():
+                if key not in current:
+                    transitions.append((key, RESOLVED, json.loads(payload), fingerprint))
+
+            now = time.time()
+            events = []
+            for key, transition, alert, fingerprint in transitions:
+                payload = _dumps(alert)
+                if transition == OPENED:
+                    conn.execute('''
+                        INSERT INTO alert_state (alert_id, object_type, object_id, status, fingerprint, payload,
+                                                 opened_at, updated_at, resolved_at)
+                        VALUES (?, ?, ?, 'open', ?, ?, ?, ?, NULL)
+                        ON CONFLICT(alert_id, object_type, object_id) DO UPDATE SET
+                            status = 'open', fingerprint = excluded.fingerprint, payload = excluded.payload,
+                            opened_at = excluded.opened_at, updated_at = excluded.updated_at, resolved_at = NULL
+                    ''', (*key, fingerprint, payload, hour_str, hour_str))
+                elif transition == UPDATED:
+                    conn.execute('''
+                        UPDATE alert_state SET fingerprint = ?, payload = ?, updated_at = ?
+                        WHERE alert_id = ? AND object_type = ? AND object_id = ?
+                    ''', (fingerprint, payload, hour_str, *key))
+                else:
+                    conn.execute('''
+                        UPDATE alert_state SET status = 'resolved', updated_at = ?, resolved_at = ?
+                        WHERE alert_id = ? AND object_type = ? AND object_id = ?
+                    ''', (hour_str, hour_str, *key))
+                cursor = conn.execute('''
+                    INSERT INTO alert_events (alert_id, object_type, object_id, transition, payload, hour, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (*key, transition, payload, hour_str, now))
+                events.append(self._event(cursor.lastrowid, transition, hour_str, alert))
+
+            conn.execute('''
+                INSERT INTO alert_state_meta (name, value) VALUES ('last_hour', ?)
+                ON CONFLICT(name) DO UPDATE SET value = excluded.value
+            ''', (hour_str,))
+            if self.retention:
+                conn.execute('DELETE FROM alert_events WHERE created_at < ?', (now - self.retention,))
+        return events
+
+    @staticmethod
+    def _event(seq: int, transition: str, hour: str, alert: Dict[str, Any]) -> Dict[str, Any]:
+        return {'seq': seq, 'transition': transition, 'hour': hour, 'alert': {**alert, 'status': transition}}
+
+    def head(self) -> int:
+        """seq последнего события (0, если журнал пуст)"""
+        row = self._connection().execute("SELECT seq FROM sqlite_sequence WHERE name = 'alert_events'").fetchone()
+        return row[0] if row else 0
+
+    def open_alerts(self) -> List[Dict[str, Any]]:
+        rows = self._connection().execute(
+            "SELECT payload FROM alert_state WHERE status = 'open' ORDER BY opened_at, alert_id").fetchall()
+        return [json.loads(payload) for (payload,) in rows]
+
+    def changes(self, after: Optional[int] = None, limit: int = FEED_PAGE_SIZE) -> Dict[str, Any]:
+        """
+        События с seq > after: {'events', 'cursor', 'reset', 'has_more'}.
+        Без курсора или если события после него уже удалены по сроку хранения,
+        возвращается снимок: открытые алерты как события opened и reset=True.
+        """
+        conn = self._connection()
+        head = self.head()
+        oldest = conn.execute('SELECT MIN(seq) FROM alert_events').fetchone()[0]
+        if after is None or after > head or (after < head and (oldest is None or oldest > after + 1)):
+            events = [{'seq': head, 'transition': OPENED, 'hour': None, 'alert': {**alert, 'status': OPENED}}
+                      for alert in self.open_alerts()]
+            return {'events': events, 'cursor': head, 'reset': True, 'has_more': False}
+
+        rows = conn.execute('''
+            SELECT seq, transition, hour, payload FROM alert_events
+            WHERE seq > ? ORDER BY seq LIMIT ?
+        ''', (after, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        events = [self._event(seq, transition, hour, json.loads(payload))
+                  for seq, transition, hour, payload in rows[:limit]]
+        return {'events': events, 'cursor': events[-1]['seq'] if events else after,
+                'reset': False, 'has_more': has_more}
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._connection()
+        counts = dict(conn.execute('SELECT status, COUNT(*) FROM alert_state GROUP BY status').fetchall())
+        row = conn.execute("SELECT value FROM alert_state_meta WHERE name = 'last_hour'").fetchone()
+        return {'open': counts.get('open', 0), 'resolved': counts.get('resolved', 0),
+                'head': self.head(), 'last_hour': row[0] if row else None}
+
+
+_store: Optional[AlertStateStore] = None
+_store_lock = threading.Lock()
+
+
+def get_alert_state_store() -> AlertStateStore:
+    """Общий для процесса AlertStateStore (создается при первом обращении)"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = AlertStateStore()
+    return _store
@@ -1,21 +1,30 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
-from alert_controller import generate_alerts
-from consumption_loader import load_data, load_ctp_points, get_consumption_for_period_unom, get_consumption_for_period_ctp, simulate_real_consumption, build_ctp_pressure_payload
-from user_auth import auth_manager
+from alert_controller import get_alerts as get_cached_alerts, refresh_alert_state, HOUSE_ADDRESSES
+from consumption_loader import load_data, load_ctp_points, build_unom_to_ctp, get_consumption_for_period_unom_sync, get_consumption_for_period_ctp_sync, simulate_real_consumption, build_ctp_pressure_payload, calculate_house_statistics
+from small_leakage_model import is_model_loaded, set_data_source
+from payload_cache import get_payload
+from geo_tiles import LAYERS as GEO_LAYERS, get_pyramid
+from spatial_index import build_house_index, build_house_features
+from geocoding import create_geocoder
+from alert_state import get_alert_state_store, FEED_PAGE_SIZE
+from leaderboard import get_leaderboard, METRICS as LEADERBOARD_METRICS, DEFAULT_TOP_K, MAX_TOP_K
+from exporter import available_formats, export_filename, iter_export, resolve_targets, FORMATS as EXPORT_FORMATS
+from user_auth import auth_manager, TooManyAttemptsError
+from async_runtime import async_to_sync, run_blocking
+import ipaddress
 import json
 import os
 from typing import List, Tuple, Optional, Dict, Any
 from datetime import datetime, timedelta
 import pandas as pd
-import asyncio
 import math
-import requests
-import time
 from functools import wraps
 
 
 app = Flask(__name__)
+# async-обработчики выполняются в долгоживущем event loop процесса (см. async_runtime), а не в новом loop на каждый запрос
+app.async_to_sync = async_to_sync
 
 # Настройка CORS для работы через nginx с HTTPS
 # Получаем список разрешенных источников из переменной окружения или используем по умолчанию
@@ -50,6 +59,8 @@ CORS(app,
 # --- Load data once on startup ---
 print("--- Загрузка данных о потреблении и карты ЦТП ---")
 ctp_to_unom_map, consumption_df, excedents_df = load_data()
+# ML-модель малых утечек работает с теми же данными и загружается при первом использовании
+set_data_source(consumption_df, excedents_df)
 
 if consumption_df is None or ctp_to_unom_map is None:
     print("Не удалось загрузить данные. API может возвращать пустые результаты.")
@@ -72,6 +83,17 @@ except Exception as e:
     print(f"Ошибка загрузки GeoJSON: {e}")
     geojson_data = None
 
+# Пространственный индекс домов (концы труб) для поиска по координатам
+house_index = build_house_index(geojson_data)
+print(f"Построен пространственный индекс: {len(house_index)} домов")
+
+# Обратные индексы: UNOM -> ЦТП и UNOM -> координаты/свойства дома
+unom_to_ctp = build_unom_to_ctp(ctp_to_unom_map or {})
+house_features = build_house_features(geojson_data)
+
+# Геокодер: адреса МКД по ближайшему дому, затем кэш на диске, затем внешний провайдер
+geocoder = create_geocoder(house_index, HOUSE_ADDRESSES)
+
 print("--- Загрузка мета-данных о ЦТП ---")
 ctp_points_df = load_ctp_points()
 
@@ -113,7 +135,7 @@ def require_permission(permission):
 
 
 @app.route('/alerts', methods=['GET'])
-def get_alerts():
+async def get_alerts():
     """
     This endpoint generates and returns alerts based on the loaded data.
     Each alert now includes a timestamp.
@@ -142,18 +164,38 @@ def get_alerts():
 
     config = {'event_duration_threshold': duration_threshold}
     
-    # generate_alerts returns a list of dictionaries
-    alerts_data = asyncio.run(generate_alerts(ctp_to_unom_map, consumption_df, config=config, alert_time=alert_time, excedents_df=excedents_df))
+    # get_cached_alerts returns a list of dictionaries, cached per hour of alert_time
+    alerts_data = await get_cached_alerts(ctp_to_unom_map, consumption_df, config=config, alert_time=alert_time, excedents_df=excedents_df)
     
     return jsonify(alerts_data)
 
+@app.route('/alerts/changes', methods=['GET'])
+async def alert_changes():
+    """
+    Лента изменений алертов (opened/updated/resolved) после курсора.
+    Перед чтением выполняется каноническая живая оценка текущего часа (refresh_alert_state, кэшируется),
+    которая записывает переходы.
+
+    Query Parameters:
+        - after (int, optional): последний обработанный seq. Без него возвращается снимок открытых алертов.
+        - limit (int, optional): максимум событий в ответе.
+    """
+    if consumption_df.empty:
+        return jsonify({"error": "Данные о потреблении не загружены, невозможно сгенерировать алерты."}), 500
+
+    after = request.args.get('after', type=int)
+    limit = max(1, min(request.args.get('limit', FEED_PAGE_SIZE, type=int), FEED_PAGE_SIZE))
+
+    await refresh_alert_state(ctp_to_unom_map, consumption_df, excedents_df)
+    return jsonify(await run_blocking(get_alert_state_store().changes, after, limit))
+
 @app.route('/ml_predict', methods=['POST'])
 def ml_predict():
     # TODO: Implement machine learning prediction logic
     pass
 
 @app.route('/ctp_data', methods=['GET'])
-def ctp_data():
+async def ctp_data():
     ctp_id = request.args.get('ctp_id')
     timestamp_str = request.args.get('timestamp')
 
@@ -168,7 +210,7 @@ def ctp_data():
 
     start_ts = end_ts - timedelta(hours=24)
 
-    result_df = asyncio.run(get_consumption_for_period_ctp(ctp_id, start_ts, end_ts, consumption_df, ctp_to_unom_map, excedents_df=excedents_df))
+    result_df = await run_blocking(get_consumption_for_period_ctp_sync, ctp_id, start_ts, end_ts, consumption_df, ctp_to_unom_map, excedents_df=excedents_df)
 
     if result_df.empty:
         return jsonify({"error": "No data found for the given CTP and period"}), 404
@@ -183,7 +225,7 @@ def ctp_data():
 
 
 @app.route('/ctp_data_pressure', methods=['GET'])
-def ctp_data_pressure():
+async def ctp_data_pressure():
     ctp_id = request.args.get('ctp_id')
     timestamp_str = request.args.get('timestamp')
 
@@ -198,16 +240,16 @@ def ctp_data_pressure():
 
     start_ts = end_ts - timedelta(hours=24)
 
-    result_df = asyncio.run(get_consumption_for_period_ctp(ctp_id, start_ts, end_ts, consumption_df, ctp_to_unom_map, excedents_df=excedents_df))
+    result_df = await run_blocking(get_consumption_for_period_ctp_sync, ctp_id, start_ts, end_ts, consumption_df, ctp_to_unom_map, excedents_df=excedents_df)
 
     if result_df.empty:
         return jsonify({"error": "No data found for the given CTP and period"}), 404
 
-    response_data = asyncio.run(build_ctp_pressure_payload(ctp_id, end_ts, result_df, ctp_points_df))
+    response_data = await build_ctp_pressure_payload(ctp_id, end_ts, result_df, ctp_points_df)
     return jsonify(response_data)
 
 @app.route('/mcd_data', methods=['GET'])
-def mcd_data():
+async def mcd_data():
     unom = request.args.get('unom', type=int)
     timestamp_str = request.args.get('timestamp')
 
@@ -222,7 +264,7 @@ def mcd_data():
 
     start_ts = end_ts - timedelta(hours=24)
     
-    result_df = asyncio.run(get_consumption_for_period_unom(unom, start_ts, end_ts, consumption_df, excedents_df=excedents_df))
+    result_df = await run_blocking(get_consumption_for_period_unom_sync, unom, start_ts, end_ts, consumption_df, excedents_df=excedents_df)
 
     if result_df.empty:
         return jsonify({"error": "No data found for the given UNOM and period"}), 404
@@ -236,7 +278,7 @@ def mcd_data():
     return jsonify(response_data)
 
 @app.route('/house_by_coordinates', methods=['GET'])
-def house_by_coordinates():
+async def house_by_coordinates():
     """
     API endpoint для поиска дома по координатам и получения данных для графиков и статистики.
     
@@ -267,7 +309,7 @@ def house_by_coordinates():
     
     # Получение данных потребления за последние 24 часа
     start_ts = end_ts - timedelta(hours=24)
-    consumption_data = asyncio.run(get_consumption_for_period_unom(closest_unom, start_ts, end_ts, consumption_df, excedents_df=excedents_df))
+    consumption_data = await run_blocking(get_consumption_for_period_unom_sync, closest_unom, start_ts, end_ts, consumption_df, excedents_df=excedents_df)
     
     if consumption_data.empty:
         return jsonify({"error": "No consumption data found for the house"}), 404
@@ -295,6 +337,76 @@ def house_by_coordinates():
     
     return jsonify(response_data)
 
+@app.route('/top_consumers', methods=['GET'])
+async def top_consumers():
+    """
+    Топ потребителей за час по всей сети или по ЦТП (рейтинг пересчитывается раз в час).
+
+    Query Parameters:
+        - metric (str, optional): real (по умолчанию), deviation или ratio
+        - k (int, optional): размер топа, по умолчанию 10
+        - ctp_id (str, optional): рейтинг внутри ЦТП
+        - timestamp (str, optional): час рейтинга в ISO формате, по умолчанию - последний час данных
+    """
+    metric = request.args.get('metric', 'real')
+    if metric not in LEADERBOARD_METRICS:
+        return jsonify({"error": f"Unsupported metric '{metric}', expected one of: {', '.join(LEADERBOARD_METRICS)}"}), 400
+    k = max(1, min(request.args.get('k', DEFAULT_TOP_K, type=int), MAX_TOP_K))
+    ctp_id = request.args.get('ctp_id')
+    if ctp_id and ctp_id not in (ctp_to_unom_map or {}):
+        return jsonify({"error": f"Unknown CTP '{ctp_id}'"}), 404
+
+    at = None
+    timestamp_str = request.args.get('timestamp')
+    if timestamp_str:
+        try:
+            at = pd.to_datetime(timestamp_str)
+        except Exception:
+            return jsonify({"error": "Invalid timestamp format. Use ISO format like YYYY-MM-DDTHH:MM:SS"}), 400
+
+    board = await run_blocking(get_leaderboard, consumption_df, ctp_to_unom_map or {}, excedents_df, at)
+    if board is None:
+        return jsonify({"error": "No consumption data loaded"}), 500
+    return jsonify(board.payload(metric, k, ctp_id or None))
+
+@app.route('/export', methods=['GET'])
+def export_data():
+    """
+    Потоковый экспорт рядов расхода домов и ЦТП (chunked transfer).
+
+    Query Parameters:
+        - unom (str, optional): UNOM через запятую
+        - ctp_id (str, optional): ID ЦТП через запятую
+        - start, end (str): границы периода в ISO формате (включительно)
+        - format (str, optional): csv (по умолчанию), jsonl или parquet
+        - expand (str, optional): 'houses' - выгрузить дома ЦТП вместо суммарного ряда ЦТП
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in available_formats():
+        return jsonify({"error": f"Unsupported format '{fmt}', expected one of: {', '.join(available_formats())}"}), 400
+
+    try:
+        unoms = [int(value) for value in request.args.get('unom', '').split(',') if value.strip()]
+    except ValueError:
+        return jsonify({"error": "Invalid 'unom' parameter, expected comma-separated integers"}), 400
+    ctp_ids = [value.strip() for value in request.args.get('ctp_id', '').split(',') if value.strip()]
+    if not unoms and not ctp_ids:
+        return jsonify({"error": "Missing 'unom' or 'ctp_id' parameter"}), 400
+
+    try:
+        start_ts = pd.to_datetime(request.args['start'])
+        end_ts = pd.to_datetime(request.args['end'])
+    except (KeyError, ValueError):
+        return jsonify({"error": "Missing or invalid 'start'/'end'. Use ISO format like YYYY-MM-DDTHH:MM:SS"}), 400
+    if start_ts > end_ts:
+        return jsonify({"error": "'start' must not be later than 'end'"}), 400
+
+    targets = resolve_targets(unoms, ctp_ids, ctp_to_unom_map, expand_ctp=request.args.get('expand') == 'houses')
+    chunks = iter_export(targets, start_ts, end_ts, consumption_df, ctp_to_unom_map, excedents_df, fmt)
+    filename = export_filename(targets, start_ts, end_ts, fmt)
+    return Response(chunks, mimetype=EXPORT_FORMATS[fmt][0],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 # --- Вспомогательные функции ---
 
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
@@ -321,53 +433,16 @@ def find_closest_house_by_coordinates(lat: float, lon: float, radius: float = 10
     Находит ближайший дом по координатам в заданном радиусе.
     Возвращает UNOM найденного дома или None.
     """
-    if not geojson_data:
-        return None
-    
-    closest_unom = None
-    min_distance = float('inf')
-    
-    for feature in geojson_data['features']:
-        if feature['geometry']['type'] == 'LineString':
-            # Берем координаты конца трубы (координаты дома)
-            coordinates = feature['geometry']['coordinates']
-            if len(coordinates) >= 2:
-                house_lon, house_lat = coordinates[-1]  # Последняя точка - дом
-                unom = feature['properties'].get('Конец')
-                
-                if unom and isinstance(unom, (int, float)):
-                    distance = haversine_distance(lat, lon, house_lat, house_lon)
-                    
-                    if distance <= radius and distance < min_distance:
-                        min_distance = distance
-                        closest_unom = int(unom)
-    
-    return closest_unom
+    return house_index.closest(lat, lon, radius)
 
 def get_house_info(unom: int) -> Dict[str, Any]:
     """
     Получает информацию о доме по UNOM.
     """
-    # Поиск ЦТП для данного дома
-    ctp_name = None
-    for ctp, unoms in ctp_to_unom_map.items():
-        if unom in unoms:
-            ctp_name = ctp
-            break
-    
-    # Поиск координат дома в GeoJSON
-    house_coordinates = None
-    if geojson_data:
-        for feature in geojson_data['features']:
-            if (feature['geometry']['type'] == 'LineString' and 
-                feature['properties'].get('Конец') == unom):
-                coordinates = feature['geometry']['coordinates']
-                if len(coordinates) >= 2:
-                    house_coordinates = {
-                        'lon': coordinates[-1][0],
-                        'lat': coordinates[-1][1]
-                    }
-                break
+    # ЦТП и координаты дома из обратных индексов
+    ctp_name = unom_to_ctp.get(unom)
+    house_feature = house_features.get(unom)
+    house_coordinates = house_feature['coordinates'] if house_feature else None
     
     return {
         'unom': unom,
@@ -376,118 +451,8 @@ def get_house_info(unom: int) -> Dict[str, Any]:
         'coordinates': house_coordinates
     }
 
-def calculate_house_statistics(consumption_data: pd.DataFrame) -> Dict[str, Any]:
-    """
-    Рассчитывает статистику потребления воды для дома.
-    """
-    if consumption_data.empty:
-        return {}
-    
-    real_values = consumption_data['реальный']
-    predicted_values = consumption_data['прогноз']
-    
-    # Основная статистика
-    stats = {
-        'total_real_consumption': float(real_values.sum()),
-        'total_predicted_consumption': float(predicted_values.sum()),
-        'average_real_consumption': float(real_values.mean()),
-        'average_predicted_consumption': float(predicted_values.mean()),
-        'max_real_consumption': float(real_values.max()),
-        'min_real_consumption': float(real_values.min()),
-        'max_predicted_consumption': float(predicted_values.max()),
-        'min_predicted_consumption': float(predicted_values.min()),
-    }
-    
-    # Расчет отклонений
-    if len(real_values) > 0 and len(predicted_values) > 0:
-        differences = real_values - predicted_values
-        stats['average_deviation'] = float(differences.mean())
-        stats['max_deviation'] = float(differences.max())
-        stats['min_deviation'] = float(differences.min())
-        stats['deviation_percentage'] = float((differences / predicted_values * 100).mean())
-    
-    # Текущие значения (последние записи)
-    if len(real_values) > 0:
-        stats['current_real_consumption'] = float(real_values.iloc[-1])
-    if len(predicted_values) > 0:
-        stats['current_predicted_consumption'] = float(predicted_values.iloc[-1])
-    
-    return stats
-
-def get_address_by_coordinates(lat: float, lon: float) -> Optional[str]:
-    """
-    Получает адрес по координатам используя Nominatim API (OpenStreetMap).
-    """
-    try:
-        # Добавляем задержку для соблюдения лимитов API
-        time.sleep(1)
-        
-        url = "https://nominatim.openstreetmap.org/reverse"
-        params = {
-            'format': 'json',
-            'lat': lat,
-            'lon': lon,
-            'zoom': 18,
-            'addressdetails': 1,
-            'accept-language': 'ru'
-        }
-        
-        headers = {
-            'User-Agent': 'GigaWin2025/1.0 (water management system)'
-        }
-        
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            if 'display_name' in data:
-                # Извлекаем основные компоненты адреса
-                address_parts = []
-                
-                if 'address' in data:
-                    addr = data['address']
-                    
-                    # Собираем адрес из компонентов
-                    if 'house_number' in addr:
-                        house_num = addr['house_number']
-                        if 'road' in addr:
-                            address_parts.append(f"{addr['road']}, д. {house_num}")
-                        elif 'street' in addr:
-                            address_parts.append(f"{addr['street']}, д. {house_num}")
-                        else:
-                            address_parts.append(f"д. {house_num}")
-                    elif 'road' in addr:
-                        address_parts.append(addr['road'])
-                    elif 'street' in addr:
-                        address_parts.append(addr['street'])
-                    
-                    if 'suburb' in addr:
-                        address_parts.append(addr['suburb'])
-                    elif 'city_district' in addr:
-                        address_parts.append(addr['city_district'])
-                    
-                    if 'city' in addr:
-                        address_parts.append(addr['city'])
-                    elif 'town' in addr:
-                        address_parts.append(addr['town'])
-                    elif 'village' in addr:
-                        address_parts.append(addr['village'])
-                
-                if address_parts:
-                    return ', '.join(address_parts)
-                else:
-                    # Если не удалось собрать адрес из компонентов, используем display_name
-                    return data['display_name']
-        
-        return None
-        
-    except Exception as e:
-        print(f"Ошибка получения адреса для координат {lat}, {lon}: {e}")
-        return None
-
 @app.route('/geocoding', methods=['GET'])
-def geocoding():
+async def geocoding():
     """
     API endpoint для получения адреса по координатам.
     
@@ -501,11 +466,13 @@ def geocoding():
     if not lat or not lon:
         return jsonify({"error": "Missing 'lat' or 'lon' parameter"}), 400
     
-    address = get_address_by_coordinates(lat, lon)
+    # Сначала локальные адреса домов и кэш на диске; внешний провайдер - только при промахе
+    address, source = await geocoder.reverse(lat, lon)
     
     if address:
         return jsonify({
             "address": address,
+            "source": source,
             "coordinates": {"lat": lat, "lon": lon}
         })
     else:
@@ -519,7 +486,41 @@ def get_geojson():
     if not geojson_data:
         return jsonify({"error": "GeoJSON data not loaded"}), 500
     
-    return jsonify(geojson_data)
+    # Данные статичны: сериализуются и сжимаются один раз, повторные запросы получают 304 по ETag
+    return get_payload('geojson', lambda: geojson_data).response(request)
+
+@app.route('/geojson/bbox', methods=['GET'])
+def get_geojson_bbox():
+    """
+    API endpoint для получения GeoJSON объектов, пересекающих видимую область карты.
+    Параметры: bbox=minLon,minLat,maxLon,maxLat, zoom (необязателен), layer=pipes|houses (по умолчанию pipes).
+    Геометрия упрощается по уровню zoom (пирамида уровней строится один раз на слой).
+    """
+    layer = request.args.get('layer', 'pipes')
+    if layer not in GEO_LAYERS:
+        return jsonify({"error": f"Unknown layer '{layer}', expected one of: {', '.join(GEO_LAYERS)}"}), 400
+
+    try:
+        bbox = tuple(float(value) for value in request.args.get('bbox', '').split(','))
+        if len(bbox) != 4 or not all(math.isfinite(value) for value in bbox):
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "Invalid 'bbox' parameter, expected minLon,minLat,maxLon,maxLat"}), 400
+    if bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        return jsonify({"error": "Invalid 'bbox' parameter: min values must not exceed max values"}), 400
+
+    zoom = request.args.get('zoom')
+    try:
+        zoom = float(zoom) if zoom is not None else None
+    except ValueError:
+        return jsonify({"error": "Invalid 'zoom' parameter"}), 400
+
+    if layer == 'pipes' and not geojson_data:
+        return jsonify({"error": "GeoJSON data not loaded"}), 500
+
+    pyramid = get_pyramid(layer, geojson_data if layer == 'pipes' else None)
+    body, count = pyramid.query(bbox, zoom)
+    return Response(body, mimetype='application/json', headers={'X-Feature-Count': str(count)})
 
 @app.route('/houses', methods=['GET'])
 def get_houses():
@@ -529,6 +530,12 @@ def get_houses():
     if not geojson_data:
         return jsonify({"error": "GeoJSON data not loaded"}), 500
     
+    return get_payload('houses', build_houses_list).response(request)
+
+def build_houses_list() -> Dict[str, Any]:
+    """
+    Собирает список всех домов с координатами и информацией из GeoJSON трубопроводов.
+    """
     houses = []
     
     for feature in geojson_data['features']:
@@ -541,12 +548,9 @@ def get_houses():
                 ctp = feature['properties'].get('Начало')
                 
                 if unom and isinstance(unom, (int, float)):
-                    # Получаем дополнительную информацию о доме
-                    house_info = get_house_info(int(unom))
-                    
                     house_data = {
                         'unom': int(unom),
-                        'ctp': ctp or house_info.get('ctp', f"ЦТП-{int(unom) % 10}"),
+                        'ctp': ctp or get_house_info(int(unom))['ctp'],
                         'address': None,  # Адрес будет получаться через геокодинг
                         'coordinates': {
                             'lat': house_lat,
@@ -556,10 +560,10 @@ def get_houses():
                     }
                     houses.append(house_data)
     
-    return jsonify({
+    return {
         'houses': houses,
         'total_count': len(houses)
-    })
+    }
 
 @app.route('/add_incedent', methods=['POST'])
 def add_incedent():
@@ -568,8 +572,28 @@ def add_incedent():
 
 # --- Эндпоинты авторизации ---
 
+# Прокси, которым доверяется заголовок X-Real-IP: адреса или подсети через запятую
+# (TRUSTED_PROXIES, например "127.0.0.1,172.16.0.0/12"). Без настройки заголовок игнорируется
+TRUSTED_PROXIES = [ipaddress.ip_network(proxy.strip(), strict=False)
+                   for proxy in os.getenv('TRUSTED_PROXIES', '').split(',') if proxy.strip()]
+
+def _client_ip() -> str:
+    """IP клиента: адрес соединения, а за доверенным прокси - из X-Real-IP"""
+    remote_addr = request.remote_addr
+    try:
+        trusted = any(ipaddress.ip_address(remote_addr) in network for network in TRUSTED_PROXIES)
+    except ValueError:
+        trusted = False
+    if trusted:
+        return request.headers.get('X-Real-IP') or remote_addr
+    return remote_addr
+
+def _auth_client_id() -> str:
+    """Ключ клиента для лимитов попыток входа: IP (Telegram ID из тела запроса ограничивается отдельно)"""
+    return f"ip:{_client_ip()}"
+
 @app.route('/auth/register', methods=['POST'])
-def register():
+async def register():
     """Регистрация нового пользователя"""
     try:
         data = request.get_json()
@@ -588,20 +612,22 @@ def register():
         if email != 'admin' and len(password) < 6:
             return jsonify({'error': 'Пароль должен содержать минимум 6 символов'}), 400
         
-        user_id = auth_manager.create_user(email, password, full_name)
+        user_id = await auth_manager.create_user_async(email, password, full_name, client_id=_auth_client_id())
         
         return jsonify({
             'message': 'Пользователь успешно зарегистрирован',
             'user_id': user_id
         }), 201
         
+    except TooManyAttemptsError:
+        return jsonify({'error': 'Слишком много одновременных попыток, повторите позже'}), 429
     except ValueError as e:
         return jsonify({'error': 'Пользователь с таким email уже существует'}), 400
     except Exception as e:
         return jsonify({'error': 'Ошибка регистрации пользователя'}), 500
 
 @app.route('/auth/login', methods=['POST'])
-def login():
+async def login():
     """Авторизация пользователя"""
     try:
         data = request.get_json()
@@ -616,7 +642,7 @@ def login():
         if not email or not password:
             return jsonify({'error': 'Email и пароль обязательны'}), 400
         
-        user_data = auth_manager.login(email, password, telegram_id)
+        user_data = await auth_manager.login_async(email, password, telegram_id, client_id=_auth_client_id())
         
         if not user_data:
             return jsonify({'error': 'Неверный email или пароль'}), 401
@@ -633,6 +659,8 @@ def login():
             'session_token': user_data['session_token']
         })
         
+    except TooManyAttemptsError:
+        return jsonify({'error': 'Слишком много одновременных попыток входа, повторите позже'}), 429
     except Exception as e:
         return jsonify({'error': 'Ошибка авторизации'}), 500
 
@@ -701,7 +729,7 @@ def update_profile():
         return jsonify({'error': 'Ошибка обновления профиля'}), 500
 
 @app.route('/auth/telegram_login', methods=['POST'])
-def telegram_login():
+async def telegram_login():
     """Привязка Telegram аккаунта к существующему пользователю"""
     try:
         data = request.get_json()
@@ -716,7 +744,7 @@ def telegram_login():
         if not email or not password or not telegram_id:
             return jsonify({'error': 'Email, пароль и Telegram ID обязательны'}), 400
         
-        user_data = auth_manager.login(email, password, telegram_id)
+        user_data = await auth_manager.login_async(email, password, telegram_id, client_id=_auth_client_id())
         
         if not user_data:
             return jsonify({'error': 'Неверный email или пароль'}), 401
@@ -733,6 +761,8 @@ def telegram_login():
             'session_token': user_data['session_token']
         })
         
+    except TooManyAttemptsError:
+        return jsonify({'error': 'Слишком много одновременных попыток входа, повторите позже'}), 429
     except Exception as e:
         return jsonify({'error': 'Ошибка привязки Telegram аккаунта'}), 500
 
@@ -842,7 +872,9 @@ def health():
             'consumption_data': consumption_df is not None,
             'ctp_data': ctp_to_unom_map is not None,
             'geojson_data': geojson_data is not None,
-            'models_loaded': True  # Модели загружаются при импорте модулей
+            'models_loaded': is_model_loaded(),  # Модель загружается лениво, при первом анализе утечек
+            'auth_cache': auth_manager.cache_stats(),
+            'alert_state': get_alert_state_store().stats()
         }
         
         # Проверяем базовую функциональность
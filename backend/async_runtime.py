@@ -0,0 +1,110 @@
+"""
+Долгоживущий event loop процесса для асинхронных обработчиков Flask.
+
+Вместо asyncio.run на каждый запрос (создание и закрытие loop) корутины обработчиков
+выполняются в одном loop, работающем в фоновом потоке. Потоки WSGI-сервера передают
+туда корутины через run_async и ждут результат, поэтому запросы из разных потоков
+выполняются в loop одновременно. Тяжёлая синхронная работа (pandas, numpy)
+выносится из loop в общий пул потоков через run_blocking.
+
+Loop создаётся лениво и заново в каждом процессе (после fork воркера gunicorn
+поток родителя не существует).
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import os
+import threading
+from typing import Any, Awaitable, Callable, Optional
+
+# Размер пула для синхронной работы (переопределяется переменной окружения ASYNC_EXECUTOR_WORKERS)
+EXECUTOR_WORKERS = int(os.getenv('ASYNC_EXECUTOR_WORKERS', min(32, (os.cpu_count() or 1) + 4)))
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+def _run_loop(loop: asyncio.AbstractEventLoop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Возвращает event loop процесса, запуская его в фоновом потоке при первом обращении."""
+    global _loop, _executor, _pid
+    if _loop is not None and _pid == os.getpid():
+        return _loop
+    with _lock:
+        if _loop is None or _pid != os.getpid():
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS,
+                                                             thread_name_prefix='async-runtime')
+            loop = asyncio.new_event_loop()
+            # asyncio.to_thread и run_in_executor(None, ...) используют тот же пул
+            loop.set_default_executor(executor)
+            threading.Thread(target=_run_loop, args=(loop,), name='async-runtime-loop', daemon=True).start()
+            _loop, _executor, _pid = loop, executor, os.getpid()
+    return _loop
+
+
+def run_async(coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+    """
+    Выполняет корутину в event loop процесса и ждёт результат в текущем (синхронном) потоке.
+    Корутина видит contextvars вызывающего потока (в том числе контекст запроса Flask).
+    """
+    loop = get_loop()
+    if threading.current_thread().name == 'async-runtime-loop':
+        raise RuntimeError("run_async нельзя вызывать из event loop процесса: используйте await")
+
+    context = contextvars.copy_context()
+    result = concurrent.futures.Future()
+    task_holder = []
+
+    def start():
+        # Задача копирует текущий контекст при создании, поэтому создаём её внутри context.run
+        task = context.run(loop.create_task, coro)
+        task_holder.append(task)
+
+        def done(task: asyncio.Task):
+            if task.cancelled():
+                result.cancel()
+            elif task.exception() is not None:
+                result.set_exception(task.exception())
+            else:
+                result.set_result(task.result())
+
+        task.add_done_callback(done)
+
+    loop.call_soon_threadsafe(start)
+    try:
+        return result.result(timeout)
+    except concurrent.futures.TimeoutError:
+        loop.call_soon_threadsafe(lambda: task_holder and task_holder[0].cancel())
+        raise
+
+
+async def run_blocking(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Выполняет синхронную функцию в пуле потоков, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def async_to_sync(func: Callable[..., Awaitable[Any]]) -> Callable[..., Any]:
+    """Синхронная обёртка корутинной функции через run_async (для Flask.async_to_sync)."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return run_async(func(*args, **kwargs))
+    return wrapper
+
+
+def shutdown():
+    """Останавливает event loop и пул потоков процесса."""
+    global _loop, _executor, _pid
+    with _lock:
+        if _loop is not None and _pid == os.getpid():
+            _loop.call_soon_threadsafe(_loop.stop)
+            _executor.shutdown(wait=False)
+        _loop, _executor, _pid = None, None, None
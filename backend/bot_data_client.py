@@ -0,0 +1,213 @@
+"""
+Доступ бота к данным бэкенда без блокировки event loop.
+
+Два взаимозаменяемых клиента с одинаковыми корутинами (get_alerts, get_alert_changes,
+find_house, get_top_consumers, ping):
+
+- HttpDataClient ходит в API через общий httpx.AsyncClient: пул соединений с keep-alive,
+  раздельные таймауты на подключение и чтение. Медленный ответ /alerts ждет только
+  вызвавший обработчик, остальные чаты продолжают обслуживаться.
+- LocalDataClient вызывает загрузчик и контроллер алертов в том же процессе, когда бот
+  запущен рядом с данными (конфигурация data_backend = "local"); тяжелые вычисления
+  выполняются в пуле потоков.
+
+Авторизация всегда идет через API (HttpDataClient.request).
+"""
+
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import httpx
+import pandas as pd
+
+from alert_controller import get_alerts, refresh_alert_state
+from alert_state import get_alert_state_store
+from consumption_loader import build_unom_to_ctp, calculate_house_statistics, get_consumption_for_period_unom_sync
+from leaderboard import DEFAULT_TOP_K, get_leaderboard
+from spatial_index import build_house_features, build_house_index
+
+logger = logging.getLogger(__name__)
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+PIPES_GEOJSON_PATH = os.path.join(base_dir, 'data', 'Трубы_v2.geojson')
+
+# Таймауты запросов к API (сек): подключение, чтение ответа (оценка алертов может быть долгой)
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
+# Пул соединений к API
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 60.0
+# Порог длительности события для алертов, как у /alerts по умолчанию
+ALERT_DURATION_THRESHOLD = 4
+# Радиус поиска дома по координатам (м), как у /house_by_coordinates по умолчанию
+HOUSE_SEARCH_RADIUS = 100
+
+BACKENDS = ('http', 'local')
+
+
+class DataClientError(Exception):
+    """Ошибка получения данных; status - HTTP-статус ответа или None, если API недоступен"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class HttpDataClient:
+    """Клиент API бэкенда на общем пуле keep-alive соединений"""
+
+    def __init__(self, base_url: str, verify: bool = True,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.verify = verify
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                   max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                   keepalive_expiry=KEEPALIVE_EXPIRY)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Соединения пула привязаны к event loop, в котором созданы
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(base_url=self.base_url, verify=self.verify,
+                                             timeout=self.timeout, limits=self.limits)
+            self._loop = loop
+        return self._client
+
+    async def request(self, method: str, path: str, *, timeout: Optional[float] = None, **kwargs) -> httpx.Response:
+        """Запрос к API; недоступность и таймаут превращаются в DataClientError(status=None)"""
+        if timeout is not None:
+            kwargs['timeout'] = httpx.Timeout(timeout, connect=min(timeout, self.timeout.connect))
+        try:
+            return await self._get_client().request(method, path, **kwargs)
+        except httpx.HTTPError as e:
+            raise DataClientError(f"{method} {path}: {e!r}") from e
+
+    async def _get_json(self, path: str, params: Optional[Dict[str, Any]] = None, **kwargs) -> Any:
+        response = await self.request('GET', path, params=params, **kwargs)
+        if response.status_code != 200:
+            raise DataClientError(f"GET {path}: HTTP {response.status_code}", response.status_code)
+        return response.json()
+
+    async def get_alerts(self, alert_time: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        params = {'timestamp': alert_time.isoformat()} if alert_time else None
+        return await self._get_json('/alerts', params)
+
+    async def get_alert_changes(self, after: Optional[int] = None) -> Dict[str, Any]:
+        return await self._get_json('/alerts/changes', {} if after is None else {'after': after})
+
+    async def find_house(self, lat: float, lon: float, timestamp: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+        """Дом рядом с точкой со статистикой за сутки; None, если дома рядом нет"""
+        params = {'lat': lat, 'lon': lon, 'timestamp': (timestamp or datetime.now()).isoformat()}
+        response = await self.request('GET', '/house_by_coordinates', params=params)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise DataClientError(f"GET /house_by_coordinates: HTTP {response.status_code}", response.status_code)
+        return response.json()
+
+    async def get_top_consumers(self, metric: str = 'real', k: int = DEFAULT_TOP_K,
+                                ctp_id: Optional[str] = None) -> Dict[str, Any]:
+        """Топ потребителей за последний час (ответ /top_consumers)"""
+        params = {'metric': metric, 'k': k}
+        if ctp_id:
+            params['ctp_id'] = ctp_id
+        return await self._get_json('/top_consumers', params)
+
+    async def ping(self, timeout: float = CONNECT_TIMEOUT) -> bool:
+        """Доступность API (легкий /health вместо оценки алертов)"""
+        try:
+            response = await self.request('GET', '/health', timeout=timeout)
+        except DataClientError:
+            return False
+        return response.status_code == 200
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class LocalDataClient:
+    """Те же данные без HTTP: загрузчик и алерты вызываются в процессе бота"""
+
+    def __init__(self, ctp_to_unom_map: Dict[str, List[int]], consumption_df: pd.DataFrame,
+                 excedents_df: Optional[pd.DataFrame] = None, geojson_path: str = PIPES_GEOJSON_PATH):
+        self.ctp_to_unom_map = ctp_to_unom_map
+        self.consumption_df = consumption_df
+        self.excedents_df = excedents_df
+        self.geojson_path = geojson_path
+        self.unom_to_ctp = build_unom_to_ctp(ctp_to_unom_map or {})
+        self._houses = None
+        self._houses_lock = asyncio.Lock()
+
+    async def get_alerts(self, alert_time: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        return await get_alerts(self.ctp_to_unom_map, self.consumption_df,
+                                config={'event_duration_threshold': ALERT_DURATION_THRESHOLD},
+                                alert_time=alert_time, excedents_df=self.excedents_df)
+
+    async def get_alert_changes(self, after: Optional[int] = None) -> Dict[str, Any]:
+        # Каноническая живая оценка записывает переходы в ленту, как в /alerts/changes
+        await refresh_alert_state(self.ctp_to_unom_map, self.consumption_df, self.excedents_df)
+        return await asyncio.to_thread(get_alert_state_store().changes, after)
+
+    def _load_houses(self):
+        try:
+            with open(self.geojson_path, 'r', encoding='utf-8') as f:
+                geojson_data = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки GeoJSON для поиска домов: {e}")
+            geojson_data = None
+        return build_house_index(geojson_data), build_house_features(geojson_data)
+
+    async def _get_houses(self):
+        async with self._houses_lock:
+            if self._houses is None:
+                self._houses = await asyncio.to_thread(self._load_houses)
+        return self._houses
+
+    async def find_house(self, lat: float, lon: float, timestamp: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+        house_index, house_features = await self._get_houses()
+        unom = house_index.closest(lat, lon, HOUSE_SEARCH_RADIUS)
+        if not unom:
+            return None
+
+        end_ts = pd.Timestamp(timestamp or datetime.now())
+        consumption_data = await asyncio.to_thread(get_consumption_for_period_unom_sync, unom,
+                                                   end_ts - timedelta(hours=24), end_ts, self.consumption_df,
+                                                   excedents_df=self.excedents_df)
+        if consumption_data.empty:
+            return None
+
+        house_feature = house_features.get(unom)
+        return {
+            'house_info': {
+                'unom': unom,
+                'ctp': self.unom_to_ctp.get(unom) or f"ЦТП-{unom % 10}",
+                'address': None,
+                'coordinates': house_feature['coordinates'] if house_feature else None,
+            },
+            'statistics': calculate_house_statistics(consumption_data),
+        }
+
+    async def get_top_consumers(self, metric: str = 'real', k: int = DEFAULT_TOP_K,
+                                ctp_id: Optional[str] = None) -> Dict[str, Any]:
+        if ctp_id and ctp_id not in self.ctp_to_unom_map:
+            raise DataClientError(f"Unknown CTP '{ctp_id}'", 404)
+        board = await asyncio.to_thread(get_leaderboard, self.consumption_df, self.ctp_to_unom_map, self.excedents_df)
+        if board is None:
+            raise DataClientError("No consumption data loaded", 500)
+        return board.payload(metric, k, ctp_id)
+
+    async def ping(self, timeout: float = CONNECT_TIMEOUT) -> bool:
+        return self.consumption_df is not None and not self.consumption_df.empty
+
+    async def aclose(self):
+        pass
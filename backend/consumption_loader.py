@@ -1,13 +1,187 @@
 import os
 import json
+import hashlib
 import sqlite3
 import pandas as pd
 import numpy as np
 import asyncio
+import threading
+import shutil
+import weakref
 from typing import Optional
 from datetime import datetime
 
-np.random.seed(42)
+from consumption_snapshot import open_snapshot, snapshot_columns
+
+# Сид генератора шума: "реальный" расход детерминированно зависит от (UNOM, timestamp, NOISE_SEED)
+NOISE_SEED = 42
+
+# Уровни шума запросов: дом (/mcd_data, алерты) и дома в составе ЦТП (/ctp_data)
+HOUSE_NOISE_LEVEL = 0.025
+CTP_NOISE_LEVEL = 0.015
+
+# Уровни шума, для которых "реальный" расход материализуется при загрузке (см. materialize_simulation)
+SIMULATED_NOISE_LEVELS = (HOUSE_NOISE_LEVEL, CTP_NOISE_LEVEL)
+SIMULATION_FORMAT_VERSION = 1
+CONSUMPTION_STORE_FORMAT_VERSION = 1
+
+# --- Производные структуры, построенные поверх загруженных DataFrame ---
+
+_derived_cache = {}
+
+def _lookup_for_frame(kind, frame):
+    """Возвращает производную структуру kind для frame или None, если она не построена."""
+    entry = _derived_cache.get((kind, id(frame)))
+    if entry is not None and entry[0]() is frame:
+        return entry[1]
+    return None
+
+def _attach_to_frame(kind, frame, value):
+    """
+    Привязывает производную структуру к frame.
+
+    Кэш ключуется по id(frame) и очищается, когда frame удаляется сборщиком мусора,
+    поэтому загруженные данные нельзя изменять на месте после построения индекса.
+    """
+    key = (kind, id(frame))
+    ref = weakref.ref(frame, lambda _, key=key: _derived_cache.pop(key, None))
+    _derived_cache[key] = (ref, value)
+    return value
+
+def _cached_for_frame(kind, frame, builder):
+    """Возвращает производную структуру для frame, строя её при первом обращении."""
+    value = _lookup_for_frame(kind, frame)
+    if value is None:
+        value = _attach_to_frame(kind, frame, builder(frame))
+    return value
+
+def _to_ns(timestamp):
+    """Переводит timestamp (str, datetime, pd.Timestamp) в int64 наносекунды."""
+    return pd.Timestamp(timestamp).value
+
+def _bound_to_ns(timestamp, side):
+    """
+    Переводит границу периода в int64 наносекунды с семантикой df.loc[start:end]:
+    строка с неполной датой ('2025-09-09') покрывает весь свой период.
+    """
+    if isinstance(timestamp, str):
+        try:
+            period = pd.Period(timestamp)
+            return (period.start_time if side == 'left' else period.end_time).value
+        except (ValueError, TypeError):
+            pass
+    return _to_ns(timestamp)
+
+def _index_to_ns(timestamps):
+    """Переводит последовательность timestamps (DatetimeIndex, Series, список) в массив int64 наносекунд."""
+    return np.asarray(pd.DatetimeIndex(timestamps).values.astype('datetime64[ns]')).view(np.int64)
+
+class UnomIndex:
+    """
+    Колоночный индекс данных о расходе по UNOM.
+
+    Строки отсортированы по (UNOM, timestamp), и каждому дому соответствует
+    непрерывный диапазон [lo, hi) в массивах timestamps/consumption.
+    Выборка ряда дома за период сводится к двум бинарным поискам.
+    """
+
+    def __init__(self, consumption_df):
+        unoms = consumption_df['UNOM'].to_numpy()
+        timestamps = _index_to_ns(consumption_df.index)
+        consumption = consumption_df['consumption'].to_numpy(dtype=np.float64)
+
+        order = np.lexsort((timestamps, unoms))
+        self._set_sorted(unoms[order], timestamps[order], consumption[order], consumption_df.index.name)
+
+    @classmethod
+    def from_sorted(cls, sorted_unoms, timestamps, consumption, index_name=None) -> 'UnomIndex':
+        """
+        Строит индекс по массивам, уже отсортированным по (UNOM, timestamp), без копирования
+        (например, по memory-mapped столбцам хранилища, см. open_consumption_store).
+        """
+        index = cls.__new__(cls)
+        index._set_sorted(sorted_unoms, timestamps, consumption, index_name)
+        return index
+
+    def _set_sorted(self, sorted_unoms, timestamps, consumption, index_name):
+        self.timestamps = timestamps
+        self.consumption = consumption
+        self.index_name = index_name
+
+        boundaries = np.flatnonzero(sorted_unoms[1:] != sorted_unoms[:-1]) + 1
+        starts = np.concatenate(([0], boundaries)).astype(np.int64)
+        stops = np.concatenate((boundaries, [len(sorted_unoms)])).astype(np.int64)
+        if len(sorted_unoms) == 0:
+            starts = stops = np.empty(0, dtype=np.int64)
+
+        self.unoms = sorted_unoms[starts]
+        self.starts = starts
+        self.stops = stops
+        self.offsets = {int(unom): (int(lo), int(hi)) for unom, lo, hi in zip(self.unoms, starts, stops)}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def locate(self, unom_id, start_ts=None, end_ts=None) -> slice:
+        """
+        Возвращает срез строк дома за период [start_ts, end_ts] (обе границы включены,
+        как у df.loc[start_ts:end_ts]). Для неизвестного UNOM возвращает пустой срез.
+        """
+        span = self.offsets.get(unom_id)
+        if span is None:
+            return slice(0, 0)
+
+        lo, hi = span
+        house_timestamps = self.timestamps[lo:hi]
+        left = lo if start_ts is None else lo + int(np.searchsorted(house_timestamps, _bound_to_ns(start_ts, 'left'), side='left'))
+        right = hi if end_ts is None else lo + int(np.searchsorted(house_timestamps, _bound_to_ns(end_ts, 'right'), side='right'))
+        return slice(left, max(left, right))
+
+    def last_rows(self, unom_ids, start_ts=None, end_ts=None):
+        """
+        Для каждого UNOM из unom_ids возвращает номер последней строки дома в периоде
+        [start_ts, end_ts] или -1, если в периоде нет данных. Обрабатывает все дома за один проход.
+        """
+        rows = np.full(len(unom_ids), -1, dtype=np.int64)
+        spans = [self.offsets.get(unom_id) for unom_id in unom_ids]
+        known = np.array([span is not None for span in spans], dtype=bool)
+        if not known.any():
+            return rows
+
+        lo = np.array([span[0] for span in spans if span is not None], dtype=np.int64)
+        hi = np.array([span[1] for span in spans if span is not None], dtype=np.int64)
+
+        # Число строк не позже end_ts для каждого префикса (строки дома отсортированы по времени)
+        if end_ts is None:
+            last = hi - 1
+        else:
+            not_after = np.concatenate(([0], np.cumsum(self.timestamps <= _bound_to_ns(end_ts, 'right'))))
+            last = lo + (not_after[hi] - not_after[lo]) - 1
+
+        valid = last >= lo
+        if start_ts is not None:
+            valid &= self.timestamps[np.maximum(last, 0)] >= _bound_to_ns(start_ts, 'left')
+        rows[known] = np.where(valid, last, -1)
+        return rows
+
+    def row_unoms(self):
+        """Возвращает UNOM для каждой строки индекса."""
+        return np.repeat(self.unoms, self.stops - self.starts)
+
+    def datetime_index(self, rows) -> pd.DatetimeIndex:
+        """Возвращает DatetimeIndex для среза строк."""
+        return pd.DatetimeIndex(self.timestamps[rows].view('datetime64[ns]'), name=self.index_name)
+
+    def series(self, unom_id, start_ts=None, end_ts=None) -> pd.Series:
+        """Возвращает прогнозный расход дома за период как pd.Series с DatetimeIndex."""
+        rows = self.locate(unom_id, start_ts, end_ts)
+        return pd.Series(self.consumption[rows], index=self.datetime_index(rows), name='consumption')
+
+def get_unom_index(consumption_df) -> UnomIndex:
+    """
+    Возвращает индекс по UNOM для consumption_df, строя его один раз на объект DataFrame.
+    """
+    return _cached_for_frame('unom_index', consumption_df, UnomIndex)
 
 def load_excedents_data(csv_path='data/excedents.csv'):
     """
@@ -22,11 +196,123 @@ def load_excedents_data(csv_path='data/excedents.csv'):
         excedents_df = pd.read_csv(csv_path)
         excedents_df['timestamp_start'] = pd.to_datetime(excedents_df['timestamp_start'])
         excedents_df['timestamp_end'] = pd.to_datetime(excedents_df['timestamp_end'])
+
+        # Интервалы утечек компилируются один раз при загрузке
+        excedents_index = get_excedents_index(excedents_df)
+        print(f"Скомпилированы интервалы утечек: {len(excedents_index)} объектов")
         return excedents_df
     except FileNotFoundError:
         print(f"Файл {csv_path} не найден. Утечки не будут добавлены.")
         return pd.DataFrame()
 
+class ExcedentsIndex:
+    """
+    Скомпилированные данные об утечках.
+
+    Для каждой пары (type, id) хранятся массивы интервалов, отсортированные по началу:
+    starts/ends (int64 наносекунды), rates (м³/ч) и маска отключений ('-' в CSV).
+    Отрицательные значения для ЦТП отбрасываются один раз при компиляции.
+
+    fingerprints хранит хеш интервалов каждого объекта, version — хеш всех данных;
+    по ним кэши определяют, какие объекты затронуло изменение excedents.csv.
+    """
+
+    def __init__(self, excedents_df):
+        self.intervals = {}
+        self.fingerprints = {}
+        self.version = ''
+        if excedents_df.empty:
+            return
+
+        for (entity_type, entity_id), group in excedents_df.groupby(['type', 'id'], sort=False):
+            group = group.sort_values('timestamp_start', kind='stable')
+            leakage = group['leakage']
+
+            # Проверяем на отключение: значение '-'
+            disconnect = np.array(leakage == '-', dtype=bool)
+            # Скорость изменения расхода (м³/ч); нечисловые значения игнорируются
+            rates = np.array(pd.to_numeric(leakage, errors='coerce'), dtype=np.float64)
+            rates[np.isnan(rates) | disconnect] = 0.0
+
+            # Валидация: отрицательные значения (снижение) только для MCD
+            if entity_type == 'ctp':
+                for value in rates[rates < 0]:
+                    print(f"Предупреждение: игнорируется отрицательное значение {value} для CTP {entity_id}. "
+                          f"Снижение расхода возможно только для домов (MCD).")
+                rates[rates < 0] = 0.0
+
+            self.intervals[(entity_type, str(entity_id))] = (
+                _index_to_ns(group['timestamp_start']),
+                _index_to_ns(group['timestamp_end']),
+                rates,
+                disconnect,
+            )
+
+        for key, arrays in self.intervals.items():
+            digest = hashlib.sha1()
+            for array in arrays:
+                digest.update(array.tobytes())
+            self.fingerprints[key] = digest.hexdigest()
+        self.version = hashlib.sha1(json.dumps(sorted(self.fingerprints.items())).encode()).hexdigest()
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def rates(self, entity_type, entity_id, timestamps_ns):
+        """
+        Возвращает (leakage, disconnect) для массива timestamps_ns (int64 наносекунды):
+        суммарную скорость изменения расхода и маску отключений в каждой точке.
+        """
+        timestamps_ns = np.asarray(timestamps_ns, dtype=np.int64)
+        leakage = np.zeros(len(timestamps_ns), dtype=np.float64)
+        disconnect = np.zeros(len(timestamps_ns), dtype=bool)
+
+        entry = self.intervals.get((entity_type, str(entity_id)))
+        if entry is None or len(timestamps_ns) == 0:
+            return leakage, disconnect
+
+        starts, ends, rates, is_disconnect = entry
+        # Интервалы, начинающиеся после последней точки, не могут быть активны
+        count = int(np.searchsorted(starts, timestamps_ns.max(), side='right'))
+        if count == 0:
+            return leakage, disconnect
+
+        active = (starts[:count, None] <= timestamps_ns[None, :]) & (timestamps_ns[None, :] < ends[:count, None])
+        leakage = rates[:count] @ active
+        disconnect = (active & is_disconnect[:count, None]).any(axis=0)
+        return leakage, disconnect
+
+    def overlapping_rates(self, entity_type, entity_id, start_ns, end_ns):
+        """
+        Возвращает скорости (м³/ч) интервалов объекта, пересекающихся с периодом (start_ns, end_ns);
+        для отключений и нечисловых значений скорость равна 0.
+        """
+        entry = self.intervals.get((entity_type, str(entity_id)))
+        if entry is None:
+            return np.empty(0, dtype=np.float64)
+
+        starts, ends, rates, _ = entry
+        return rates[(starts < end_ns) & (ends > start_ns)]
+
+def get_excedents_index(excedents_df) -> ExcedentsIndex:
+    """
+    Возвращает скомпилированные интервалы утечек для excedents_df, строя их один раз на объект DataFrame.
+    """
+    return _cached_for_frame('excedents_index', excedents_df, ExcedentsIndex)
+
+def get_leakage_rates(entity_id, entity_type, timestamps, excedents_df):
+    """
+    Векторная версия get_leakage_rate_for_timestamp для целого ряда timestamps.
+
+    Возвращает кортеж numpy-массивов (leakage, disconnect):
+    - leakage: суммарная скорость изменения расхода (м³/ч) в каждой точке
+    - disconnect: True там, где объект полностью отключен (значение '-' в CSV)
+    """
+    timestamps_ns = _index_to_ns(timestamps)
+    if excedents_df is None or excedents_df.empty:
+        return np.zeros(len(timestamps_ns)), np.zeros(len(timestamps_ns), dtype=bool)
+    return get_excedents_index(excedents_df).rates(entity_type, entity_id, timestamps_ns)
+
 def get_leakage_rate_for_timestamp(entity_id, entity_type, timestamp, excedents_df):
     """
     Получает скорость изменения расхода для конкретного объекта (CTP или MCD) в конкретный момент времени.
@@ -44,45 +330,81 @@ def get_leakage_rate_for_timestamp(entity_id, entity_type, timestamp, excedents_
     if excedents_df.empty:
         return 0
     
-    timestamp = pd.to_datetime(timestamp)
-    
-    # Фильтруем утечки по типу и ID
-    relevant_excedents = excedents_df[
-        (excedents_df['type'] == entity_type) & 
-        (excedents_df['id'] == entity_id)
-    ]
-    
-    total_leakage_rate = 0
-    has_disconnect = False
-    
-    for _, excedent in relevant_excedents.iterrows():
-        excedent_start = excedent['timestamp_start']
-        excedent_end = excedent['timestamp_end']
-        
-        # Проверяем, попадает ли timestamp в период утечки
-        if excedent_start <= timestamp < excedent_end:
-            leakage_value = excedent['leakage']
-            
-            # Проверяем на отключение: значение '-'
-            if leakage_value == '-':
-                has_disconnect = True
-            else:
-                # Скорость изменения расхода (м³/ч)
-                try:
-                    value = float(leakage_value)
-                    
-                    # Валидация: отрицательные значения (снижение) только для MCD
-                    if value < 0 and entity_type == 'ctp':
-                        print(f"Предупреждение: игнорируется отрицательное значение {value} для CTP {entity_id}. "
-                              f"Снижение расхода возможно только для домов (MCD).")
-                        continue
-                    
-                    total_leakage_rate += value
-                except (ValueError, TypeError):
-                    pass
+    leakage, disconnect = get_leakage_rates(entity_id, entity_type, [timestamp], excedents_df)
     
     # Если есть отключение, возвращаем -1, иначе возвращаем скорость изменения расхода
-    return -1 if has_disconnect else total_leakage_rate
+    return -1 if disconnect[0] else float(leakage[0])
+
+def _splitmix64(x):
+    """Финализатор SplitMix64 для массива uint64 (переполнение — ожидаемое поведение)."""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def _uint64_to_unit(x):
+    """Переводит uint64 в равномерное распределение на интервале (0, 1)."""
+    return ((x >> np.uint64(11)).astype(np.float64) + 0.5) / float(1 << 53)
+
+def _normal_from_keys(unoms, timestamps_ns, seed=NOISE_SEED):
+    """
+    Стандартный нормальный шум для пар (UNOM, timestamp); массивы unoms и timestamps_ns
+    (int64 наносекунды) транслируются друг на друга по правилам numpy.
+    """
+    unom_keys = np.asarray(unoms, dtype=np.int64).view(np.uint64)
+    seconds = (np.asarray(timestamps_ns, dtype=np.int64) // 1_000_000_000).view(np.uint64)
+
+    with np.errstate(over='ignore'):
+        first = _splitmix64(_splitmix64(unom_keys ^ np.uint64(seed)) ^ seconds)
+        second = _splitmix64(first)
+
+    radius = np.sqrt(-2.0 * np.log(_uint64_to_unit(first)))
+    return radius * np.cos(2.0 * np.pi * _uint64_to_unit(second))
+
+def deterministic_normal(unoms, timestamps, seed=NOISE_SEED):
+    """
+    Счетчиковый генератор стандартного нормального шума.
+
+    Значение для пары (UNOM, timestamp) получается хешированием самой пары (SplitMix64)
+    и преобразованием Бокса-Мюллера, поэтому не зависит от порядка вычислений,
+    процесса или запроса. Возвращает матрицу (len(unoms), len(timestamps)).
+    """
+    unoms = np.asarray(unoms, dtype=np.int64).reshape(-1)
+    return _normal_from_keys(unoms[:, None], _index_to_ns(timestamps)[None, :], seed)
+
+def simulate_real_consumption_block(predicted, unoms, timestamps, noise_level=0.02, excedents_df=None):
+    """
+    Векторная симуляция реального расхода для блока домов.
+
+    Параметры:
+        predicted: 2-D массив прогнозного расхода (дома x часы); NaN — нет данных
+        unoms: UNOM для каждой строки блока
+        timestamps: общая ось времени для столбцов блока
+        noise_level: относительный уровень Гауссовского шума
+        excedents_df: данные об утечках (утечки типа 'mcd' применяются к соответствующим строкам)
+
+    Возвращает 2-D массив той же формы; NaN в predicted сохраняются.
+    """
+    predicted = np.atleast_2d(np.asarray(predicted, dtype=np.float64))
+    unoms = np.asarray(unoms, dtype=np.int64).reshape(-1)
+    timestamps_ns = _index_to_ns(timestamps)
+
+    simulated = predicted + deterministic_normal(unoms, timestamps_ns) * predicted * noise_level
+
+    # Добавляем утечки для MCD (многоквартирных домов): обходим только дома, по которым есть записи
+    if excedents_df is not None and not excedents_df.empty:
+        excedents_index = get_excedents_index(excedents_df)
+        rows = {str(unom): row for row, unom in enumerate(unoms)}
+        for entity_type, entity_id in excedents_index.intervals:
+            row = rows.get(entity_id) if entity_type == 'mcd' else None
+            if row is None:
+                continue
+            leakage, disconnect = excedents_index.rates('mcd', entity_id, timestamps_ns)
+            simulated[row] += leakage
+            # Полное отключение (расход = 0)
+            simulated[row, disconnect] = 0.0
+
+    return np.maximum(simulated, 0.0)
 
 def simulate_real_consumption(predicted_series, noise_level=0.02, unom: Optional[int] = None, 
                             start_ts=None, end_ts=None, excedents_df=None):
@@ -93,59 +415,365 @@ def simulate_real_consumption(predicted_series, noise_level=0.02, unom: Optional
     Поддерживаемые типы изменений:
     - Полное отключение: значение '-' в CSV → расход = 0
     - Изменение расхода: числовое значение в CSV (м³/ч) → добавляется к расходу
+
+    Шум детерминирован по (UNOM, timestamp), см. deterministic_normal.
     """
-    # Set seed for deterministic results based on unom and timestamp
-    
-    noise = np.random.normal(loc=0, scale=predicted_series * noise_level)
-    simulated = predicted_series + noise
-    
-    # Добавляем утечку для MCD (многоквартирных домов)
-    if unom is not None and excedents_df is not None and not excedents_df.empty:
-        # Применяем утечку к каждой точке временного ряда
-        for timestamp in simulated.index:
-            leakage_rate = get_leakage_rate_for_timestamp(str(unom), 'mcd', timestamp, excedents_df)
-            
-            if leakage_rate == -1:
-                # Полное отключение (расход = 0)
-                simulated.loc[timestamp] = 0.0
-            elif leakage_rate != 0:
-                # Добавляем скорость изменения расхода (может быть положительной или отрицательной)
-                simulated.loc[timestamp] += leakage_rate
-    
-    return simulated.clip(lower=0)
+    simulated = simulate_real_consumption_block(
+        predicted_series.to_numpy(dtype=np.float64),
+        [unom if unom is not None else 0],
+        predicted_series.index,
+        noise_level,
+        excedents_df if unom is not None else None,
+    )
+    return pd.Series(simulated[0], index=predicted_series.index, name=predicted_series.name)
+
+class SimulatedReality:
+    """
+    Материализованный "реальный" расход для всех (UNOM, час).
+
+    Массив float32 формы (len(noise_levels), число строк UnomIndex) со строками в порядке
+    UnomIndex; обычно это memory-mapped .npy файл рядом с БД. Прогноз не дублируется:
+    он уже хранится в UnomIndex.consumption.
+    """
+
+    def __init__(self, real, noise_levels, excedents_df):
+        self.real = real
+        self.noise_levels = tuple(noise_levels)
+        has_excedents = excedents_df is not None and not excedents_df.empty
+        self._excedents_ref = weakref.ref(excedents_df) if has_excedents else None
+
+    def column(self, noise_level, excedents_df):
+        """
+        Возвращает материализованный столбец для уровня шума или None, если таблица
+        построена для другого уровня шума или других данных об утечках.
+        """
+        if self._excedents_ref is None:
+            if excedents_df is not None and not excedents_df.empty:
+                return None
+        elif self._excedents_ref() is not excedents_df:
+            return None
+
+        for position, level in enumerate(self.noise_levels):
+            if np.isclose(level, noise_level):
+                return self.real[position]
+        return None
+
+def get_simulated_reality(consumption_df) -> Optional[SimulatedReality]:
+    """Возвращает материализованный "реальный" расход для consumption_df, если он построен."""
+    return _lookup_for_frame('simulated_reality', consumption_df)
+
+def _file_fingerprint(path):
+    """Отпечаток файла-источника (имя, размер, время изменения) для инвалидации кэша."""
+    try:
+        stat = os.stat(path)
+        return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+    except (OSError, TypeError):
+        return [os.path.basename(path) if path else None, None, None]
+
+def _simulate_index_rows(unom_index, excedents_df, noise_levels, out, chunk_rows=1 << 22):
+    """
+    Заполняет out[level, row] симулированным расходом для всех строк unom_index
+    (та же формула, что и в simulate_real_consumption_block).
+    """
+    row_unoms = unom_index.row_unoms()
+    total_rows = len(unom_index.timestamps)
+
+    for position, noise_level in enumerate(noise_levels):
+        for start in range(0, total_rows, chunk_rows):
+            stop = min(start + chunk_rows, total_rows)
+            predicted = unom_index.consumption[start:stop]
+            noise = _normal_from_keys(row_unoms[start:stop], unom_index.timestamps[start:stop])
+            out[position, start:stop] = predicted + noise * predicted * noise_level
+
+    # Утечки и отключения MCD — только для домов, по которым есть записи
+    if excedents_df is not None and not excedents_df.empty:
+        excedents_index = get_excedents_index(excedents_df)
+        for entity_type, entity_id in excedents_index.intervals:
+            if entity_type != 'mcd':
+                continue
+            try:
+                span = unom_index.offsets.get(int(entity_id))
+            except ValueError:
+                span = None
+            if span is None:
+                continue
+            lo, hi = span
+            leakage, disconnect = excedents_index.rates('mcd', entity_id, unom_index.timestamps[lo:hi])
+            for position in range(len(noise_levels)):
+                values = out[position, lo:hi] + leakage
+                values[disconnect] = 0.0
+                out[position, lo:hi] = values
+
+    for position in range(len(noise_levels)):
+        for start in range(0, total_rows, chunk_rows):
+            view = out[position, start:start + chunk_rows]
+            np.maximum(view, 0.0, out=view)
+
+def _load_simulation_cache(cache_path, manifest):
+    """Открывает кэш через mmap, если его манифест совпадает с ожидаемым, иначе возвращает None."""
+    try:
+        with open(cache_path + '.json', 'r', encoding='utf-8') as f:
+            if json.load(f) != manifest:
+                return None
+        real = np.load(cache_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
 
-async def get_consumption_for_period_unom(unom_id, start_ts, end_ts, df, noise_level=0.025, excedents_df=None):
+    if real.dtype != np.float32 or real.shape != (len(manifest['noise_levels']), manifest['rows']):
+        return None
+    return real
+
+def materialize_simulation(consumption_df, excedents_df, cache_path, source_paths=(),
+                           noise_levels=SIMULATED_NOISE_LEVELS):
+    """
+    Материализует "реальный" расход для всех (UNOM, час) и привязывает его к consumption_df.
+
+    Результат сохраняется в memory-mapped файле cache_path (.npy) с манифестом cache_path + '.json'.
+    Кэш переиспользуется, пока не изменились файлы source_paths (БД с synt_data, excedents.csv),
+    сид или уровни шума. Если файл записать нельзя, таблица строится в памяти.
+    """
+    unom_index = get_unom_index(consumption_df)
+    manifest = {
+        'format_version': SIMULATION_FORMAT_VERSION,
+        'noise_seed': NOISE_SEED,
+        'noise_levels': [float(level) for level in noise_levels],
+        'rows': int(len(unom_index.timestamps)),
+        'sources': [_file_fingerprint(path) for path in source_paths],
+    }
+    shape = (len(noise_levels), manifest['rows'])
+
+    real = _load_simulation_cache(cache_path, manifest)
+    if real is not None:
+        print(f"Симулированный расход загружен из {cache_path}")
+    else:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+        try:
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+            _simulate_index_rows(unom_index, excedents_df, noise_levels, out)
+            out.flush()
+            del out
+            os.replace(tmp_path, cache_path)
+            with open(cache_path + '.json.tmp', 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+            os.replace(cache_path + '.json.tmp', cache_path + '.json')
+            real = np.load(cache_path, mmap_mode='r')
+            print(f"Симулированный расход материализован в {cache_path}: {shape[1]} строк")
+        except OSError as e:
+            print(f"Не удалось сохранить симулированный расход в {cache_path}: {e}. Используется память.")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            real = np.empty(shape, dtype=np.float32)
+            _simulate_index_rows(unom_index, excedents_df, noise_levels, real)
+
+    return _attach_to_frame('simulated_reality', consumption_df,
+                            SimulatedReality(real, noise_levels, excedents_df))
+
+def simulate_index_rows(unom_index, rows, noise_level=HOUSE_NOISE_LEVEL, excedents_df=None):
+    """
+    Симулирует реальный расход для произвольного набора строк UnomIndex
+    (та же формула, что и в simulate_real_consumption_block, но поэлементно).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    houses = np.searchsorted(unom_index.starts, rows, side='right') - 1
+    row_unoms = unom_index.unoms[houses]
+    timestamps_ns = unom_index.timestamps[rows]
+    predicted = unom_index.consumption[rows]
+
+    simulated = predicted + _normal_from_keys(row_unoms, timestamps_ns) * predicted * noise_level
+
+    if excedents_df is not None and not excedents_df.empty:
+        excedents_index = get_excedents_index(excedents_df)
+        # Строки дома в UnomIndex - непрерывный диапазон offsets: среди запрошенных строк,
+        # упорядоченных один раз, он находится двоичным поиском, без прохода по всем строкам
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+        for entity_type, entity_id in excedents_index.intervals:
+            if entity_type != 'mcd':
+                continue
+            try:
+                span = unom_index.offsets.get(int(entity_id))
+            except ValueError:
+                continue
+            if span is None:
+                continue
+            lo, hi = np.searchsorted(sorted_rows, span)
+            if lo == hi:
+                continue
+            matched = order[lo:hi]
+            leakage, disconnect = excedents_index.rates('mcd', entity_id, timestamps_ns[matched])
+            simulated[matched] += leakage
+            simulated[matched[disconnect]] = 0.0
+
+    return np.maximum(simulated, 0.0)
+
+def get_real_consumption_rows(consumption_df, rows, noise_level=HOUSE_NOISE_LEVEL, excedents_df=None):
+    """
+    Возвращает "реальный" расход для строк UnomIndex: из материализованной таблицы,
+    если она подходит, иначе вычисляет его через simulate_index_rows.
+    """
+    reality = get_simulated_reality(consumption_df)
+    column = reality.column(noise_level, excedents_df) if reality is not None else None
+    if column is not None:
+        return np.asarray(column[rows], dtype=np.float64)
+    return simulate_index_rows(get_unom_index(consumption_df), rows, noise_level, excedents_df)
+
+class CtpAggregates:
+    """
+    Плотные часовые агрегаты расхода по ЦТП (матрицы ЦТП x час).
+
+    predicted/real — сумма прогнозного и симулированного расхода домов ЦТП
+    (с уровнем шума noise_level) с утечками ЦТП поверх, reporting — число домов,
+    по которым есть данные в этот час. Часы без данных (reporting == 0) в выборку не попадают,
+    как и при сборке ряда ЦТП из рядов домов.
+    """
+
+    def __init__(self, consumption_df, ctp_map, excedents_df, noise_level=CTP_NOISE_LEVEL):
+        unom_index = get_unom_index(consumption_df)
+        self.ctp_map = ctp_map
+        self.noise_level = noise_level
+        self.index_name = unom_index.index_name
+        has_excedents = excedents_df is not None and not excedents_df.empty
+        self._excedents_ref = weakref.ref(excedents_df) if has_excedents else None
+
+        self.hours = np.unique(unom_index.timestamps)
+        self.ctp_ids = list(ctp_map.keys())
+        self.positions = {ctp_id: position for position, ctp_id in enumerate(self.ctp_ids)}
+        shape = (len(self.ctp_ids), len(self.hours))
+
+        owners, rows = [], []
+        for position, ctp_id in enumerate(self.ctp_ids):
+            for unom_id in ctp_map[ctp_id]:
+                span = unom_index.offsets.get(unom_id)
+                if span is None:
+                    continue
+                lo, hi = span
+                owners.append(np.full(hi - lo, position, dtype=np.int64))
+                rows.append(np.arange(lo, hi))
+
+        size = shape[0] * shape[1]
+        if rows:
+            rows = np.concatenate(rows)
+            cells = np.concatenate(owners) * shape[1] + np.searchsorted(self.hours, unom_index.timestamps[rows])
+            # Симулированный расход домов ЦТП (как в get_consumption_for_period_unom)
+            house_real = simulate_index_rows(unom_index, rows, noise_level, excedents_df)
+            self.predicted = np.bincount(cells, weights=unom_index.consumption[rows], minlength=size).reshape(shape)
+            self.real = np.bincount(cells, weights=house_real, minlength=size).reshape(shape)
+            self.reporting = np.bincount(cells, minlength=size).reshape(shape)
+        else:
+            self.predicted = np.zeros(shape)
+            self.real = np.zeros(shape)
+            self.reporting = np.zeros(shape, dtype=np.int64)
+
+        # Утечки на уровне ЦТП поверх суммы домов
+        if has_excedents:
+            excedents_index = get_excedents_index(excedents_df)
+            for position, ctp_id in enumerate(self.ctp_ids):
+                leakage, disconnect = excedents_index.rates('ctp', ctp_id, self.hours)
+                self.real[position] += leakage
+                self.real[position, disconnect] = 0.0
+
+    def __len__(self):
+        return len(self.ctp_ids)
+
+    def matches(self, ctp_map, noise_level, excedents_df):
+        """Проверяет, построены ли агрегаты для этой карты ЦТП, уровня шума и данных об утечках."""
+        if ctp_map is not self.ctp_map or not np.isclose(noise_level, self.noise_level):
+            return False
+        if self._excedents_ref is None:
+            return excedents_df is None or excedents_df.empty
+        return self._excedents_ref() is excedents_df
+
+    def locate(self, start_ts=None, end_ts=None) -> slice:
+        """Возвращает срез часов за период [start_ts, end_ts] (обе границы включены)."""
+        left = 0 if start_ts is None else int(np.searchsorted(self.hours, _bound_to_ns(start_ts, 'left'), side='left'))
+        right = len(self.hours) if end_ts is None else int(np.searchsorted(self.hours, _bound_to_ns(end_ts, 'right'), side='right'))
+        return slice(left, max(left, right))
+
+    def frame(self, ctp_id, start_ts=None, end_ts=None) -> pd.DataFrame:
+        """
+        Возвращает DataFrame с колонками 'прогноз' и 'реальный' для ЦТП за период
+        (пустой, если данных нет).
+        """
+        position = self.positions.get(ctp_id)
+        if position is None:
+            return pd.DataFrame()
+
+        hours = self.locate(start_ts, end_ts)
+        present = self.reporting[position, hours] > 0
+        if not present.any():
+            return pd.DataFrame()
+
+        index = pd.DatetimeIndex(self.hours[hours][present].view('datetime64[ns]'), name=self.index_name)
+        return pd.DataFrame({
+            'прогноз': self.predicted[position, hours][present],
+            'реальный': self.real[position, hours][present],
+        }, index=index)
+
+def build_ctp_aggregates(consumption_df, ctp_map, excedents_df=None, noise_level=CTP_NOISE_LEVEL) -> CtpAggregates:
+    """Строит агрегаты по ЦТП и привязывает их к consumption_df."""
+    return _attach_to_frame('ctp_aggregates', consumption_df,
+                            CtpAggregates(consumption_df, ctp_map, excedents_df, noise_level))
+
+def get_ctp_aggregates(consumption_df) -> Optional[CtpAggregates]:
+    """Возвращает агрегаты по ЦТП для consumption_df, если они построены (см. build_ctp_aggregates)."""
+    return _lookup_for_frame('ctp_aggregates', consumption_df)
+
+def get_consumption_for_period_unom_sync(unom_id, start_ts, end_ts, df, noise_level=HOUSE_NOISE_LEVEL, excedents_df=None):
     """
     Возвращает прогнозируемый и симулированный расход для UNOM за определенный период времени.
+    Ряд дома выбирается через индекс по UNOM (см. get_unom_index), а не фильтрацией всего df;
+    если "реальный" расход материализован (см. materialize_simulation), он читается из таблицы.
     """
-    if not df.index.is_monotonic_increasing:
-        df = df.sort_index()
-        
-    period_df = df.loc[start_ts:end_ts]
-    unom_df = period_df[period_df['UNOM'] == unom_id]
+    unom_index = get_unom_index(df)
+    rows = unom_index.locate(unom_id, start_ts, end_ts)
 
-    if unom_df.empty:
+    if rows.start == rows.stop:
         return pd.DataFrame()
 
-    predicted = unom_df['consumption']
-    simulated = simulate_real_consumption(predicted, noise_level, unom=unom_id, 
-                                        start_ts=start_ts, end_ts=end_ts, excedents_df=excedents_df)
+    timestamps = unom_index.datetime_index(rows)
+    predicted = pd.Series(unom_index.consumption[rows], index=timestamps, name='consumption')
+
+    reality = get_simulated_reality(df)
+    real_column = reality.column(noise_level, excedents_df) if reality is not None else None
+    if real_column is not None:
+        simulated = pd.Series(np.asarray(real_column[rows], dtype=np.float64), index=timestamps)
+    else:
+        simulated = simulate_real_consumption(predicted, noise_level, unom=unom_id, 
+                                            start_ts=start_ts, end_ts=end_ts, excedents_df=excedents_df)
     
     result_df = pd.DataFrame({'прогноз': predicted, 'реальный': simulated})
     return result_df
 
-async def get_consumption_for_period_ctp(ctp_id, start_ts, end_ts, df, ctp_map, noise_level=0.015, excedents_df=None):
+async def get_consumption_for_period_unom(unom_id, start_ts, end_ts, df, noise_level=HOUSE_NOISE_LEVEL, excedents_df=None):
     """
-    Возвращает прогнозируемый и симулированный расход для ЦТП, используя get_consumption_for_period_unom.
+    Асинхронный вариант get_consumption_for_period_unom_sync. Выполняется в текущем потоке:
+    выборка по индексу дешёвая, а вызывающие (проверки алертов) делают её для многих домов подряд.
+    Для обработчиков запросов тяжёлую работу выносите в пул через async_runtime.run_blocking.
+    """
+    return get_consumption_for_period_unom_sync(unom_id, start_ts, end_ts, df, noise_level, excedents_df)
+
+def get_consumption_for_period_ctp_sync(ctp_id, start_ts, end_ts, df, ctp_map, noise_level=CTP_NOISE_LEVEL, excedents_df=None):
+    """
+    Возвращает прогнозируемый и симулированный расход для ЦТП.
+
+    Если для df построены агрегаты по ЦТП (см. build_ctp_aggregates) с той же картой,
+    уровнем шума и данными об утечках, возвращается срез их строки; иначе ряд собирается
+    из рядов домов через get_consumption_for_period_unom.
     """
     unoms_for_ctp = ctp_map.get(ctp_id)
     if not unoms_for_ctp:
         print(f"Внимание: ЦТП с ID '{ctp_id}' не найден.")
         return pd.DataFrame()
 
-    # Используем asyncio.gather для параллельного выполнения
-    tasks = [get_consumption_for_period_unom(unom_id, start_ts, end_ts, df, noise_level, excedents_df) for unom_id in unoms_for_ctp]
-    all_unom_dfs = await asyncio.gather(*tasks)
+    aggregates = get_ctp_aggregates(df)
+    if aggregates is not None and aggregates.matches(ctp_map, noise_level, excedents_df):
+        total_consumption_df = aggregates.frame(ctp_id, start_ts, end_ts)
+        if total_consumption_df.empty:
+            print(f"Внимание: Данные для ЦТП '{ctp_id}' в периоде с '{start_ts}' по '{end_ts}' не найдены.")
+        return total_consumption_df
+
+    all_unom_dfs = [get_consumption_for_period_unom_sync(unom_id, start_ts, end_ts, df, noise_level, excedents_df)
+                    for unom_id in unoms_for_ctp]
     
     valid_dfs = [df for df in all_unom_dfs if not df.empty]
 
@@ -156,20 +784,20 @@ async def get_consumption_for_period_ctp(ctp_id, start_ts, end_ts, df, ctp_map,
     combined_df = pd.concat(valid_dfs)
     total_consumption_df = combined_df.groupby(combined_df.index).sum()
 
-    # Применяем утечки на уровне ЦТП к прогнозному расходу
+    # Применяем утечки на уровне ЦТП к реальному расходу
     if excedents_df is not None and not excedents_df.empty:
-        for timestamp in total_consumption_df.index:
-            leakage_rate = get_leakage_rate_for_timestamp(ctp_id, 'ctp', timestamp, excedents_df)
-            
-            if leakage_rate == -1:
-                # Полное отключение (расход = 0)
-                total_consumption_df.loc[timestamp, 'реальный'] = 0.0
-            elif leakage_rate != 0:
-                # Добавляем утечку ЦТП к реальному расходу
-                total_consumption_df.loc[timestamp, 'реальный'] += leakage_rate
+        leakage, disconnect = get_leakage_rates(ctp_id, 'ctp', total_consumption_df.index, excedents_df)
+        real = np.array(total_consumption_df['реальный'], dtype=np.float64) + leakage
+        # Полное отключение (расход = 0)
+        real[disconnect] = 0.0
+        total_consumption_df['реальный'] = real
 
     return total_consumption_df
 
+async def get_consumption_for_period_ctp(ctp_id, start_ts, end_ts, df, ctp_map, noise_level=CTP_NOISE_LEVEL, excedents_df=None):
+    """Асинхронный вариант get_consumption_for_period_ctp_sync (выполняется в текущем потоке)."""
+    return get_consumption_for_period_ctp_sync(ctp_id, start_ts, end_ts, df, ctp_map, noise_level, excedents_df)
+
 async def build_ctp_pressure_payload(ctp_id, end_ts, result_df, ctp_points_df):
     """
     Формирует данные о состоянии системы, характеристиках и кривых для ЦТП
@@ -288,9 +916,220 @@ async def build_ctp_pressure_payload(ctp_id, end_ts, result_df, ctp_points_df):
 # --- Asynchronous versions for concurrent execution ---
 
 
-def load_data(db_path='data/hak2025.db', map_path='data/ctp_to_unom.json', excedents_path='data/excedents.csv'):
+def calculate_house_statistics(consumption_data):
+    """
+    Рассчитывает статистику потребления воды для дома.
+    """
+    if consumption_data.empty:
+        return {}
+    
+    real_values = consumption_data['реальный']
+    predicted_values = consumption_data['прогноз']
+    
+    # Основная статистика
+    stats = {
+        'total_real_consumption': float(real_values.sum()),
+        'total_predicted_consumption': float(predicted_values.sum()),
+        'average_real_consumption': float(real_values.mean()),
+        'average_predicted_consumption': float(predicted_values.mean()),
+        'max_real_consumption': float(real_values.max()),
+        'min_real_consumption': float(real_values.min()),
+        'max_predicted_consumption': float(predicted_values.max()),
+        'min_predicted_consumption': float(predicted_values.min()),
+    }
+    
+    # Расчет отклонений
+    if len(real_values) > 0 and len(predicted_values) > 0:
+        differences = real_values - predicted_values
+        stats['average_deviation'] = float(differences.mean())
+        stats['max_deviation'] = float(differences.max())
+        stats['min_deviation'] = float(differences.min())
+        stats['deviation_percentage'] = float((differences / predicted_values * 100).mean())
+    
+    # Текущие значения (последние записи)
+    if len(real_values) > 0:
+        stats['current_real_consumption'] = float(real_values.iloc[-1])
+    if len(predicted_values) > 0:
+        stats['current_predicted_consumption'] = float(predicted_values.iloc[-1])
+    
+    return stats
+
+def build_unom_to_ctp(ctp_map):
+    """
+    Строит обратный индекс UNOM -> ЦТП по карте ЦТП-UNOM.
+    Если дом указан у нескольких ЦТП, берется первый в порядке карты.
+    """
+    unom_to_ctp = {}
+    for ctp_id, unoms in ctp_map.items():
+        for unom_id in unoms:
+            unom_to_ctp.setdefault(int(unom_id), ctp_id)
+    return unom_to_ctp
+
+def _read_synt_data(db_path):
+    """Читает synt_data из БД в DataFrame с DatetimeIndex 'timestamp', отсортированным по времени."""
+    con = sqlite3.connect(db_path)
+    try:
+        # Попытка загрузить уже очищенную таблицу
+        consumption_df = pd.read_sql_query("SELECT date, UNOM, consumption from synt_data", con)
+        consumption_df['timestamp'] = pd.to_datetime(consumption_df['date'])
+        consumption_df.set_index('timestamp', inplace=True)
+    except sqlite3.OperationalError:
+        # Загрузка исходной таблицы, если очищенная не найдена
+        consumption_df = pd.read_sql_query("SELECT * from synt_data", con)
+        consumption_df['timestamp'] = pd.to_datetime(consumption_df['date'].str[:10] + ' ' + consumption_df['time'])
+        consumption_df.set_index('timestamp', inplace=True)
+    finally:
+        con.close()
+
+    consumption_df.sort_index(inplace=True)
+    return consumption_df
+
+class _StoreLock:
+    """Межпроцессная блокировка построения хранилища (flock), чтобы его строил один процесс."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+            self.file = open(self.path, 'a+')
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        except (ImportError, OSError):
+            # Без flock (Windows, read-only каталог) процессы строят хранилище независимо;
+            # запись все равно атомарна через os.replace
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        return self
+
+    def __exit__(self, *exc):
+        if self.file is not None:
+            self.file.close()
+        return False
+
+def _store_manifest(db_path, snapshot=None):
+    # Хранилище, собранное из снимка (consumption_snapshot), зависит от снимка, а не от БД
+    source = os.path.join(snapshot[0], 'manifest.json') if snapshot is not None else db_path
+    return {
+        'format_version': CONSUMPTION_STORE_FORMAT_VERSION,
+        'sources': [_file_fingerprint(source)],
+    }
+
+def open_consumption_store(store_path, manifest):
+    """
+    Открывает колоночное хранилище расхода через mmap (только чтение), если его манифест
+    совпадает с ожидаемым, иначе возвращает None.
+
+    Возвращает (unoms, timestamps, consumption, index_name): столбцы, отсортированные
+    по (UNOM, timestamp), как в UnomIndex.
+    """
+    try:
+        with open(os.path.join(store_path, 'manifest.json'), 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+        columns = [np.load(os.path.join(store_path, f'{name}.npy'), mmap_mode='r')
+                   for name in ('unoms', 'timestamps', 'consumption')]
+    except (OSError, ValueError):
+        return None
+
+    if any(stored.get(key) != value for key, value in manifest.items()):
+        return None
+    unoms, timestamps, consumption = columns
+    if not (len(unoms) == len(timestamps) == len(consumption) == stored.get('rows')):
+        return None
+    if timestamps.dtype != np.int64 or consumption.dtype != np.float64:
+        return None
+    return unoms, timestamps, consumption, stored.get('index_name')
+
+def build_consumption_store(db_path, store_path, snapshot=None):
+    """
+    Читает synt_data из БД (или из колоночного снимка snapshot = (каталог, манифест), см.
+    consumption_snapshot) и сохраняет столбцы UnomIndex (UNOM, timestamp в наносекундах,
+    прогноз) в каталог store_path как .npy файлы с манифестом. Каталог заменяется атомарно.
+    """
+    if snapshot is not None:
+        unom_index = UnomIndex.from_sorted(*snapshot_columns(*snapshot), snapshot[1].get('index_name'))
+    else:
+        unom_index = UnomIndex(_read_synt_data(db_path))
+    manifest = dict(_store_manifest(db_path, snapshot), rows=int(len(unom_index.timestamps)),
+                    index_name=unom_index.index_name)
+
+    tmp_path = f"{store_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    try:
+        np.save(os.path.join(tmp_path, 'unoms.npy'), unom_index.row_unoms())
+        np.save(os.path.join(tmp_path, 'timestamps.npy'), unom_index.timestamps)
+        np.save(os.path.join(tmp_path, 'consumption.npy'), unom_index.consumption)
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        shutil.rmtree(store_path, ignore_errors=True)
+        os.replace(tmp_path, store_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+def frame_from_store(unoms, timestamps, consumption, index_name=None) -> pd.DataFrame:
+    """
+    Собирает consumption_df поверх столбцов хранилища без копирования и привязывает к нему
+    UnomIndex по тем же массивам. Строки DataFrame идут в порядке (UNOM, timestamp).
+    """
+    index = pd.DatetimeIndex(timestamps.view('datetime64[ns]'), name=index_name, copy=False)
+    consumption_df = pd.DataFrame({'UNOM': unoms, 'consumption': consumption}, index=index, copy=False)
+    _attach_to_frame('unom_index', consumption_df,
+                     UnomIndex.from_sorted(unoms, timestamps, consumption, index_name))
+    return consumption_df
+
+def load_consumption_frame(db_path, store=None):
+    """
+    Загружает данные о расходе.
+
+    При store='mmap' (по умолчанию, переменная окружения CONSUMPTION_STORE) synt_data один раз
+    переводится в колоночное хранилище рядом с БД, а все процессы (воркеры gunicorn, Telegram-бот,
+    AlertNotifier) открывают его через mmap только для чтения и делят страницы в page cache.
+    Хранилище перестраивается при изменении файла БД. При store='off' или если хранилище
+    нельзя записать, synt_data читается в память процесса, как раньше.
+
+    Если рядом с БД есть скомпилированный снимок synt_data (consumption_snapshot) не старше БД,
+    данные берутся из него через mmap вместо чтения SQLite.
+    """
+    store = store or os.getenv('CONSUMPTION_STORE', 'mmap')
+    snapshot = open_snapshot(db_path)
+    if store == 'mmap':
+        store_path = os.path.splitext(db_path)[0] + '.store'
+        manifest = _store_manifest(db_path, snapshot)
+        try:
+            opened = open_consumption_store(store_path, manifest)
+            if opened is None:
+                with _StoreLock(store_path + '.lock'):
+                    # Пока ждали блокировку, хранилище мог построить другой процесс
+                    opened = open_consumption_store(store_path, manifest)
+                    if opened is None:
+                        build_consumption_store(db_path, store_path, snapshot)
+                        source = f"снимка {snapshot[0]}" if snapshot is not None else "БД"
+                        print(f"Построено колоночное хранилище расхода из {source}: {store_path}")
+                        opened = open_consumption_store(store_path, manifest)
+            if opened is not None:
+                print(f"Данные о расходе открыты из {store_path} (mmap)")
+                return frame_from_store(*opened)
+        except OSError as e:
+            print(f"Не удалось использовать хранилище {store_path}: {e}. Данные читаются в память.")
+
+    if snapshot is not None:
+        print(f"Данные о расходе загружены из снимка {snapshot[0]}")
+        return frame_from_store(*snapshot_columns(*snapshot), snapshot[1].get('index_name'))
+    return _read_synt_data(db_path)
+
+def load_data(db_path='data/hak2025.db', map_path='data/ctp_to_unom.json', excedents_path='data/excedents.csv',
+              simulation=None):
     """
     Загружает карту ЦТП-UNOM, данные о потреблении и данные об утечках.
+
+    simulation управляет материализацией "реального" расхода (см. materialize_simulation):
+    'startup' — при загрузке, 'background' — в фоновом потоке, 'off' — не материализовать.
+    По умолчанию берется из переменной окружения SIMULATION_CACHE ('background').
+    Данные о расходе открываются из общего хранилища (см. load_consumption_frame).
     """
     base_dir = os.path.dirname(os.path.abspath(__file__))
     
@@ -307,29 +1146,42 @@ def load_data(db_path='data/hak2025.db', map_path='data/ctp_to_unom.json', exced
         map_path = os.path.join(base_dir, map_path)
     if not os.path.isabs(db_path):
         db_path = os.path.join(base_dir, db_path)
+    if not os.path.isabs(excedents_path):
+        excedents_path = os.path.join(base_dir, excedents_path)
+
     # Загрузка карты ЦТП -> UNOM
     with open(map_path, 'r', encoding='utf-8') as f:
         ctp_to_unom_map = json.load(f)
 
-    # Загрузка данных о расходе из БД
-    con = sqlite3.connect(db_path)
-    try:
-        # Попытка загрузить уже очищенную таблицу
-        consumption_df = pd.read_sql_query("SELECT date, UNOM, consumption from synt_data", con)
-        consumption_df['timestamp'] = pd.to_datetime(consumption_df['date'])
-        consumption_df.set_index('timestamp', inplace=True)
-    except sqlite3.OperationalError:
-        # Загрузка исходной таблицы, если очищенная не найдена
-        consumption_df = pd.read_sql_query("SELECT * from synt_data", con)
-        consumption_df['timestamp'] = pd.to_datetime(consumption_df['date'].str[:10] + ' ' + consumption_df['time'])
-        consumption_df.set_index('timestamp', inplace=True)
-    finally:
-        con.close()
+    # Загрузка данных о расходе: общее mmap-хранилище рядом с БД или чтение из БД
+    consumption_df = load_consumption_frame(db_path)
 
-    consumption_df.sort_index(inplace=True)
+    # Индекс по UNOM строится один раз при загрузке и переиспользуется всеми запросами
+    unom_index = get_unom_index(consumption_df)
+    print(f"Построен индекс расхода по UNOM: {len(unom_index)} домов")
     
     # Загрузка данных об утечках
     excedents_df = load_excedents_data(excedents_path)
+
+    # Часовые агрегаты по ЦТП для /ctp_data и алертов уровня ЦТП
+    ctp_aggregates = build_ctp_aggregates(consumption_df, ctp_to_unom_map, excedents_df)
+    print(f"Построены агрегаты расхода по ЦТП: {len(ctp_aggregates)} ЦТП x {len(ctp_aggregates.hours)} ч")
+
+    # Материализация "реального" расхода рядом с БД
+    simulation = simulation or os.getenv('SIMULATION_CACHE', 'background')
+    if simulation in ('startup', 'background'):
+        cache_path = os.path.splitext(db_path)[0] + '.simulated.npy'
+        source_paths = (db_path, excedents_path)
+        snapshot = open_snapshot(db_path)
+        if snapshot is not None:
+            # Прогноз из снимка хранится во float32: кэш, посчитанный по БД, не подходит
+            source_paths += (os.path.join(snapshot[0], 'manifest.json'),)
+        args = (consumption_df, excedents_df, cache_path, source_paths)
+        if simulation == 'startup':
+            materialize_simulation(*args)
+        else:
+            threading.Thread(target=materialize_simulation, args=args, daemon=True,
+                             name='simulation-materializer').start()
     
     return ctp_to_unom_map, consumption_df, excedents_df
 
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Колоночный снимок synt_data, разбитый по датам.
+
+Компиляция (python consumption_snapshot.py [путь к БД] [--since YYYY-MM-DD | --append])
+один раз читает synt_data. Время переводится в эпоху в часах средствами самой SQLite, поэтому
+в Python не создаются строки дат и не вызывается pd.to_datetime. Строки выбираются порциями
+и раскладываются по дням. Каждый день сохраняется в каталог date=YYYY-MM-DD в виде трех .npy:
+unom (int32), hour (int32, часы от эпохи) и consumption (float32). Внутри дня строки
+отсортированы по (UNOM, час). manifest.json описывает партиции и отпечаток БД, по которой
+собран снимок.
+
+load_data (через load_consumption_frame) открывает снимок через mmap, если он есть и не старше
+БД, и собирает из него столбцы UnomIndex вместо чтения SQLite. Партиции идут по времени и
+отсортированы по UNOM внутри, поэтому общий порядок (UNOM, время) получается одной
+устойчивой сортировкой по UNOM. Параметр --since перекомпилирует только дни начиная с
+указанной даты, а более ранние партиции переносятся в новый снимок жесткими ссылками.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+SNAPSHOT_FORMAT_VERSION = 1
+# Строк synt_data в одной порции чтения
+FETCH_ROWS = 1 << 20
+
+ROW_DTYPE = np.dtype([('hour', '<i4'), ('unom', '<i4'), ('consumption', '<f4')])
+COLUMNS = ('unom', 'hour', 'consumption')
+NS_PER_HOUR = 3600 * 10 ** 9
+
+
+def snapshot_path_for(db_path: str) -> str:
+    """Каталог снимка рядом с БД: data/hak2025.db -> data/hak2025.snapshot"""
+    return os.path.splitext(db_path)[0] + '.snapshot'
+
+
+def _partition_name(day: int) -> str:
+    return f"date={date(1970, 1, 1) + timedelta(days=int(day))}"
+
+
+def _source_fingerprint(db_path: str) -> Dict[str, Any]:
+    stat = os.stat(db_path)
+    return {'name': os.path.basename(db_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_manifest(snapshot_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(snapshot_path, 'manifest.json'), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('format_version') == SNAPSHOT_FORMAT_VERSION else None
+
+
+def is_fresh(manifest: Dict[str, Any], db_path: str) -> bool:
+    """Снимок не старше БД: БД не менялась после компиляции (или ее нет рядом со снимком)"""
+    try:
+        db_mtime = os.stat(db_path).st_mtime_ns
+    except OSError:
+        return True
+    return db_mtime <= manifest['source']['mtime_ns']
+
+
+def _time_expressions(con: sqlite3.Connection) -> Tuple[str, str]:
+    """
+    Выражения SQLite для часа от эпохи и для даты (YYYY-MM-DD) строки;
+    исходная таблица хранит дату и время раздельно.
+    """
+    columns = {row[1] for row in con.execute("PRAGMA table_info(synt_data)")}
+    timestamp = "substr(date, 1, 10) || ' ' || time" if 'time' in columns else "date"
+    return f"CAST(strftime('%s', {timestamp}) AS INTEGER) / 3600", "substr(date, 1, 10)"
+
+
+def _to_block(rows) -> np.ndarray:
+    try:
+        return np.fromiter(rows, dtype=ROW_DTYPE, count=len(rows))
+    except TypeError:
+        # NULL в consumption: такие строки остаются с NaN, как при чтении через pandas
+        return np.fromiter(((h, u, np.nan if c is None else c) for h, u, c in rows), dtype=ROW_DTYPE, count=len(rows))
+
+
+def _spill_rows(con: sqlite3.Connection, since: Optional[str], spill_dir: str) -> Dict[int, int]:
+    """Читает synt_data порциями и дописывает строки в файлы по дням; возвращает {день: строк}"""
+    hour, day = _time_expressions(con)
+    query = f"SELECT {hour} AS hour, UNOM, consumption FROM synt_data WHERE hour IS NOT NULL AND UNOM IS NOT NULL"
+    params = ()
+    if since is not None:
+        # Сравнение строк ISO-дат дешевле, чем разбор времени для каждой строки
+        query += f" AND {day} >= ?"
+        params = (since,)
+
+    counts = {}
+    cursor = con.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        block = _to_block(rows)
+        days = block['hour'] // 24
+        order = np.argsort(days, kind='stable')
+        block, days = block[order], days[order]
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        for part in np.split(np.arange(len(block)), bounds):
+            day = int(days[part[0]])
+            with open(os.path.join(spill_dir, f"{day}.bin"), 'ab') as f:
+                block[part].tofile(f)
+            counts[day] = counts.get(day, 0) + len(part)
+    return counts
+
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def compile_snapshot(db_path: str, snapshot_path: Optional[str] = None, since: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Компилирует synt_data в снимок snapshot_path (по умолчанию рядом с БД) и возвращает манифест.
+    since ('YYYY-MM-DD' или 'last' - последняя партиция) перечитывает из БД только дни начиная
+    с этой даты; остальные партиции берутся из текущего снимка. Каталог заменяется атомарно.
+    """
+    snapshot_path = snapshot_path or snapshot_path_for(db_path)
+    source = _source_fingerprint(db_path)
+    previous = read_manifest(snapshot_path) if since else None
+    since_day = None
+    if previous is not None:
+        last = max((p['day'] for p in previous['partitions']), default=None)
+        since_day = last if since == 'last' else (datetime.fromisoformat(since).date() - date(1970, 1, 1)).days
+        if last is None:
+            since_day = None
+
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    spill_dir = os.path.join(tmp_path, '_spill')
+    os.makedirs(spill_dir)
+    try:
+        partitions = []
+        if since_day is not None:
+            for partition in previous['partitions']:
+                if partition['day'] < since_day:
+                    name = _partition_name(partition['day'])
+                    os.makedirs(os.path.join(tmp_path, name))
+                    for column in COLUMNS:
+                        _link_or_copy(os.path.join(snapshot_path, name, f"{column}.npy"),
+                                      os.path.join(tmp_path, name, f"{column}.npy"))
+                    partitions.append(partition)
+
+        con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            counts = _spill_rows(con, str(date(1970, 1, 1) + timedelta(days=since_day)) if since_day is not None else None,
+                                 spill_dir)
+        finally:
+            con.close()
+
+        for day in sorted(counts):
+            block = np.fromfile(os.path.join(spill_dir, f"{day}.bin"), dtype=ROW_DTYPE)
+            block = block[np.lexsort((block['hour'], block['unom']))]
+            name = _partition_name(day)
+            os.makedirs(os.path.join(tmp_path, name))
+            for column in COLUMNS:
+                np.save(os.path.join(tmp_path, name, f"{column}.npy"), np.ascontiguousarray(block[column]))
+            partitions.append({'day': day, 'date': name[5:], 'rows': int(len(block))})
+        shutil.rmtree(spill_dir)
+
+        partitions.sort(key=lambda p: p['day'])
+        manifest = {
+            'format_version': SNAPSHOT_FORMAT_VERSION,
+            'source': source,
+            'compiled_at': time.time(),
+            'rows': sum(p['rows'] for p in partitions),
+            'index_name': 'timestamp',
+            'partitions': partitions,
+        }
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        os.replace(tmp_path, snapshot_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return manifest
+
+
+def open_snapshot(db_path: str, snapshot_path: Optional[str] = None) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """(каталог, манифест) снимка, если он есть и не старше БД, иначе None"""
+    snapshot_path = snapshot_path or snapshot_path_for(db_path)
+    manifest = read_manifest(snapshot_path)
+    if manifest is None or not is_fresh(manifest, db_path):
+        return None
+    return snapshot_path, manifest
+
+
+def snapshot_columns(snapshot_path: str, manifest: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Столбцы UnomIndex из снимка: UNOM (int64), timestamp (int64, нс), прогноз (float64),
+    отсортированные по (UNOM, timestamp). Партиции читаются через mmap.
+    """
+    parts = {column: [] for column in COLUMNS}
+    for partition in manifest['partitions']:
+        name = _partition_name(partition['day'])
+        for column in COLUMNS:
+            parts[column].append(np.load(os.path.join(snapshot_path, name, f"{column}.npy"), mmap_mode='r'))
+
+    if not manifest['partitions']:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    unoms = np.concatenate(parts['unom'])
+    # Партиции идут по времени и внутри отсортированы по (UNOM, час): устойчивая сортировка
+    # по UNOM дает порядок (UNOM, час)
+    order = np.argsort(unoms, kind='stable')
+    timestamps = np.concatenate(parts['hour'])[order].astype(np.int64) * NS_PER_HOUR
+    consumption = np.concatenate(parts['consumption'])[order].astype(np.float64)
+    return unoms[order].astype(np.int64), timestamps, consumption
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Компиляция synt_data в колоночный снимок по датам")
+    parser.add_argument('db_path', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'hak2025.db'))
+    parser.add_argument('--output', help="каталог снимка (по умолчанию <БД>.snapshot)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--since', help="перекомпилировать только дни начиная с даты YYYY-MM-DD")
+    group.add_argument('--append', action='store_const', const='last', dest='since',
+                       help="перекомпилировать последний день снимка и все новые")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    manifest = compile_snapshot(args.db_path, args.output, args.since)
+    print(f"Снимок {args.output or snapshot_path_for(args.db_path)}: {manifest['rows']} строк, "
+          f"{len(manifest['partitions'])} партиций, {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+Потоковый экспорт рядов расхода (прогноз, "реальный", отклонение) в CSV, JSON Lines или Parquet.
+
+Ряды домов берутся срезами UnomIndex, ряды ЦТП — из часовых агрегатов, и форматируются
+блоками по CHUNK_ROWS строк: в памяти одновременно находится только один блок, поэтому
+экспорт месяца по целому ЦТП не собирает весь ответ в памяти. iter_export отдает байты
+по мере готовности (для HTTP с chunked transfer), write_export пишет их в файл.
+"""
+
+import io
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+import consumption_loader as cl
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow необязателен: без него Parquet недоступен
+    pa = pq = None
+
+# Строк в одном блоке форматирования
+CHUNK_ROWS = 50000
+
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'jsonl': ('application/x-ndjson; charset=utf-8', 'jsonl'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+COLUMNS = ['entity_type', 'entity_id', 'timestamp', 'predicted', 'real', 'deviation']
+
+
+def available_formats() -> List[str]:
+    """Форматы, доступные в текущем окружении."""
+    return [fmt for fmt in FORMATS if fmt != 'parquet' or pq is not None]
+
+
+def resolve_targets(unoms: Iterable[int] = (), ctp_ids: Iterable[str] = (),
+                    ctp_map: Optional[Dict[str, List[int]]] = None,
+                    expand_ctp: bool = False) -> List[Tuple[str, Any]]:
+    """
+    Список объектов экспорта [('mcd', unom) | ('ctp', ctp_id)].
+    При expand_ctp ЦТП заменяется домами из карты ЦТП-UNOM.
+    """
+    targets = [('mcd', int(unom)) for unom in unoms]
+    for ctp_id in ctp_ids:
+        if expand_ctp:
+            targets.extend(('mcd', int(unom)) for unom in (ctp_map or {}).get(ctp_id, []))
+        else:
+            targets.append(('ctp', ctp_id))
+    return list(dict.fromkeys(targets))
+
+
+def _house_blocks(unom, start_ts, end_ts, consumption_df, excedents_df) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Блоки (timestamps_ns, прогноз, реальный) ряда дома за период."""
+    unom_index = cl.get_unom_index(consumption_df)
+    rows = unom_index.locate(unom, start_ts, end_ts)
+    for start in range(rows.start, rows.stop, CHUNK_ROWS):
+        block = np.arange(start, min(start + CHUNK_ROWS, rows.stop))
+        real = cl.get_real_consumption_rows(consumption_df, block, cl.HOUSE_NOISE_LEVEL, excedents_df)
+        yield unom_index.timestamps[block], unom_index.consumption[block], real
+
+
+def _ctp_blocks(ctp_id, start_ts, end_ts, consumption_df, ctp_map, excedents_df) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Блоки (timestamps_ns, прогноз, реальный) ряда ЦТП за период."""
+    frame = cl.get_consumption_for_period_ctp_sync(ctp_id, start_ts, end_ts, consumption_df, ctp_map,
+                                                   excedents_df=excedents_df)
+    if frame.empty:
+        return
+    timestamps = frame.index.as_unit('ns').asi8
+    predicted = frame['прогноз'].to_numpy(dtype=np.float64)
+    real = frame['реальный'].to_numpy(dtype=np.float64)
+    for start in range(0, len(frame), CHUNK_ROWS):
+        stop = start + CHUNK_ROWS
+        yield timestamps[start:stop], predicted[start:stop], real[start:stop]
+
+
+def iter_frames(targets: Sequence[Tuple[str, Any]], start_ts, end_ts, consumption_df,
+                ctp_map: Optional[Dict[str, List[int]]] = None, excedents_df=None) -> Iterator[pd.DataFrame]:
+    """Блоки экспорта как DataFrame с колонками COLUMNS."""
+    for entity_type, entity_id in targets:
+        if entity_type == 'ctp':
+            blocks = _ctp_blocks(entity_id, start_ts, end_ts, consumption_df, ctp_map or {}, excedents_df)
+        else:
+            blocks = _house_blocks(entity_id, start_ts, end_ts, consumption_df, excedents_df)
+        for timestamps, predicted, real in blocks:
+            yield pd.DataFrame({
+                'entity_type': entity_type,
+                'entity_id': str(entity_id),
+                'timestamp': pd.DatetimeIndex(timestamps.view('datetime64[ns]')).strftime('%Y-%m-%dT%H:%M:%S'),
+                'predicted': predicted,
+                'real': real,
+                'deviation': real - predicted,
+            }, columns=COLUMNS)
+
+
+class _ByteSink(io.RawIOBase):
+    """Файлоподобный приемник: накапливает записанные байты до вызова drain."""
+
+    def __init__(self):
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def _iter_parquet(frames: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    """Parquet: каждый блок пишется отдельной row group, байты отдаются сразу после записи."""
+    schema = pa.schema([('entity_type', pa.string()), ('entity_id', pa.string()), ('timestamp', pa.string()),
+                        ('predicted', pa.float64()), ('real', pa.float64()), ('deviation', pa.float64())])
+    sink = _ByteSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for frame in frames:
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def iter_export(targets: Sequence[Tuple[str, Any]], start_ts, end_ts, consumption_df,
+                ctp_map: Optional[Dict[str, List[int]]] = None, excedents_df=None,
+                fmt: str = 'csv') -> Iterator[bytes]:
+    """
+    Экспортирует ряды объектов targets за период [start_ts, end_ts] в формате fmt,
+    отдавая байты по блокам. Неизвестный формат отклоняется сразу (ValueError), до начала выдачи.
+    """
+    if fmt not in available_formats():
+        raise ValueError(f"Unsupported export format '{fmt}', expected one of: {', '.join(available_formats())}")
+
+    return _encode(iter_frames(targets, start_ts, end_ts, consumption_df, ctp_map, excedents_df), fmt)
+
+
+def _encode(frames: Iterator[pd.DataFrame], fmt: str) -> Iterator[bytes]:
+    if fmt == 'parquet':
+        return _iter_parquet(frames)
+    return _iter_text(frames, fmt)
+
+
+def _iter_text(frames: Iterator[pd.DataFrame], fmt: str) -> Iterator[bytes]:
+    """CSV с заголовком или JSON Lines, по блоку на итерацию."""
+    if fmt == 'csv':
+        yield (','.join(COLUMNS) + '\n').encode('utf-8')
+    for frame in frames:
+        if fmt == 'csv':
+            yield frame.to_csv(header=False, index=False).encode('utf-8')
+        else:
+            lines = frame.to_json(orient='records', lines=True, force_ascii=False, double_precision=6)
+            yield (lines.rstrip('\n') + '\n').encode('utf-8')
+
+
+def write_export(file: BinaryIO, targets: Sequence[Tuple[str, Any]], start_ts, end_ts, consumption_df,
+                 ctp_map: Optional[Dict[str, List[int]]] = None, excedents_df=None, fmt: str = 'csv') -> int:
+    """Пишет экспорт (аргументы как у iter_export) в файл, возвращает число выгруженных строк."""
+    if fmt not in available_formats():
+        raise ValueError(f"Unsupported export format '{fmt}', expected one of: {', '.join(available_formats())}")
+
+    rows = 0
+
+    def counted(frames):
+        nonlocal rows
+        for frame in frames:
+            rows += len(frame)
+            yield frame
+
+    for chunk in _encode(counted(iter_frames(targets, start_ts, end_ts, consumption_df, ctp_map, excedents_df)), fmt):
+        file.write(chunk)
+    return rows
+
+
+def export_filename(targets: Sequence[Tuple[str, Any]], start_ts, end_ts, fmt: str) -> str:
+    """Имя файла экспорта по объектам и периоду."""
+    if len(targets) == 1:
+        subject = f"{'house' if targets[0][0] == 'mcd' else 'ctp'}_{targets[0][1]}"
+    else:
+        subject = f"{len(targets)}_objects"
+    period = f"{pd.Timestamp(start_ts):%Y%m%d%H}-{pd.Timestamp(end_ts):%Y%m%d%H}"
+    return f"{subject}_{period}.{FORMATS[fmt][1]}".replace('/', '_')
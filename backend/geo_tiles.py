@@ -0,0 +1,216 @@
+"""
+Выдача GeoJSON по видимой области карты (bbox) с упрощением геометрии по уровню zoom.
+
+Для каждого слоя (трубы, дома) один раз строится пирамида уровней детализации:
+на каждом уровне геометрия упрощена алгоритмом Дугласа-Пекера с допуском около
+одного пикселя на этом zoom, а каждый объект заранее сериализован в JSON.
+Запрос отбирает объекты, пересекающие bbox, и склеивает готовые байты.
+"""
+
+import json
+import math
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Слои карты: имя -> файл GeoJSON
+LAYERS = {
+    'pipes': os.path.join(base_dir, 'data', 'Трубы_v2.geojson'),
+    'houses': os.path.join(base_dir, 'data', 'МКД_полигоны.geojson'),
+}
+
+# Уровни пирамиды: zoom, для которого упрощается геометрия; None — исходная геометрия
+ZOOM_TIERS = (10, 12, 14, 16, None)
+
+# Метров на пиксель на экваторе при zoom 0 (тайлы 256 px, Web Mercator)
+METERS_PER_PIXEL_Z0 = 156543.03392
+
+
+def simplify_line(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Упрощает ломаную алгоритмом Дугласа-Пекера (итеративно, без рекурсии).
+    points — массив (n, 2) в метрической проекции, tolerance — допуск в тех же единицах.
+    """
+    if len(points) <= 2 or tolerance <= 0:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        segment = end - start
+        inner = points[first + 1:last] - start
+        length = math.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return points[keep]
+
+
+class _Projection:
+    """Локальная равнопромежуточная проекция градусов в метры вокруг широты lat0."""
+
+    def __init__(self, lat0: float):
+        self.scale_x = math.radians(1) * 6371000 * math.cos(math.radians(lat0))
+        self.scale_y = math.radians(1) * 6371000
+
+    def forward(self, coordinates: Sequence[Sequence[float]]) -> np.ndarray:
+        points = np.asarray(coordinates, dtype=np.float64)[:, :2]
+        return points * (self.scale_x, self.scale_y)
+
+    def inverse(self, points: np.ndarray) -> List[List[float]]:
+        return (points / (self.scale_x, self.scale_y)).tolist()
+
+
+def _simplify_ring(ring, projection: _Projection, tolerance: float, closed: bool):
+    """Упрощает одну ломаную или кольцо; вырожденный результат заменяется исходной геометрией."""
+    if len(ring) <= 2:
+        return ring
+    simplified = simplify_line(projection.forward(ring), tolerance)
+    if closed and len(simplified) < 4:
+        return ring
+    coordinates = projection.inverse(simplified)
+    # Возвращаем исходные значения крайних точек, чтобы смежные объекты стыковались точно
+    coordinates[0], coordinates[-1] = list(ring[0]), list(ring[-1])
+    return coordinates
+
+
+def simplify_geometry(geometry: Dict[str, Any], projection: _Projection, tolerance: Optional[float]) -> Dict[str, Any]:
+    """Упрощает геометрию GeoJSON (LineString, MultiLineString, Polygon, MultiPolygon)."""
+    if tolerance is None or not geometry:
+        return geometry
+
+    geometry_type = geometry.get('type')
+    coordinates = geometry.get('coordinates')
+    if geometry_type == 'LineString':
+        simplified = _simplify_ring(coordinates, projection, tolerance, closed=False)
+    elif geometry_type == 'MultiLineString':
+        simplified = [_simplify_ring(line, projection, tolerance, closed=False) for line in coordinates]
+    elif geometry_type == 'Polygon':
+        simplified = [_simplify_ring(ring, projection, tolerance, closed=True) for ring in coordinates]
+    elif geometry_type == 'MultiPolygon':
+        simplified = [[_simplify_ring(ring, projection, tolerance, closed=True) for ring in polygon]
+                      for polygon in coordinates]
+    else:
+        return geometry
+
+    return {**geometry, 'coordinates': simplified}
+
+
+def _flatten_coordinates(coordinates) -> List[Tuple[float, float]]:
+    """Возвращает все точки вложенного списка координат GeoJSON."""
+    if not coordinates:
+        return []
+    if isinstance(coordinates[0], (int, float)):
+        return [(coordinates[0], coordinates[1])]
+    points = []
+    for part in coordinates:
+        points.extend(_flatten_coordinates(part))
+    return points
+
+
+class TilePyramid:
+    """
+    Слой GeoJSON, подготовленный для выдачи по bbox: bbox каждого объекта
+    и сериализованные объекты для каждого уровня ZOOM_TIERS.
+    """
+
+    def __init__(self, geojson_data: Optional[Dict[str, Any]], tiers: Sequence[Optional[int]] = ZOOM_TIERS):
+        features = [feature for feature in (geojson_data or {}).get('features', []) if feature.get('geometry')]
+        boxes = []
+        for feature in features:
+            points = _flatten_coordinates(feature['geometry'].get('coordinates'))
+            if points:
+                lons, lats = zip(*points)
+                boxes.append((min(lons), min(lats), max(lons), max(lats)))
+            else:
+                boxes.append((np.inf, np.inf, -np.inf, -np.inf))
+        self.boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+        finite = np.isfinite(self.boxes).all(axis=1)
+        lat0 = float(self.boxes[finite][:, [1, 3]].mean()) if finite.any() else 0.0
+        projection = _Projection(lat0)
+
+        self.tiers = list(tiers)
+        self.features: Dict[Optional[int], List[bytes]] = {}
+        for zoom in self.tiers:
+            tolerance = None if zoom is None else METERS_PER_PIXEL_Z0 * math.cos(math.radians(lat0)) / 2 ** zoom
+            self.features[zoom] = [
+                json.dumps({**feature, 'geometry': simplify_geometry(feature['geometry'], projection, tolerance)},
+                           ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                for feature in features
+            ]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def tier_for_zoom(self, zoom: Optional[float]) -> Optional[int]:
+        """Выбирает уровень пирамиды: самый детальный уровень, не превышающий zoom."""
+        zoom_tiers = sorted(tier for tier in self.tiers if tier is not None)
+        full_detail = None in self.tiers or not zoom_tiers
+        # Крупнее самого детального упрощённого уровня — исходная геометрия
+        if zoom is None or not zoom_tiers or zoom > zoom_tiers[-1]:
+            return None if full_detail else zoom_tiers[-1]
+        candidates = [tier for tier in zoom_tiers if tier <= zoom]
+        return candidates[-1] if candidates else zoom_tiers[0]
+
+    def query(self, bbox: Tuple[float, float, float, float], zoom: Optional[float] = None) -> Tuple[bytes, int]:
+        """
+        Возвращает (FeatureCollection в виде байт JSON, число объектов) для объектов,
+        пересекающих bbox = (min_lon, min_lat, max_lon, max_lat).
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        mask = ((self.boxes[:, 0] <= max_lon) & (self.boxes[:, 2] >= min_lon)
+                & (self.boxes[:, 1] <= max_lat) & (self.boxes[:, 3] >= min_lat))
+        tier_features = self.features[self.tier_for_zoom(zoom)]
+        selected = [tier_features[position] for position in np.flatnonzero(mask)]
+        body = b'{"type":"FeatureCollection","features":[' + b','.join(selected) + b']}'
+        return body, len(selected)
+
+
+_pyramids: Dict[str, TilePyramid] = {}
+_pyramids_lock = threading.Lock()
+
+
+def load_geojson(path: str) -> Optional[Dict[str, Any]]:
+    """Загружает GeoJSON файл; при ошибке возвращает None."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Ошибка загрузки GeoJSON {path}: {e}")
+        return None
+
+
+def get_pyramid(layer: str, geojson_data: Optional[Dict[str, Any]] = None) -> TilePyramid:
+    """
+    Возвращает пирамиду слоя layer, строя её при первом обращении
+    (из geojson_data, если передан, иначе из файла LAYERS[layer]).
+    """
+    pyramid = _pyramids.get(layer)
+    if pyramid is None:
+        with _pyramids_lock:
+            pyramid = _pyramids.get(layer)
+            if pyramid is None:
+                if geojson_data is None:
+                    geojson_data = load_geojson(LAYERS[layer])
+                pyramid = TilePyramid(geojson_data)
+                _pyramids[layer] = pyramid
+                print(f"Подготовлен слой карты '{layer}': {len(pyramid)} объектов, уровни {pyramid.tiers}")
+    return pyramid
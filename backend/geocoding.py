@@ -0,0 +1,278 @@
+"""
+Обратное геокодирование (координаты -> адрес) с приоритетом локальных данных.
+
+Порядок поиска:
+1. ближайший дом из пространственного индекса и его адрес из загруженных адресов МКД;
+2. постоянный кэш на диске (sqlite), ключ — координаты, округлённые до CACHE_PRECISION знаков;
+3. внешний провайдер (по умолчанию Nominatim) с ограничением частоты запросов.
+
+Провайдер подключаемый: для тестов и офлайн-работы используется StaticProvider.
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import requests
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Путь к кэшу геокодирования (переопределяется переменной окружения GEOCODE_CACHE_PATH)
+DEFAULT_CACHE_PATH = os.path.join(base_dir, 'data', 'geocode_cache.sqlite')
+
+# Округление координат для ключа кэша: 4 знака ~ 11 м по широте
+CACHE_PRECISION = 4
+
+# Через сколько секунд повторять внешний запрос для координат, по которым адрес не найден
+NEGATIVE_CACHE_TTL = 24 * 3600
+
+# Радиус поиска дома из локальных данных, в метрах
+LOCAL_SEARCH_RADIUS = 50
+
+
+def format_nominatim_address(data: Dict[str, Any]) -> Optional[str]:
+    """Собирает краткий адрес из ответа Nominatim reverse; при неудаче возвращает display_name."""
+    if 'display_name' not in data:
+        return None
+
+    address_parts = []
+    addr = data.get('address', {})
+
+    # Собираем адрес из компонентов
+    street = addr.get('road') or addr.get('street')
+    if 'house_number' in addr:
+        house_num = addr['house_number']
+        address_parts.append(f"{street}, д. {house_num}" if street else f"д. {house_num}")
+    elif street:
+        address_parts.append(street)
+
+    district = addr.get('suburb') or addr.get('city_district')
+    if district:
+        address_parts.append(district)
+
+    settlement = addr.get('city') or addr.get('town') or addr.get('village')
+    if settlement:
+        address_parts.append(settlement)
+
+    if address_parts:
+        return ', '.join(address_parts)
+    # Если не удалось собрать адрес из компонентов, используем display_name
+    return data['display_name']
+
+
+class GeocodingProvider:
+    """Интерфейс внешнего провайдера обратного геокодирования."""
+
+    name = 'provider'
+
+    async def reverse(self, lat: float, lon: float) -> Optional[str]:
+        raise NotImplementedError
+
+
+class NominatimProvider(GeocodingProvider):
+    """
+    Nominatim API (OpenStreetMap). Не чаще одного запроса в min_interval секунд на процесс
+    (политика использования Nominatim); HTTP-запрос выполняется в потоке, не блокируя event loop.
+    """
+
+    name = 'nominatim'
+
+    def __init__(self, url: str = 'https://nominatim.openstreetmap.org/reverse',
+                 user_agent: str = 'GigaWin2025/1.0 (water management system)',
+                 min_interval: float = 1.0, timeout: float = 10):
+        self.url = url
+        self.user_agent = user_agent
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self._session = requests.Session()
+        # Блокировка потоков, а не asyncio.Lock: запросы могут идти из разных event loop
+        self._lock = threading.Lock()
+        self._last_request = 0.0
+
+    def _request(self, lat: float, lon: float) -> Optional[str]:
+        params = {
+            'format': 'json',
+            'lat': lat,
+            'lon': lon,
+            'zoom': 18,
+            'addressdetails': 1,
+            'accept-language': 'ru'
+        }
+        with self._lock:
+            # Выдерживаем интервал только если предыдущий запрос был недавно
+            wait = self._last_request + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                response = self._session.get(self.url, params=params, headers={'User-Agent': self.user_agent},
+                                             timeout=self.timeout)
+            finally:
+                self._last_request = time.monotonic()
+
+        if response.status_code != 200:
+            raise RuntimeError(f"Nominatim вернул статус {response.status_code}")
+        return format_nominatim_address(response.json())
+
+    async def reverse(self, lat: float, lon: float) -> Optional[str]:
+        return await asyncio.to_thread(self._request, lat, lon)
+
+
+class StaticProvider(GeocodingProvider):
+    """Провайдер без сети: адреса из словаря {(lat, lon) округлённые до precision: адрес}."""
+
+    name = 'static'
+
+    def __init__(self, addresses: Optional[Mapping[Tuple[float, float], str]] = None,
+                 precision: int = CACHE_PRECISION):
+        self.precision = precision
+        self.addresses = {(round(lat, precision), round(lon, precision)): address
+                          for (lat, lon), address in (addresses or {}).items()}
+        self.calls = 0
+
+    async def reverse(self, lat: float, lon: float) -> Optional[str]:
+        self.calls += 1
+        return self.addresses.get((round(lat, self.precision), round(lon, self.precision)))
+
+
+class GeocodeCache:
+    """Постоянный кэш обратного геокодирования в sqlite. Хранит и найденные адреса, и промахи."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, precision: int = CACHE_PRECISION,
+                 negative_ttl: float = NEGATIVE_CACHE_TTL):
+        self.path = path
+        self.precision = precision
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS reverse_geocode (
+                    lat_key INTEGER NOT NULL,
+                    lon_key INTEGER NOT NULL,
+                    address TEXT,
+                    provider TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (lat_key, lon_key)
+                )
+            ''')
+            self._conn.commit()
+
+    def _key(self, lat: float, lon: float) -> Tuple[int, int]:
+        scale = 10 ** self.precision
+        return int(round(lat * scale)), int(round(lon * scale))
+
+    def get(self, lat: float, lon: float) -> Tuple[bool, Optional[str]]:
+        """Возвращает (найдено в кэше, адрес). Истёкший промах считается отсутствующим."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT address, updated_at FROM reverse_geocode WHERE lat_key = ? AND lon_key = ?',
+                self._key(lat, lon)
+            ).fetchone()
+        if row is None:
+            return False, None
+        address, updated_at = row
+        if address is None and time.time() - updated_at > self.negative_ttl:
+            return False, None
+        return True, address
+
+    def put(self, lat: float, lon: float, address: Optional[str], provider: str = None):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO reverse_geocode (lat_key, lon_key, address, provider, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (*self._key(lat, lon), address, provider, time.time())
+            )
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM reverse_geocode').fetchone()[0]
+
+
+class Geocoder:
+    """Обратное геокодирование: локальные адреса домов -> кэш на диске -> внешний провайдер."""
+
+    def __init__(self, house_index=None, house_addresses: Optional[Mapping[int, str]] = None,
+                 provider: Optional[GeocodingProvider] = None, cache: Optional[GeocodeCache] = None,
+                 local_radius: float = LOCAL_SEARCH_RADIUS):
+        self.house_index = house_index
+        self.house_addresses = house_addresses or {}
+        self.provider = provider
+        self.cache = cache
+        self.local_radius = local_radius
+        # In-flight запросы к провайдеру по ключу кэша, чтобы одинаковые координаты не запрашивались дважды
+        self._pending: Dict[Tuple[Any, Any], asyncio.Future] = {}
+
+    def lookup_local(self, lat: float, lon: float) -> Optional[str]:
+        """Адрес ближайшего дома из локальных данных в радиусе local_radius."""
+        if self.house_index is None or not self.house_addresses:
+            return None
+        unom = self.house_index.closest(lat, lon, self.local_radius)
+        return self.house_addresses.get(unom) if unom is not None else None
+
+    async def reverse(self, lat: float, lon: float) -> Tuple[Optional[str], Optional[str]]:
+        """Возвращает (адрес, источник: 'local' | 'cache' | имя провайдера) или (None, None)."""
+        address = self.lookup_local(lat, lon)
+        if address:
+            return address, 'local'
+
+        if self.cache is not None:
+            cached, address = self.cache.get(lat, lon)
+            if cached:
+                return address, 'cache' if address else None
+
+        if self.provider is None:
+            return None, None
+
+        key = self.cache._key(lat, lon) if self.cache is not None else (lat, lon)
+        pending = self._pending.get(key)
+        if pending is not None and pending.get_loop() is asyncio.get_running_loop():
+            address = await asyncio.shield(pending)
+            return address, self.provider.name if address else None
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            address = await self.provider.reverse(lat, lon)
+        except Exception as e:
+            print(f"Ошибка получения адреса для координат {lat}, {lon}: {e}")
+            # Ошибку провайдера не кэшируем: следующий запрос попробует снова
+            future.set_result(None)
+            return None, None
+        else:
+            future.set_result(address)
+        finally:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+        if self.cache is not None:
+            self.cache.put(lat, lon, address, self.provider.name)
+        return address, self.provider.name if address else None
+
+
+def create_provider(name: Optional[str] = None) -> Optional[GeocodingProvider]:
+    """Создаёт провайдера по имени (переменная окружения GEOCODING_PROVIDER): nominatim | off."""
+    name = (name or os.getenv('GEOCODING_PROVIDER', 'nominatim')).lower()
+    if name == 'nominatim':
+        return NominatimProvider()
+    if name in ('off', 'none', ''):
+        return None
+    raise ValueError(f"Неизвестный провайдер геокодирования: {name}")
+
+
+def create_geocoder(house_index=None, house_addresses: Optional[Mapping[int, str]] = None,
+                    provider: Optional[GeocodingProvider] = None) -> Geocoder:
+    """Создаёт геокодер приложения: провайдер и путь кэша берутся из окружения, если не заданы."""
+    try:
+        cache = GeocodeCache(os.getenv('GEOCODE_CACHE_PATH', DEFAULT_CACHE_PATH))
+    except sqlite3.Error as e:
+        print(f"Кэш геокодирования недоступен, работаем без него: {e}")
+        cache = None
+    return Geocoder(house_index, house_addresses, provider or create_provider(), cache)
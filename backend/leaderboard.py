@@ -0,0 +1,160 @@
+"""
+Рейтинг потребителей по всей сети за час.
+
+Leaderboard строится один раз на час по вектору последнего часа всех домов (UnomIndex +
+"реальный" расход) и хранит готовые порядки для каждой метрики: по городу и по каждому ЦТП.
+Чтение топ-K — срез готового порядка, O(K). get_leaderboard держит построенные рейтинги
+в кэше по (данные, карта ЦТП, утечки, час), поэтому в течение часа пересчета нет.
+
+Метрики:
+- real: "реальный" расход, м³/ч;
+- deviation: превышение прогноза (реальный - прогноз), м³/ч;
+- ratio: отношение реального расхода к прогнозу (дома с прогнозом меньше
+  MIN_PREDICTED_FOR_RATIO в этот рейтинг не входят).
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import consumption_loader as cl
+
+METRICS = ('real', 'deviation', 'ratio')
+# Прогноз (м³/ч), ниже которого отношение не считается
+MIN_PREDICTED_FOR_RATIO = 0.1
+# Размер топа по умолчанию и предел для одного запроса
+DEFAULT_TOP_K = 10
+MAX_TOP_K = 100
+# Сколько рейтингов (разных часов и наборов данных) держать в кэше
+CACHE_ENTRIES = 24
+
+
+def latest_hour(consumption_df, at: Optional[datetime] = None) -> Optional[pd.Timestamp]:
+    """Час рейтинга: начало часа at (по умолчанию - сейчас), но не позже последнего часа в данных."""
+    unom_index = cl.get_unom_index(consumption_df)
+    if not len(unom_index):
+        return None
+    # Ряды домов отсортированы по времени: последний час данных - максимум по последним строкам
+    last = pd.Timestamp(int(unom_index.timestamps[unom_index.stops - 1].max()))
+    hour = pd.Timestamp(at if at is not None else datetime.now()).floor('h')
+    return min(hour, last.floor('h'))
+
+
+class Leaderboard:
+    """Отсортированные рейтинги домов за один час по всем METRICS, по городу и по ЦТП."""
+
+    def __init__(self, consumption_df, ctp_map: Dict[str, List[int]], excedents_df, hour: pd.Timestamp):
+        self.hour = hour
+        unom_index = cl.get_unom_index(consumption_df)
+        rows = unom_index.last_rows(unom_index.unoms, hour, hour)
+        present = rows >= 0
+
+        self.unoms = unom_index.unoms[present].astype(np.int64)
+        rows = rows[present]
+        self.predicted = unom_index.consumption[rows]
+        self.real = cl.get_real_consumption_rows(consumption_df, rows, cl.HOUSE_NOISE_LEVEL, excedents_df)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(self.predicted >= MIN_PREDICTED_FOR_RATIO, self.real / self.predicted, np.nan)
+        self.values = {'real': self.real, 'deviation': self.real - self.predicted, 'ratio': ratio}
+
+        self.unom_to_ctp = cl.build_unom_to_ctp(ctp_map)
+        self.city = {metric: self._descending(values, np.arange(len(values)))
+                     for metric, values in self.values.items()}
+
+        # Пары (ЦТП, дом) для рейтингов по ЦТП
+        positions = {int(unom): position for position, unom in enumerate(self.unoms)}
+        self.ctp_ids = list(ctp_map.keys())
+        self.ctp_positions = {ctp_id: position for position, ctp_id in enumerate(self.ctp_ids)}
+        owners, members = [], []
+        for owner, ctp_id in enumerate(self.ctp_ids):
+            for unom in dict.fromkeys(int(unom) for unom in ctp_map[ctp_id]):
+                if unom in positions:
+                    owners.append(owner)
+                    members.append(positions[unom])
+        owners = np.asarray(owners, dtype=np.int64)
+        members = np.asarray(members, dtype=np.int64)
+
+        # Для каждой метрики: члены ЦТП, отсортированные по (ЦТП, значение по убыванию), и границы ЦТП
+        self.by_ctp = {}
+        for metric, values in self.values.items():
+            member_values = values[members]
+            valid = ~np.isnan(member_values)
+            order = np.lexsort((-member_values[valid], owners[valid]))
+            sorted_owners = owners[valid][order]
+            bounds = np.searchsorted(sorted_owners, np.arange(len(self.ctp_ids) + 1))
+            self.by_ctp[metric] = (members[valid][order], bounds)
+
+    @staticmethod
+    def _descending(values: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+        candidates = candidates[~np.isnan(values[candidates])]
+        return candidates[np.argsort(-values[candidates], kind='stable')]
+
+    def __len__(self):
+        return len(self.unoms)
+
+    def ranked(self, metric: str = 'real', ctp_id: Optional[str] = None) -> np.ndarray:
+        """Позиции домов в порядке рейтинга (без копирования)"""
+        if metric not in self.values:
+            raise ValueError(f"Unknown metric '{metric}', expected one of: {', '.join(METRICS)}")
+        if ctp_id is None:
+            return self.city[metric]
+        owner = self.ctp_positions.get(ctp_id)
+        if owner is None:
+            return np.empty(0, dtype=np.int64)
+        members, bounds = self.by_ctp[metric]
+        return members[bounds[owner]:bounds[owner + 1]]
+
+    def top(self, metric: str = 'real', k: int = DEFAULT_TOP_K, ctp_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Топ-K домов по metric по городу или по ЦТП ctp_id"""
+        positions = self.ranked(metric, ctp_id)[:max(0, k)]
+        return [{
+            'rank': rank,
+            'unom': int(self.unoms[position]),
+            'ctp_id': ctp_id if ctp_id is not None else self.unom_to_ctp.get(int(self.unoms[position])),
+            'real': float(self.real[position]),
+            'predicted': float(self.predicted[position]),
+            'deviation': float(self.values['deviation'][position]),
+            'ratio': None if np.isnan(self.values['ratio'][position]) else float(self.values['ratio'][position]),
+        } for rank, position in enumerate(positions, 1)]
+
+    def payload(self, metric: str = 'real', k: int = DEFAULT_TOP_K, ctp_id: Optional[str] = None) -> Dict[str, Any]:
+        """Ответ API /top_consumers"""
+        return {
+            'hour': self.hour.isoformat(),
+            'metric': metric,
+            'ctp_id': ctp_id,
+            'ranked': int(len(self.ranked(metric, ctp_id))),
+            'items': self.top(metric, k, ctp_id),
+        }
+
+
+_boards = OrderedDict()
+_boards_lock = threading.Lock()
+
+
+def get_leaderboard(consumption_df, ctp_map: Dict[str, List[int]], excedents_df=None,
+                    at: Optional[datetime] = None) -> Optional[Leaderboard]:
+    """
+    Рейтинг за час at (по умолчанию - последний час данных не позже текущего), строится
+    один раз на час и набор данных; None, если данных нет.
+    """
+    hour = latest_hour(consumption_df, at)
+    if hour is None:
+        return None
+    has_excedents = excedents_df is not None and not excedents_df.empty
+    key = (id(consumption_df), id(ctp_map), cl.get_excedents_index(excedents_df).version if has_excedents else '', hour)
+
+    with _boards_lock:
+        board = _boards.get(key)
+        if board is None:
+            board = Leaderboard(consumption_df, ctp_map, excedents_df, hour)
+            _boards[key] = board
+            while len(_boards) > CACHE_ENTRIES:
+                _boards.popitem(last=False)
+        else:
+            _boards.move_to_end(key)
+    return board
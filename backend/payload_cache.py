@@ -0,0 +1,84 @@
+"""
+Предварительно сериализованные ответы для статических данных API (/geojson, /houses).
+
+JSON сериализуется один раз в байты, сжатые варианты (gzip и, если установлен пакет brotli, br)
+считаются заранее. Ответ отдается со строгим ETag и поддержкой If-None-Match -> 304.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+from typing import Any, Callable, Dict
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него отдаем gzip
+    brotli = None
+
+# Порядок предпочтения кодировок при равном q в Accept-Encoding
+ENCODING_PREFERENCE = ('br', 'gzip', 'identity')
+
+
+class StaticPayload:
+    """Сериализованный JSON-ответ со сжатыми вариантами и ETag для каждого варианта."""
+
+    def __init__(self, data: Any, mimetype: str = 'application/json'):
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()[:32]
+
+        self.mimetype = mimetype
+        self.variants: Dict[str, bytes] = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body, quality=11)
+        # Строгий ETag различается для каждого представления (RFC 9110, 8.8.3)
+        self.etags = {encoding: f'"{digest}-{encoding}"' for encoding in self.variants}
+
+    def __len__(self):
+        return len(self.variants['identity'])
+
+    def select_encoding(self, request) -> str:
+        """Выбирает кодировку по Accept-Encoding запроса."""
+        best, best_quality = 'identity', 0
+        for encoding in ENCODING_PREFERENCE:
+            if encoding not in self.variants:
+                continue
+            quality = 1 if encoding == 'identity' else request.accept_encodings[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def response(self, request) -> Response:
+        """Формирует ответ: 304, если клиент прислал актуальный ETag, иначе тело в выбранной кодировке."""
+        encoding = self.select_encoding(request)
+        etag = self.etags[encoding]
+        headers = {
+            'ETag': etag,
+            'Vary': 'Accept-Encoding',
+            'Cache-Control': 'no-cache',
+        }
+
+        if request.if_none_match.contains_weak(etag.strip('"')):
+            return Response(status=304, headers=headers)
+
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(self.variants[encoding], mimetype=self.mimetype, headers=headers)
+
+
+_payloads: Dict[str, StaticPayload] = {}
+_payloads_lock = threading.Lock()
+
+
+def get_payload(name: str, builder: Callable[[], Any]) -> StaticPayload:
+    """Возвращает сериализованный ответ name, строя его через builder() при первом обращении."""
+    payload = _payloads.get(name)
+    if payload is None:
+        with _payloads_lock:
+            payload = _payloads.get(name)
+            if payload is None:
+                payload = StaticPayload(builder())
+                _payloads[name] = payload
+    return payload
@@ -96,10 +96,12 @@ def main():
         return
     
     api_base_url = config.get('api_base_url', 'http://localhost:5001')
+    # Источник данных для команд: "http" (API бэкенда) или "local" (данные в процессе бота)
+    data_backend = os.environ.get('BOT_DATA_BACKEND', config.get('data_backend', 'http'))
     
     try:
         # Создаем и запускаем бота
-        bot = TelegramBot(bot_token, api_base_url)
+        bot = TelegramBot(bot_token, api_base_url, data_backend=data_backend)
         
         # Инициализируем данные
         logger.info("Инициализация данных бота...")
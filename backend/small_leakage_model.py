@@ -6,29 +6,82 @@ import pandas as pd
 import numpy as np
 import os
 import asyncio
+import threading
 from datetime import datetime
 from catboost import CatBoostClassifier
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, Optional
 import consumption_loader as cl
 
 
-print("Загрузка данных и модели...")
-ctp_to_unom_map, consumption_df, excedents_df = cl.load_data()
-
 base_dir = os.path.dirname(os.path.abspath(__file__))
 model_path = os.path.join(base_dir, 'models', 'catboost_model.cbm')
-model = CatBoostClassifier()
-model.load_model(model_path)
-print("Данные и модель загружены!")
+
+# Модель и данные загружаются при первом обращении, а не при импорте
+_model = None
+_model_lock = threading.Lock()
+_consumption_df = None
+_excedents_df = None
+_data_lock = threading.Lock()
+
+
+def get_model() -> CatBoostClassifier:
+    """Возвращает модель CatBoost, загружая её при первом вызове"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                print("Загрузка модели...")
+                model = CatBoostClassifier()
+                model.load_model(model_path)
+                _model = model
+                print("Модель загружена!")
+    return _model
+
+
+def is_model_loaded() -> bool:
+    """Загружена ли модель CatBoost (без запуска загрузки)"""
+    return _model is not None
+
+
+def set_data_source(consumption_df: pd.DataFrame, excedents_df: Optional[pd.DataFrame] = None):
+    """Задает уже загруженные данные о расходе и утечках, с которыми работает модуль по умолчанию"""
+    global _consumption_df, _excedents_df
+    with _data_lock:
+        _consumption_df, _excedents_df = consumption_df, excedents_df
 
 
-async def analyze_leakage_with_consumption_data(unom: int, start_ts: str, end_ts: str, threshold: float = 0.5) -> Dict[str, Any]:
+def _resolve_data(consumption_df=None, excedents_df=None):
+    """
+    Возвращает (consumption_df, excedents_df): переданные явно, заданные через set_data_source
+    или, если модуль используется отдельно, загруженные через load_data.
+    """
+    global _consumption_df, _excedents_df
+    if consumption_df is not None:
+        return consumption_df, excedents_df
+    if _consumption_df is None:
+        with _data_lock:
+            if _consumption_df is None:
+                print("Загрузка данных...")
+                _, loaded_df, _excedents_df = cl.load_data()
+                _consumption_df = loaded_df
+    return _consumption_df, _excedents_df
+
+# Окно признаков модели: прогноз и реальный расход за последние 8 часов
+WINDOW_HOURS = 8
+
+
+async def analyze_leakage_with_consumption_data(unom: int, start_ts: str, end_ts: str, threshold: float = 0.5,
+                                                consumption_df: Optional[pd.DataFrame] = None,
+                                                excedents_df: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
     """
     Анализ утечек - только инференс:
     1. Получает данные через get_consumption_for_period_unom
     2. Запускает анализ моделью CatBoost
     3. Возвращает результат
+
+    Данные берутся из аргументов или из источника, заданного set_data_source.
     """
+    consumption_df, excedents_df = _resolve_data(consumption_df, excedents_df)
 
     consumption_data = await cl.get_consumption_for_period_unom(
         unom, start_ts, end_ts, consumption_df, excedents_df=excedents_df
@@ -54,27 +107,109 @@ async def analyze_leakage_with_consumption_data(unom: int, start_ts: str, end_ts
             "timestamp": datetime.now().isoformat()
         }
     
-    recent_data = consumption_data.tail(8)
+    recent_data = consumption_data.tail(WINDOW_HOURS)
     predicted_values = recent_data['прогноз'].values
     real_values = recent_data['реальный'].values
     features = np.concatenate([predicted_values, real_values]).reshape(1, -1)
-    print(features)
     
-    probabilities = model.predict_proba(features)
+    probabilities = get_model().predict_proba(features)
     leakage_prob = float(probabilities[0][1])
     
+    return _leakage_result(unom, leakage_prob, threshold, len(consumption_data), start_ts, end_ts)
+
+
+def _leakage_result(unom: int, leakage_prob: float, threshold: float, data_points: int, start_ts, end_ts) -> Dict[str, Any]:
+    """Формирует результат анализа по вероятности утечки"""
     return {
         "unom": unom,
         "is_leakage": leakage_prob > threshold,
         "leakage_probability": leakage_prob,
         "threshold": threshold,
         "confidence": "high" if leakage_prob > 0.8 else "medium" if leakage_prob > 0.6 else "low",
-        "data_points": len(consumption_data),
-        "period": {"start": start_ts, "end": end_ts, "hours": len(consumption_data)},
+        "data_points": data_points,
+        "period": {"start": start_ts, "end": end_ts, "hours": data_points},
         "timestamp": datetime.now().isoformat()
     }
 
 
+def build_feature_matrix(unoms: Iterable[int], start_ts, end_ts,
+                         consumption_df: Optional[pd.DataFrame] = None,
+                         excedents_df: Optional[pd.DataFrame] = None):
+    """
+    Строит матрицу признаков (прогноз и реальный расход за последние WINDOW_HOURS часов)
+    для всех домов за один проход по индексу UNOM.
+
+    Возвращает (features, scored_unoms, data_points): строки features соответствуют scored_unoms,
+    data_points — число часов в периоде для каждого дома из unoms.
+    """
+    consumption_df, excedents_df = _resolve_data(consumption_df, excedents_df)
+    unom_index = cl.get_unom_index(consumption_df)
+    data_points = {}
+    scored_unoms = []
+    windows = []
+    for unom in unoms:
+        rows = unom_index.locate(unom, start_ts, end_ts)
+        data_points[unom] = rows.stop - rows.start
+        if data_points[unom] >= WINDOW_HOURS:
+            scored_unoms.append(unom)
+            windows.append(np.arange(rows.stop - WINDOW_HOURS, rows.stop))
+
+    if not windows:
+        return np.empty((0, 2 * WINDOW_HOURS)), scored_unoms, data_points
+
+    rows = np.stack(windows)
+    predicted = unom_index.consumption[rows]
+    real = cl.get_real_consumption_rows(consumption_df, rows.reshape(-1), excedents_df=excedents_df).reshape(rows.shape)
+    return np.hstack([predicted, real]), scored_unoms, data_points
+
+
+async def analyze_leakage_batch(unoms: Iterable[int], start_ts: str, end_ts: str, threshold: float = 0.5,
+                                executor: Optional[Any] = None,
+                                consumption_df: Optional[pd.DataFrame] = None,
+                                excedents_df: Optional[pd.DataFrame] = None) -> Dict[int, Dict[str, Any]]:
+    """
+    Пакетный анализ утечек: признаки всех домов строятся за один проход и оцениваются
+    одним вызовом predict_proba. Сборка признаков, загрузка модели и predict_proba выполняются
+    в executor (по умолчанию - в пуле потоков event loop), чтобы не блокировать loop.
+
+    Возвращает {unom: результат} в формате analyze_leakage_with_consumption_data.
+    """
+    unoms = list(dict.fromkeys(unoms))
+    loop = asyncio.get_running_loop()
+    features, scored_unoms, data_points = await loop.run_in_executor(
+        executor, build_feature_matrix, unoms, start_ts, end_ts, consumption_df, excedents_df)
+
+    probabilities = np.empty((0, 2))
+    if scored_unoms:
+        probabilities = await loop.run_in_executor(executor, lambda: get_model().predict_proba(features))
+
+    results = {}
+    for unom in unoms:
+        points = data_points[unom]
+        if points == 0:
+            results[unom] = {
+                "unom": unom,
+                "is_leakage": False,
+                "leakage_probability": 0.0,
+                "error": "Нет данных о потреблении",
+                "timestamp": datetime.now().isoformat()
+            }
+        elif points < WINDOW_HOURS:
+            results[unom] = {
+                "unom": unom,
+                "is_leakage": False,
+                "leakage_probability": 0.0,
+                "error": f"Недостаточно данных: {points} часов (нужно минимум {WINDOW_HOURS})",
+                "data_points": points,
+                "timestamp": datetime.now().isoformat()
+            }
+
+    for unom, row in zip(scored_unoms, probabilities):
+        results[unom] = _leakage_result(unom, float(row[1]), threshold, data_points[unom], start_ts, end_ts)
+
+    return results
+
+
 async def demo():
     """Демонстрация сервиса детекции утечек"""
     result = await analyze_leakage_with_consumption_data(12183, '2025-09-04 05:00:00', '2025-09-05 05:00:00')
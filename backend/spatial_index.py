@@ -0,0 +1,173 @@
+"""
+Пространственный индекс домов для поиска по координатам.
+
+Точки проецируются в равнопромежуточную (equirectangular) проекцию вокруг средней широты
+и раскладываются по квадратным ячейкам сетки. Запрос просматривает только ячейки,
+покрывающие круг поиска, а точные расстояния считаются по формуле Haversine.
+"""
+
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+EARTH_RADIUS = 6371000  # Радиус Земли в метрах
+
+
+def haversine_distances(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Векторная формула Haversine: расстояния в метрах от точки (lat, lon) до массивов точек."""
+    lat1 = math.radians(lat)
+    lat2 = np.radians(lats)
+    delta_lat = lat2 - lat1
+    delta_lon = np.radians(lons - lon)
+
+    a = np.sin(delta_lat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(delta_lon / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+class SpatialIndex:
+    """
+    Сеточный индекс точек с запросами по радиусу и k ближайших соседей.
+
+    Точки внутри ячейки хранятся непрерывным диапазоном в массивах, отсортированных по ячейке,
+    поэтому ячейка — это срез, а не список Python-объектов.
+    """
+
+    def __init__(self, lats: Iterable[float], lons: Iterable[float], ids: Iterable[int], cell_size: float = 250.0):
+        lats = np.asarray(list(lats), dtype=np.float64)
+        lons = np.asarray(list(lons), dtype=np.float64)
+        ids = np.asarray(list(ids), dtype=np.int64)
+
+        self.cell_size = float(cell_size)
+        self.lat0 = float(lats.mean()) if len(lats) else 0.0
+        self.lon0 = float(lons.mean()) if len(lons) else 0.0
+        self._cos_lat0 = math.cos(math.radians(self.lat0))
+
+        cells_x, cells_y = self._cells(*self._project(lats, lons))
+        # Порядок исходных точек сохраняется внутри ячейки (stable), чтобы при равных расстояниях
+        # выигрывала точка, встретившаяся в данных раньше
+        order = np.lexsort((np.arange(len(ids)), cells_y, cells_x))
+        self.lats = lats[order]
+        self.lons = lons[order]
+        self.ids = ids[order]
+        self._positions = order
+
+        self._buckets: Dict[Tuple[int, int], Tuple[int, int]] = {}
+        sorted_x, sorted_y = cells_x[order], cells_y[order]
+        if len(order):
+            changes = np.flatnonzero((sorted_x[1:] != sorted_x[:-1]) | (sorted_y[1:] != sorted_y[:-1])) + 1
+            starts = np.concatenate(([0], changes))
+            stops = np.concatenate((changes, [len(order)]))
+            for start, stop in zip(starts, stops):
+                self._buckets[(int(sorted_x[start]), int(sorted_y[start]))] = (int(start), int(stop))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _project(self, lats, lons):
+        """Равнопромежуточная проекция в метры относительно (lat0, lon0)."""
+        x = EARTH_RADIUS * np.radians(np.asarray(lons) - self.lon0) * self._cos_lat0
+        y = EARTH_RADIUS * np.radians(np.asarray(lats) - self.lat0)
+        return x, y
+
+    def _cells(self, x, y):
+        return (np.floor(np.asarray(x) / self.cell_size).astype(np.int64),
+                np.floor(np.asarray(y) / self.cell_size).astype(np.int64))
+
+    def _candidates(self, lat: float, lon: float, radius: float) -> np.ndarray:
+        """Позиции точек в ячейках, покрывающих круг радиуса radius вокруг (lat, lon)."""
+        x, y = self._project(lat, lon)
+        # Проекция сжимает долготу по cos(lat0); на широтах дальше от экватора круг шире по x
+        max_lat = min(abs(lat) + math.degrees(radius / EARTH_RADIUS), 89.9)
+        half_width = radius * self._cos_lat0 / math.cos(math.radians(max_lat))
+
+        (x_lo, x_hi), (y_lo, y_hi) = self._cells([x - half_width, x + half_width], [y - radius, y + radius])
+        cell_count = (x_hi - x_lo + 1) * (y_hi - y_lo + 1)
+
+        if cell_count >= len(self._buckets):
+            spans = [span for (cell_x, cell_y), span in self._buckets.items()
+                     if x_lo <= cell_x <= x_hi and y_lo <= cell_y <= y_hi]
+        else:
+            spans = [self._buckets[(cell_x, cell_y)]
+                     for cell_x in range(x_lo, x_hi + 1) for cell_y in range(y_lo, y_hi + 1)
+                     if (cell_x, cell_y) in self._buckets]
+
+        if not spans:
+            return np.empty(0, dtype=np.int64)
+        positions = np.concatenate([np.arange(start, stop) for start, stop in spans])
+        # Восстанавливаем исходный порядок точек для детерминированного выбора при равенстве
+        return positions[np.argsort(self._positions[positions], kind='stable')]
+
+    def query_radius(self, lat: float, lon: float, radius: float) -> List[Tuple[int, float]]:
+        """Возвращает [(id, расстояние в метрах)] всех точек в радиусе, по возрастанию расстояния."""
+        positions = self._candidates(lat, lon, radius)
+        distances = haversine_distances(lat, lon, self.lats[positions], self.lons[positions])
+        inside = distances <= radius
+        positions, distances = positions[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return [(int(self.ids[p]), float(d)) for p, d in zip(positions[order], distances[order])]
+
+    def nearest(self, lat: float, lon: float, k: int = 1,
+                max_distance: Optional[float] = None) -> List[Tuple[int, float]]:
+        """
+        Возвращает до k ближайших точек [(id, расстояние в метрах)] по возрастанию расстояния,
+        не дальше max_distance (если задан).
+        """
+        if k <= 0 or not len(self.ids):
+            return []
+
+        radius = self.cell_size
+        while True:
+            if max_distance is not None:
+                radius = min(radius, max_distance)
+            found = self.query_radius(lat, lon, radius)
+            exhausted = len(found) >= k or (max_distance is not None and radius >= max_distance)
+            # Круг накрыл все ячейки — дальше искать негде
+            if exhausted or radius > 2 * math.pi * EARTH_RADIUS:
+                return found[:k]
+            radius *= 2
+
+    def closest(self, lat: float, lon: float, radius: float) -> Optional[int]:
+        """Возвращает id ближайшей точки в радиусе radius или None."""
+        found = self.nearest(lat, lon, k=1, max_distance=radius)
+        return found[0][0] if found else None
+
+
+def build_house_features(geojson_data: Optional[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+    """
+    Строит индекс UNOM -> {'coordinates', 'properties'} по GeoJSON трубопроводов
+    (первая труба, ведущая к дому; координаты дома — последняя точка LineString).
+    """
+    houses = {}
+    for feature in (geojson_data or {}).get('features', []):
+        if feature['geometry']['type'] != 'LineString':
+            continue
+        unom = feature['properties'].get('Конец')
+        if not isinstance(unom, (int, float)) or not math.isfinite(unom) or int(unom) != unom or int(unom) in houses:
+            continue
+        coordinates = feature['geometry']['coordinates']
+        houses[int(unom)] = {
+            'coordinates': {'lon': coordinates[-1][0], 'lat': coordinates[-1][1]} if len(coordinates) >= 2 else None,
+            'properties': feature['properties'],
+        }
+    return houses
+
+
+def build_house_index(geojson_data: Optional[Dict[str, Any]], cell_size: float = 250.0) -> SpatialIndex:
+    """
+    Строит индекс домов по GeoJSON трубопроводов: дом — последняя точка LineString,
+    UNOM — свойство 'Конец'.
+    """
+    lats, lons, unoms = [], [], []
+    for feature in (geojson_data or {}).get('features', []):
+        if feature['geometry']['type'] != 'LineString':
+            continue
+        coordinates = feature['geometry']['coordinates']
+        unom = feature['properties'].get('Конец')
+        if len(coordinates) >= 2 and unom and isinstance(unom, (int, float)) and math.isfinite(unom):
+            house_lon, house_lat = coordinates[-1]  # Последняя точка - дом
+            lats.append(house_lat)
+            lons.append(house_lon)
+            unoms.append(int(unom))
+
+    return SpatialIndex(lats, lons, unoms, cell_size=cell_size)
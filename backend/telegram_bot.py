@@ -4,15 +4,17 @@ import logging
 import os
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
-import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 import pandas as pd
 
 # Импортируем модули проекта
 from alert_controller import generate_alerts
-from consumption_loader import load_data, get_consumption_for_period_unom, get_consumption_for_period_ctp, load_excedents_data, simulate_real_consumption
+from consumption_loader import load_data, build_unom_to_ctp, get_consumption_for_period_unom, get_consumption_for_period_ctp, load_excedents_data, simulate_real_consumption
 from alert_integration import AlertNotifier
+from alert_delivery import AlertDelivery, TelegramTransport
+from alert_state import CursorStore
+from bot_data_client import DataClientError, HttpDataClient, LocalDataClient
 from telegram_commands import AdvancedTelegramCommands
 from user_auth import auth_manager
 
@@ -24,18 +26,26 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class TelegramBot:
-    def __init__(self, token: str, api_base_url: str = "https://localhost:5001"):
+    def __init__(self, token: str, api_base_url: str = "https://localhost:5001", data_backend: str = "http"):
         self.token = token
         self.api_base_url = api_base_url
         # Отключаем проверку SSL для самоподписанных сертификатов внутри Docker сети
         self.ssl_verify = False
+        # Неблокирующий клиент API (пул keep-alive соединений); авторизация всегда идет через него
+        self.api = HttpDataClient(api_base_url, verify=self.ssl_verify)
+        # Источник данных для алертов и поиска: API ("http") или данные в процессе бота ("local")
+        self.data_backend = data_backend
+        self.data_client = self.api
         self.application = None
         self.ctp_to_unom_map = None
+        self.unom_to_ctp = {}
         self.consumption_df = None
         self.excedents_df = None
         self.subscribed_users = set()  # Множество ID подписанных пользователей
         self.alert_notifier = None
         self.advanced_commands = None
+        self.delivery = None  # Очередь рассылки алертов, создается вместе с Application
+        self.feed_cursors = None  # Позиция в ленте изменений алертов (/alerts/changes)
         
         # Авторизация пользователей
         self.authorized_users = {}  # {telegram_id: session_info}
@@ -47,6 +57,7 @@ class TelegramBot:
             logger.info("Загрузка данных...")
             # Загружаем данные с утечками
             self.ctp_to_unom_map, self.consumption_df, self.excedents_df = load_data()
+            self.unom_to_ctp = build_unom_to_ctp(self.ctp_to_unom_map or {})
             if self.ctp_to_unom_map and self.consumption_df is not None:
                 logger.info(f"Данные успешно загружены: {len(self.consumption_df)} записей")
                 if not self.excedents_df.empty:
@@ -56,6 +67,10 @@ class TelegramBot:
             else:
                 logger.error("Не удалось загрузить данные")
                 
+            if self.data_backend == 'local' and self.ctp_to_unom_map and self.consumption_df is not None:
+                self.data_client = LocalDataClient(self.ctp_to_unom_map, self.consumption_df, self.excedents_df)
+                logger.info("Данные для команд берутся из процесса бота (data_backend=local)")
+                
             # Инициализируем AlertNotifier
             self.alert_notifier = AlertNotifier(self.token, self.api_base_url)
             await self.alert_notifier.initialize_data()
@@ -271,15 +286,15 @@ class TelegramBot:
             # Показываем индикатор загрузки
             await query.edit_message_text("🔄 Получение алертов...")
             
-            # Получаем алерты через API бэкенда
-            response = requests.get(f"{self.api_base_url}/alerts", timeout=10, verify=self.ssl_verify)
-            
-            if response.status_code != 200:
+            # Получаем алерты (API или данные в процессе бота)
+            try:
+                alerts = await self.data_client.get_alerts()
+            except DataClientError as e:
+                if e.status is None:
+                    raise
                 await query.edit_message_text("❌ Ошибка при получении алертов от API.")
                 return
             
-            alerts = response.json()
-            
             if not alerts:
                 await query.edit_message_text("✅ На данный момент активных алертов нет.")
                 return
@@ -303,7 +318,7 @@ class TelegramBot:
                 
             await query.edit_message_text(message, parse_mode='Markdown')
             
-        except requests.exceptions.RequestException as e:
+        except DataClientError as e:
             logger.error(f"Ошибка при запросе к API: {e}")
             await query.edit_message_text("❌ Ошибка подключения к API. Проверьте, что бэкенд запущен.")
         except Exception as e:
@@ -323,15 +338,15 @@ class TelegramBot:
             return
             
         try:
-            # Получаем алерты через API бэкенда
-            response = requests.get(f"{self.api_base_url}/alerts", timeout=10, verify=self.ssl_verify)
-            
-            if response.status_code != 200:
+            # Получаем алерты (API или данные в процессе бота)
+            try:
+                alerts = await self.data_client.get_alerts()
+            except DataClientError as e:
+                if e.status is None:
+                    raise
                 await update.message.reply_text("❌ Ошибка при получении алертов от API.")
                 return
             
-            alerts = response.json()
-            
             if not alerts:
                 await update.message.reply_text("✅ На данный момент активных алертов нет.")
                 return
@@ -352,7 +367,7 @@ class TelegramBot:
                 
             await update.message.reply_text(message, parse_mode='Markdown')
             
-        except requests.exceptions.RequestException as e:
+        except DataClientError as e:
             logger.error(f"Ошибка при запросе к API: {e}")
             await update.message.reply_text("❌ Ошибка подключения к API. Проверьте, что бэкенд запущен.")
         except Exception as e:
@@ -437,12 +452,10 @@ class TelegramBot:
             lat = float(context.args[0])
             lon = float(context.args[1])
             
-            # Используем API для поиска дома по координатам
-            response = requests.get(f"{self.api_base_url}/house_by_coordinates", verify=self.ssl_verify, 
-                                  params={'lat': lat, 'lon': lon, 'timestamp': datetime.now().isoformat()})
+            # Поиск дома по координатам (API или данные в процессе бота)
+            data = await self.data_client.find_house(lat, lon, datetime.now())
             
-            if response.status_code == 200:
-                data = response.json()
+            if data is not None:
                 house_info = data.get('house_info', {})
                 stats = data.get('statistics', {})
                 
@@ -459,6 +472,9 @@ class TelegramBot:
                 
         except ValueError:
             await update.message.reply_text("❌ Неверный формат координат.")
+        except DataClientError as e:
+            logger.error(f"Ошибка при поиске дома по координатам: {e}")
+            await update.message.reply_text("❌ Ошибка подключения к API. Проверьте, что бэкенд запущен.")
 
     async def get_house_info(self, update: Update, unom: int):
         """Получение информации о доме по UNOM"""
@@ -477,11 +493,7 @@ class TelegramBot:
                     return
                 
                 # Находим ЦТП для этого дома
-                ctp_name = None
-                for ctp, unoms in self.ctp_to_unom_map.items():
-                    if unom in unoms:
-                        ctp_name = ctp
-                        break
+                ctp_name = self.unom_to_ctp.get(unom)
                 
                 # Статистика
                 real_values = consumption_data['реальный']
@@ -542,10 +554,10 @@ class TelegramBot:
             # Проверяем доступность API
             api_status = "🟢 Доступен"
             try:
-                response = requests.get(f"{self.api_base_url}/alerts", timeout=5, verify=self.ssl_verify)
+                response = await self.api.request('GET', '/health', timeout=5)
                 if response.status_code != 200:
                     api_status = "🟡 Частично доступен"
-            except:
+            except DataClientError:
                 api_status = "🔴 Недоступен"
             
             # Статистика данных
@@ -570,52 +582,41 @@ class TelegramBot:
 
     async def send_alert_to_subscribers(self, alert: Dict[str, Any]):
         """Отправка алерта всем подписанным пользователям"""
-        if not self.subscribed_users:
+        await self.send_alerts_to_subscribers([alert])
+
+    async def send_alerts_to_subscribers(self, alerts: List[Dict[str, Any]]):
+        """
+        Постановка алертов в очередь рассылки подписчикам: отправка идет в фоне с лимитами
+        Telegram, несколько алертов для одного чата объединяются в один дайджест.
+        """
+        if not self.subscribed_users or not alerts or self.delivery is None:
             return
             
-        level_emoji = {
-            "Критический": "🔴",
-            "Высокий": "🟠", 
-            "Средний": "🟡",
-            "Низкий": "🟢"
-        }.get(alert.get('level', ''), '⚪')
-        
-        message = f"🚨 **Новый алерт!**\n\n"
-        message += f"{level_emoji} **{alert.get('level', 'Неизвестно')}**\n"
-        message += f"🏠 {alert.get('type', 'Неизвестно')} {alert.get('object_id', 'N/A')}\n"
-        message += f"📝 {alert.get('alert_message', 'Нет описания')}\n"
-        message += f"💡 {alert.get('comment', 'Нет комментария')}\n"
-        message += f"⏰ {datetime.now().strftime('%H:%M:%S')}"
-        
-        for user_id in self.subscribed_users:
-            try:
-                await self.application.bot.send_message(
-                    chat_id=user_id, 
-                    text=message, 
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                logger.error(f"Ошибка отправки алерта пользователю {user_id}: {e}")
+        await self.delivery.enqueue(self.subscribed_users, alerts)
 
     async def check_and_send_alerts(self):
-        """Периодическая проверка и отправка новых алертов"""
+        """
+        Периодическая рассылка изменений алертов: из ленты /alerts/changes берутся только
+        переходы (новые, обновленные, устраненные) после сохраненного курсора.
+        """
         try:
-            # Получаем алерты через API бэкенда
-            response = requests.get(f"{self.api_base_url}/alerts", timeout=10, verify=self.ssl_verify)
-            
-            if response.status_code != 200:
-                logger.error(f"Ошибка при получении алертов от API: {response.status_code}")
+            if self.delivery is None or self.feed_cursors is None:
                 return
             
-            alerts = response.json()
-            
-            # Здесь можно добавить логику сравнения с предыдущими алертами
-            # для отправки только новых алертов
-            for alert in alerts:
-                await self.send_alert_to_subscribers(alert)
+            cursor = self.feed_cursors.get_cursor('bot')
+            while True:
+                page = await self.data_client.get_alert_changes(cursor)
+                await self.send_alerts_to_subscribers([event['alert'] for event in page['events']])
                 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка при запросе к API: {e}")
+                # Курсор сдвигается после постановки в очередь: при сбое изменения будут прочитаны повторно
+                if page['cursor'] != cursor:
+                    cursor = page['cursor']
+                    self.feed_cursors.set_cursor('bot', cursor)
+                if not page['has_more']:
+                    return
+                
+        except DataClientError as e:
+            logger.error(f"Ошибка при получении изменений алертов: {e}")
         except Exception as e:
             logger.error(f"Ошибка при проверке алертов: {e}")
 
@@ -637,8 +638,8 @@ class TelegramBot:
             email = context.args[0]
             password = context.args[1]
             
-            # Авторизуемся через API
-            auth_response = requests.post(f"{self.api_base_url}/auth/login", verify=self.ssl_verify, 
+            # Авторизуемся через API (асинхронно: проверка пароля на сервере не блокирует event loop бота)
+            auth_response = await self.api.request('POST', '/auth/login',
                                         json={
                                             "email": email,
                                             "password": password,
@@ -699,8 +700,8 @@ class TelegramBot:
                 )
                 return
             
-            # Регистрируемся через API
-            reg_response = requests.post(f"{self.api_base_url}/auth/register", verify=self.ssl_verify, 
+            # Регистрируемся через API (асинхронно, как и /login)
+            reg_response = await self.api.request('POST', '/auth/register',
                                        json={
                                            "email": email,
                                            "password": password,
@@ -770,8 +771,8 @@ class TelegramBot:
             session_token = self.authorized_users[user_id]['session_token']
             
             # Выходим через API
-            requests.post(f"{self.api_base_url}/auth/logout", verify=self.ssl_verify,
-                         headers={'Authorization': f'Bearer {session_token}'})
+            await self.api.request('POST', '/auth/logout',
+                                   headers={'Authorization': f'Bearer {session_token}'})
             
             # Удаляем из локального кэша
             del self.authorized_users[user_id]
@@ -826,6 +827,9 @@ class TelegramBot:
         """Запуск бота"""
         # Создаем приложение
         self.application = Application.builder().token(self.token).build()
+        self.delivery = AlertDelivery(TelegramTransport(self.application.bot), channel='bot')
+        # Курсор ленты хранится рядом с очередью рассылки и переживает перезапуск бота
+        self.feed_cursors = CursorStore(self.delivery.store.path)
         
         # Инициализируем данные
         await self.initialize_data()
@@ -4,19 +4,23 @@
 """
 
 import asyncio
-import json
 import logging
+import tempfile
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
-import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 import pandas as pd
 
 from consumption_loader import get_consumption_for_period_unom, get_consumption_for_period_ctp, load_excedents_data, simulate_real_consumption
+from exporter import FORMATS, available_formats, export_filename, resolve_targets, write_export
+from bot_data_client import DataClientError
 
 logger = logging.getLogger(__name__)
 
+# Экспорт до этого размера держится в памяти, больше - во временном файле на диске
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024
+
 class AdvancedTelegramCommands:
     """Класс с расширенными командами для Telegram бота"""
     
@@ -144,42 +148,65 @@ class AdvancedTelegramCommands:
             await update.message.reply_text("❌ Ошибка при сравнении домов.")
 
     async def top_consumers_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Команда /top_consumers - топ потребителей по текущему потреблению"""
+        """
+        Команда /top_consumers - топ потребителей за последний час по всей сети.
+
+        /top_consumers [расход|отклонение|отношение] [K] [ctp <CTP_ID>]
+        """
+        metric_names = {
+            'расход': 'real', 'real': 'real',
+            'отклонение': 'deviation', 'deviation': 'deviation',
+            'отношение': 'ratio', 'ratio': 'ratio',
+        }
+        titles = {
+            'real': ('текущее потребление', lambda item: f"{item['real']:.2f} м³/ч"),
+            'deviation': ('превышение прогноза', lambda item: f"{item['deviation']:+.2f} м³/ч (прогноз {item['predicted']:.2f})"),
+            'ratio': ('отношение к прогнозу', lambda item: f"x{item['ratio']:.2f} ({item['real']:.2f} / {item['predicted']:.2f} м³/ч)"),
+        }
+        usage = ("❌ Использование: /top_consumers [расход|отклонение|отношение] [K] [ctp <CTP_ID>]\n"
+                 "Пример: /top_consumers отклонение 10 ctp 04-07-0212/031")
         try:
-            # Получаем текущие данные для всех домов
-            current_time = pd.Timestamp.now()
-            start_time = current_time - pd.Timedelta(hours=1)
-            
-            top_consumers = []
-            
-            # Проверяем первые 50 домов для демонстрации
-            sample_houses = list(self.bot.ctp_to_unom_map.keys())[:5]  # Берем первые 5 ЦТП
-            all_houses = []
-            for ctp in sample_houses:
-                all_houses.extend(self.bot.ctp_to_unom_map[ctp][:10])  # По 10 домов с каждого ЦТП
-            
-            for unom in all_houses[:20]:  # Ограничиваем 20 домами для производительности
-                try:
-                    data = await get_consumption_for_period_unom(
-                        unom, start_time, current_time, self.bot.consumption_df, excedents_df=self.bot.excedents_df
-                    )
-                    if not data.empty:
-                        current_consumption = data['реальный'].iloc[-1]
-                        top_consumers.append((unom, current_consumption))
-                except:
-                    continue
-            
-            # Сортируем по убыванию потребления
-            top_consumers.sort(key=lambda x: x[1], reverse=True)
-            
-            if not top_consumers:
+            args = list(context.args or [])
+            metric, k, ctp_id = 'real', 10, None
+            if 'ctp' in [arg.lower() for arg in args]:
+                position = [arg.lower() for arg in args].index('ctp')
+                if position + 1 >= len(args):
+                    await update.message.reply_text(usage)
+                    return
+                ctp_id = args[position + 1]
+                del args[position:position + 2]
+            for arg in args:
+                if arg.isdigit():
+                    k = max(1, min(int(arg), 50))
+                elif arg.lower() in metric_names:
+                    metric = metric_names[arg.lower()]
+                else:
+                    await update.message.reply_text(usage)
+                    return
+
+            # Рейтинг строится раз в час по всем домам сети, чтение топа - O(K)
+            try:
+                board = await self.bot.data_client.get_top_consumers(metric, k, ctp_id)
+            except DataClientError as e:
+                if e.status == 404:
+                    await update.message.reply_text(f"❌ ЦТП {ctp_id} не найден.")
+                    return
+                raise
+
+            items = board.get('items', [])
+            if not items:
                 await update.message.reply_text("❌ Не удалось получить данные о потреблении.")
                 return
-            
-            message = "🏆 **Топ потребителей (текущее потребление):**\n\n"
-            for i, (unom, consumption) in enumerate(top_consumers[:10], 1):
-                message += f"{i}. 🏠 UNOM {unom}: {consumption:.2f} м³/ч\n"
-            
+
+            title, describe = titles[metric]
+            scope = f"ЦТП {ctp_id}" if ctp_id else "вся сеть"
+            hour = pd.Timestamp(board['hour']).strftime('%d.%m.%Y %H:00')
+            message = f"🏆 **Топ потребителей ({title}), {scope}:**\n⏰ {hour}\n\n"
+            for item in items:
+                ctp_suffix = f" (ЦТП {item['ctp_id']})" if not ctp_id and item.get('ctp_id') else ""
+                message += f"{item['rank']}. 🏠 UNOM {item['unom']}{ctp_suffix}: {describe(item)}\n"
+            message += f"\nВ рейтинге домов: {board.get('ranked', len(items))}"
+
             await update.message.reply_text(message, parse_mode='Markdown')
             
         except Exception as e:
@@ -207,13 +234,9 @@ class AdvancedTelegramCommands:
                 elif len(recent_data) > 20:
                     health_status["data_quality"] = "🟡 Удовлетворительное"
             
-            # Проверка API
-            try:
-                response = requests.get(f"{self.bot.api_base_url}/alerts", timeout=5)
-                if response.status_code == 200:
-                    health_status["api"] = "🟢 Доступна"
-            except:
-                pass
+            # Проверка API (или данных в процессе бота при data_backend=local)
+            if await self.bot.data_client.ping():
+                health_status["api"] = "🟢 Доступна"
             
             # Проверка системы алертов
             if self.bot.alert_notifier:
@@ -239,61 +262,76 @@ class AdvancedTelegramCommands:
             await update.message.reply_text("❌ Ошибка при проверке состояния системы.")
 
     async def export_data_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Команда /export <UNOM> - экспорт данных дома в JSON"""
-        if not context.args:
-            await update.message.reply_text("❌ Укажите номер UNOM.\nПример: /export 12345")
+        """
+        Команда /export - потоковый экспорт рядов расхода в файл.
+
+        /export <UNOM>[,<UNOM>...] [дней | <начало> <конец>] [csv|jsonl|parquet]
+        /export ctp <CTP_ID> [дома] [дней | <начало> <конец>] [csv|jsonl|parquet]
+        По умолчанию - последние 7 дней в JSON Lines.
+        """
+        usage = ("❌ Использование:\n"
+                 "/export <UNOM>[,<UNOM>...] [дней | <начало> <конец>] [csv|jsonl|parquet]\n"
+                 "/export ctp <CTP_ID> [дома] [дней | <начало> <конец>] [csv|jsonl|parquet]\n"
+                 "Пример: /export 12345 2025-09-01 2025-09-30 csv")
+        args = list(context.args or [])
+        if not args:
+            await update.message.reply_text(usage)
             return
-            
+
         try:
-            unom = int(context.args[0])
-            
-            # Получаем данные за последние 7 дней
+            unoms, ctp_ids = [], []
+            if args[0].lower() == 'ctp' and len(args) > 1:
+                ctp_ids = [args[1]]
+                args = args[2:]
+            else:
+                unoms = [int(value) for value in args.pop(0).split(',') if value]
+
+            expand_ctp = bool(ctp_ids) and bool(args) and args[0].lower() in ('дома', 'houses')
+            if expand_ctp:
+                args = args[1:]
+
+            fmt = 'jsonl'
+            if args and args[-1].lower() in FORMATS:
+                fmt = args.pop().lower()
+            if fmt not in available_formats():
+                await update.message.reply_text(f"❌ Формат {fmt} недоступен на сервере.")
+                return
+
             end_ts = pd.Timestamp.now()
             start_ts = end_ts - pd.Timedelta(days=7)
-            
-            data = await get_consumption_for_period_unom(unom, start_ts, end_ts, self.bot.consumption_df, excedents_df=self.bot.excedents_df)
-            
-            if data.empty:
-                await update.message.reply_text(f"❌ Данные для дома {unom} не найдены.")
+            if len(args) == 1:
+                start_ts = end_ts - pd.Timedelta(days=int(args[0]))
+            elif len(args) == 2:
+                start_ts, end_ts = pd.Timestamp(args[0]), pd.Timestamp(args[1])
+            elif args:
+                raise ValueError
+
+            targets = resolve_targets(unoms, ctp_ids, self.bot.ctp_to_unom_map, expand_ctp=expand_ctp)
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+
+        try:
+            # Экспорт пишется блоками во временный файл вне event loop бота
+            file_buffer = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+            rows = await asyncio.to_thread(write_export, file_buffer, targets, start_ts, end_ts,
+                                           self.bot.consumption_df, self.bot.ctp_to_unom_map,
+                                           self.bot.excedents_df, fmt)
+            if rows == 0:
+                file_buffer.close()
+                await update.message.reply_text("❌ Данные за указанный период не найдены.")
                 return
-            
-            # Подготавливаем данные для экспорта
-            export_data = {
-                "unom": unom,
-                "period": {
-                    "start": start_ts.isoformat(),
-                    "end": end_ts.isoformat()
-                },
-                "data": []
-            }
-            
-            for timestamp, row in data.iterrows():
-                export_data["data"].append({
-                    "timestamp": timestamp.isoformat(),
-                    "predicted": float(row['прогноз']),
-                    "real": float(row['реальный']),
-                    "deviation": float(row['реальный'] - row['прогноз'])
-                })
-            
-            # Создаем JSON файл
-            json_data = json.dumps(export_data, indent=2, ensure_ascii=False)
-            
-            # Отправляем как документ
-            from io import BytesIO
-            file_buffer = BytesIO()
-            file_buffer.write(json_data.encode('utf-8'))
+
             file_buffer.seek(0)
-            
-            filename = f"house_{unom}_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-            
-            await update.message.reply_document(
-                document=file_buffer,
-                filename=filename,
-                caption=f"📊 Данные дома {unom} за последние 7 дней"
-            )
-            
-        except ValueError:
-            await update.message.reply_text("❌ Неверный формат UNOM.")
+            subject = f"дома {unoms[0]}" if len(targets) == 1 and unoms else (
+                f"ЦТП {ctp_ids[0]}" if ctp_ids else f"{len(targets)} объектов")
+            with file_buffer:
+                await update.message.reply_document(
+                    document=file_buffer,
+                    filename=export_filename(targets, start_ts, end_ts, fmt),
+                    caption=f"📊 Данные {subject} с {start_ts:%Y-%m-%d %H:%M} по {end_ts:%Y-%m-%d %H:%M}"
+                )
+
         except Exception as e:
             logger.error(f"Ошибка при экспорте данных: {e}")
             await update.message.reply_text("❌ Ошибка при экспорте данных.")
@@ -309,10 +347,11 @@ class AdvancedTelegramCommands:
 
 🏠 **Анализ домов:**
 /compare <UNOM1> <UNOM2> - Сравнение двух домов
-/top_consumers - Топ потребителей
+/top_consumers [расход|отклонение|отношение] [K] [ctp <ID>] - Топ потребителей
 
 📊 **Данные:**
-/export <UNOM> - Экспорт данных дома в JSON
+/export <UNOM> [дней] [csv|jsonl|parquet] - Экспорт данных дома
+/export ctp <CTP_ID> [дома] [дней] - Экспорт данных ЦТП
 /health - Проверка состояния системы
 
 🔍 **Поиск:**
@@ -332,5 +371,6 @@ class AdvancedTelegramCommands:
 /ctp_info ЦТП-1
 /compare 12345 67890
 /export 12345
+/export ctp ЦТП-1 дома 2025-09-01 2025-09-30 csv
         """
         await update.message.reply_text(help_text, parse_mode='Markdown')
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для ленты изменений алертов (alert_state).
+Проверяет, что запросы /alerts с разными настройками в течение одного часа
+не порождают ложных переходов opened/resolved в ленте.
+Работает без БД: оценка алертов подменяется заглушкой.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+
+# Добавляем путь к модулям проекта
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import alert_controller
+from alert_controller import AlertCache, FEED_CONFIG, get_alerts, refresh_alert_state
+from alert_state import AlertStateStore
+
+# Настройка логирования
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+CTP_MAP = {'ЦТП-1': [101, 102, 103]}
+
+
+def fake_alert(unom: int) -> dict:
+    return {'alert_id': 1, 'type': 'дом', 'object_id': unom, 'alert_message': f"Алерт {unom}",
+            'comment': 'Проверить', 'level': 'Высокий'}
+
+
+async def fake_evaluate_alerts(ctp_to_unom_map, consumption_df, alert_time, excedents_df=None,
+                               ctp_ids=None, config=None):
+    """Чем меньше порог длительности, тем больше домов с алертом"""
+    threshold = config['event_duration_threshold']
+    unoms = [101] if threshold >= 4 else [101, 102, 103]
+    return {'ЦТП-1': ([fake_alert(unom) for unom in unoms], [])}
+
+
+async def test_interleaved_configs():
+    """Запросы с порогом 2 между каноническими оценками не меняют ленту"""
+    logger.info("=== Тест чередования настроек в течение часа ===")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = AlertStateStore(os.path.join(tmp_dir, 'alert_state.db'))
+        original_cache, original_evaluate = alert_controller.ALERT_CACHE, alert_controller.evaluate_alerts
+        alert_controller.ALERT_CACHE = AlertCache(state_store_factory=lambda: store)
+        alert_controller.evaluate_alerts = fake_evaluate_alerts
+        try:
+            first = await refresh_alert_state(CTP_MAP, None)
+            opened = store.changes(0)['events']
+            if [event['transition'] for event in opened] != ['opened'] or len(first) != 1:
+                logger.error(f"Ожидался один opened после канонической оценки: {opened}")
+                return False
+            head = store.head()
+
+            for _ in range(3):
+                slider = await get_alerts(CTP_MAP, None, config={'event_duration_threshold': 2})
+                if len(slider) != 3:
+                    logger.error(f"Оценка с порогом 2 вернула {len(slider)} алертов вместо 3")
+                    return False
+                await get_alerts(CTP_MAP, None, config=FEED_CONFIG)
+                await refresh_alert_state(CTP_MAP, None)
+
+            spurious = store.changes(head)['events']
+            if spurious:
+                logger.error(f"Ложные переходы в ленте: {[(e['transition'], e['alert']['object_id']) for e in spurious]}")
+                return False
+            if [alert['object_id'] for alert in store.open_alerts()] != [101]:
+                logger.error(f"Неверный набор открытых алертов: {store.open_alerts()}")
+                return False
+
+            logger.info(f"Лента без ложных переходов (head={store.head()})")
+            return True
+        finally:
+            alert_controller.ALERT_CACHE, alert_controller.evaluate_alerts = original_cache, original_evaluate
+
+
+async def main():
+    """Главная функция тестирования"""
+    tests = [
+        ("Чередование настроек", test_interleaved_configs),
+    ]
+
+    passed = 0
+    for test_name, test_func in tests:
+        try:
+            result = await test_func()
+        except Exception as e:
+            logger.error(f"❌ {test_name}: ОШИБКА - {e}")
+            continue
+        if result:
+            passed += 1
+            logger.info(f"✅ {test_name}: ПРОЙДЕН")
+        else:
+            logger.error(f"❌ {test_name}: ПРОВАЛЕН")
+
+    logger.info(f"Пройдено: {passed}/{len(tests)}")
+    return 0 if passed == len(tests) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -2,31 +2,235 @@
 Модуль авторизации и аутентификации пользователей для телеграм-бота.
 """
 
+import os
 import json
 import sqlite3
 import hashlib
 import secrets
 import logging
-from typing import Optional, Dict, Any, List
+import threading
+import time
+import asyncio
+import concurrent.futures
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, FrozenSet
 from datetime import datetime, timedelta
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+# Ожидание блокировки записи другим процессом/потоком, мс
+BUSY_TIMEOUT_MS = 5000
+# Размер кэша подготовленных выражений на соединение (sqlite3 переиспользует их по тексту SQL)
+STATEMENT_CACHE_SIZE = 128
+
+# Время жизни записей кэша сессий и разрешений, с (переменная окружения AUTH_CACHE_TTL)
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', 60))
+AUTH_CACHE_MAX_ENTRIES = 10000
+# Период фоновой очистки просроченных сессий, с (SESSION_SWEEP_INTERVAL, 0 - отключить)
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', 600))
+
+# Потоки для PBKDF2 (PASSWORD_HASH_WORKERS): хеширование ограничено этим пулом
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+PASSWORD_HASH_ITERATIONS = 100000
+# Одновременные попытки входа/регистрации на один аккаунт и на одного клиента (IP соединения;
+# для входа с Telegram ID - дополнительно на этот ID)
+MAX_CONCURRENT_PER_ACCOUNT = 2
+MAX_CONCURRENT_PER_CLIENT = 4
+
+class TooManyAttemptsError(Exception):
+    """Превышен лимит одновременных попыток входа/регистрации"""
+
+class ConcurrencyLimiter:
+    """Ограничение числа одновременных операций на ключ (аккаунт, клиент)"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, key):
+        """Занимает слот для key на время блока или бросает TooManyAttemptsError; key=None не ограничивается"""
+        if key is None:
+            yield
+            return
+        with self._lock:
+            if self._active.get(key, 0) >= self.limit:
+                raise TooManyAttemptsError(f"Слишком много одновременных попыток для {key}")
+            self._active[key] = self._active.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                if self._active[key] <= 1:
+                    del self._active[key]
+                else:
+                    self._active[key] -= 1
+
+def _pbkdf2(password: str, salt: str) -> str:
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'),
+                               PASSWORD_HASH_ITERATIONS).hex()
+
+class SessionCache:
+    """
+    Ограниченный TTL-кэш авторизации: session_token -> данные пользователя и
+    user_id -> набор разрешений.
+
+    Запись сессии живет не дольше ttl и не дольше самой сессии. Изменения через UserAuth
+    (logout, update_user, grant_permission) увеличивают общее для всех процессов поколение
+    в БД (auth_cache_epoch). Перед каждым чтением кэша UserAuth сверяет поколение (sync), и
+    кэш, заполненный при другом поколении, сбрасывается целиком. Записи, прочитанные из БД при
+    устаревшем поколении, в кэш не попадают.
+    """
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_entries: int = AUTH_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._sessions = OrderedDict()
+        self._permissions = OrderedDict()
+        self._lock = threading.Lock()
+        self.epoch = None
+
+    def sync(self, epoch: int):
+        """Сбрасывает кэш, если поколение в БД изменилось с момента его заполнения"""
+        with self._lock:
+            if epoch != self.epoch:
+                self._sessions.clear()
+                self._permissions.clear()
+                self.epoch = epoch
+
+    def _get(self, entries: OrderedDict, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = entries.get(key)
+            if entry is not None and entry[0] > now:
+                entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del entries[key]
+            self.misses += 1
+            return None
+
+    def _put(self, entries: OrderedDict, key, value, ttl: float, epoch: int):
+        with self._lock:
+            if epoch != self.epoch:
+                return
+            entries[key] = (time.monotonic() + min(self.ttl, ttl), value)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def get_session(self, session_token: str) -> Optional[Dict[str, Any]]:
+        return self._get(self._sessions, session_token)
+
+    def put_session(self, session_token: str, user_data: Dict[str, Any], expires_at: datetime, epoch: int):
+        self._put(self._sessions, session_token, user_data, (expires_at - datetime.now()).total_seconds(), epoch)
+
+    def get_permissions(self, user_id: int) -> Optional[FrozenSet[str]]:
+        return self._get(self._permissions, user_id)
+
+    def put_permissions(self, user_id: int, permissions: FrozenSet[str], epoch: int):
+        self._put(self._permissions, user_id, permissions, self.ttl, epoch)
+
+    def invalidate_session(self, session_token: str):
+        with self._lock:
+            self._sessions.pop(session_token, None)
+
+    def invalidate_user(self, user_id: int):
+        """Удаляет все сессии и разрешения пользователя"""
+        with self._lock:
+            for token in [token for token, (_, user_data) in self._sessions.items() if user_data['user_id'] == user_id]:
+                del self._sessions[token]
+            self._permissions.pop(user_id, None)
+
+    def invalidate_permissions(self, user_id: int):
+        with self._lock:
+            self._permissions.pop(user_id, None)
+
+    def purge_expired(self) -> int:
+        """Удаляет просроченные записи, возвращает их число"""
+        now = time.monotonic()
+        removed = 0
+        with self._lock:
+            for entries in (self._sessions, self._permissions):
+                for key in [key for key, (deadline, _) in entries.items() if deadline <= now]:
+                    del entries[key]
+                    removed += 1
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._permissions.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'sessions': len(self._sessions),
+                'permissions': len(self._permissions),
+            }
+
 class UserAuth:
     """Класс для управления авторизацией и аутентификацией пользователей"""
     
-    def __init__(self, db_path: str = 'data/users.db'):
+    def __init__(self, db_path: str = 'data/users.db', sweep_interval: float = SESSION_SWEEP_INTERVAL):
         self.db_path = db_path
+        # Соединения с БД: одно на поток, переиспользуются между вызовами
+        self._local = threading.local()
+        # Кэш сессий и разрешений для require_auth/require_permission
+        self.cache = SessionCache()
+        self.sweep_interval = sweep_interval
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+        # PBKDF2 выполняется в ограниченном пуле: всплеск входов не занимает все потоки/ядра
+        self._hash_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                                                thread_name_prefix='password-hash')
+        self._account_limiter = ConcurrencyLimiter(MAX_CONCURRENT_PER_ACCOUNT)
+        self._client_limiter = ConcurrencyLimiter(MAX_CONCURRENT_PER_CLIENT)
         # Создаем директорию, если она не существует
-        import os
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         self.init_database()
     
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Возвращает соединение текущего потока, открывая его при первом обращении.
+
+        Соединение работает в режиме WAL (читатели не блокируют писателя) с synchronous=NORMAL;
+        одинаковые SQL-строки берутся из кэша подготовленных выражений sqlite3.
+        После fork соединения родителя не используются.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+    
+    def close(self):
+        """Закрывает соединение текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+    
     def init_database(self):
         """Инициализация базы данных пользователей"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 
                 # Создание таблицы пользователей
@@ -68,6 +272,26 @@ class UserAuth:
                     )
                 ''')
                 
+                # Индексы для проверки сессии и разрешений на каждом запросе.
+                # session_token уже покрыт индексом ограничения UNIQUE
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_user_permissions_user_permission
+                    ON user_permissions (user_id, permission)
+                ''')
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_user_sessions_expires_at
+                    ON user_sessions (expires_at)
+                ''')
+                
+                # Поколение кэша авторизации, общее для всех процессов (см. SessionCache)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS auth_cache_epoch (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        epoch INTEGER NOT NULL
+                    )
+                ''')
+                cursor.execute('INSERT OR IGNORE INTO auth_cache_epoch (id, epoch) VALUES (1, 0)')
+                
                 conn.commit()
                 logger.info("База данных пользователей инициализирована")
                 
@@ -76,24 +300,50 @@ class UserAuth:
             raise
     
     def hash_password(self, password: str) -> str:
-        """Хеширование пароля"""
+        """Хеширование пароля (в пуле хеширования)"""
         salt = secrets.token_hex(16)
-        password_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
-        return f"{salt}:{password_hash.hex()}"
+        return f"{salt}:{self._hash_pool.submit(_pbkdf2, password, salt).result()}"
     
     def verify_password(self, password: str, password_hash: str) -> bool:
-        """Проверка пароля"""
+        """Проверка пароля (в пуле хеширования)"""
         try:
             salt, hash_part = password_hash.split(':')
-            computed_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
-            return secrets.compare_digest(hash_part, computed_hash.hex())
+            computed_hash = self._hash_pool.submit(_pbkdf2, password, salt).result()
+            return secrets.compare_digest(hash_part, computed_hash)
         except:
             return False
     
+    @contextmanager
+    def _attempt_slot(self, email: str, client_id: str = None, telegram_id: int = None):
+        """
+        Лимиты одновременных попыток на аккаунт и клиента. Лимит на Telegram ID действует
+        поверх лимита на клиента: ID задает вызывающий, поэтому заменить IP он не может.
+        """
+        telegram_key = f"telegram:{telegram_id}" if telegram_id else None
+        with self._account_limiter.slot(email), self._client_limiter.slot(client_id), \
+                self._client_limiter.slot(telegram_key):
+            yield
+    
+    async def login_async(self, email: str, password: str, telegram_id: int = None,
+                          client_id: str = None) -> Optional[Dict[str, Any]]:
+        """
+        Асинхронная авторизация для event loop (Flask async-обработчики, Telegram-бот):
+        проверка пароля и запросы к БД выполняются вне loop.
+        Бросает TooManyAttemptsError при превышении лимитов одновременных попыток.
+        """
+        with self._attempt_slot(email, client_id, telegram_id):
+            return await asyncio.to_thread(self.login, email, password, telegram_id)
+    
+    async def create_user_async(self, email: str, password: str, full_name: str = None, telegram_id: int = None,
+                                role: str = 'user', client_id: str = None) -> int:
+        """Асинхронная регистрация (см. login_async)"""
+        with self._attempt_slot(email, client_id):
+            return await asyncio.to_thread(self.create_user, email, password, full_name, telegram_id, role)
+    
     def create_user(self, email: str, password: str, full_name: str = None, telegram_id: int = None, role: str = 'user') -> int:
         """Создание нового пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 
                 # Проверяем, существует ли пользователь с таким email
@@ -127,7 +377,7 @@ class UserAuth:
     def login(self, email: str, password: str, telegram_id: int = None) -> Optional[Dict[str, Any]]:
         """Авторизация пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 
                 # Ищем пользователя по email
@@ -181,7 +431,7 @@ class UserAuth:
             session_token = secrets.token_urlsafe(32)
             expires_at = datetime.now() + timedelta(hours=24)  # Сессия на 24 часа
             
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     INSERT INTO user_sessions (user_id, telegram_id, session_token, expires_at)
@@ -195,56 +445,108 @@ class UserAuth:
             logger.error(f"Ошибка создания сессии: {e}")
             raise
     
+    def _sync_cache(self) -> int:
+        """Сверяет кэш с поколением в БД и возвращает это поколение"""
+        epoch = self._connection().execute('SELECT epoch FROM auth_cache_epoch WHERE id = 1').fetchone()[0]
+        self.cache.sync(epoch)
+        return epoch
+    
+    @staticmethod
+    def _bump_cache_epoch(cursor: sqlite3.Cursor):
+        """Новое поколение кэша (в транзакции изменения): кэши всех процессов сбросятся"""
+        cursor.execute('UPDATE auth_cache_epoch SET epoch = epoch + 1 WHERE id = 1')
+    
     def verify_session(self, session_token: str) -> Optional[Dict[str, Any]]:
-        """Проверка сессии пользователя"""
+        """
+        Проверка сессии пользователя.
+
+        Результат берется из кэша сессий (после сверки поколения, см. SessionCache); при
+        промахе читается из БД. Просроченные сессии не удаляются здесь, а вычищаются фоновой
+        очисткой (см. purge_expired_sessions).
+        """
+        self._ensure_sweeper()
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    SELECT us.user_id, us.telegram_id, us.expires_at, u.email, u.full_name, u.role, u.is_active
-                    FROM user_sessions us
-                    JOIN users u ON us.user_id = u.id
-                    WHERE us.session_token = ?
-                ''', (session_token,))
-                
-                session_data = cursor.fetchone()
-                if not session_data:
-                    return None
-                
-                user_id, telegram_id, expires_at_str, email, full_name, role, is_active = session_data
-                
-                # Проверяем активность пользователя
-                if not is_active:
-                    return None
-                
-                # Проверяем срок действия сессии
-                expires_at = datetime.fromisoformat(expires_at_str)
-                if datetime.now() > expires_at:
-                    # Удаляем просроченную сессию
-                    cursor.execute('DELETE FROM user_sessions WHERE session_token = ?', (session_token,))
-                    conn.commit()
-                    return None
-                
-                return {
-                    'user_id': user_id,
-                    'telegram_id': telegram_id,
-                    'email': email,
-                    'full_name': full_name,
-                    'role': role
-                }
+            epoch = self._sync_cache()
+            user_data = self.cache.get_session(session_token)
+            if user_data is not None:
+                return dict(user_data)
+
+            conn = self._connection()
+            session_data = conn.execute('''
+                SELECT us.user_id, us.telegram_id, us.expires_at, u.email, u.full_name, u.role, u.is_active
+                FROM user_sessions us
+                JOIN users u ON us.user_id = u.id
+                WHERE us.session_token = ?
+            ''', (session_token,)).fetchone()
+            if not session_data:
+                return None
+            
+            user_id, telegram_id, expires_at_str, email, full_name, role, is_active = session_data
+            
+            # Проверяем активность пользователя
+            if not is_active:
+                return None
+            
+            # Проверяем срок действия сессии
+            expires_at = datetime.fromisoformat(expires_at_str)
+            if datetime.now() > expires_at:
+                return None
+            
+            user_data = {
+                'user_id': user_id,
+                'telegram_id': telegram_id,
+                'email': email,
+                'full_name': full_name,
+                'role': role
+            }
+            self.cache.put_session(session_token, user_data, expires_at, epoch)
+            return dict(user_data)
                 
         except Exception as e:
             logger.error(f"Ошибка проверки сессии: {e}")
             return None
     
+    def purge_expired_sessions(self) -> int:
+        """Удаляет просроченные сессии из БД и кэша, возвращает число удаленных сессий"""
+        with self._connection() as conn:
+            deleted = conn.execute('DELETE FROM user_sessions WHERE expires_at < ?',
+                                   (datetime.now().isoformat(),)).rowcount
+        self.cache.purge_expired()
+        return deleted
+    
+    def _ensure_sweeper(self):
+        """Запускает фоновую очистку сессий в текущем процессе, если она еще не запущена"""
+        if self.sweep_interval <= 0 or self._sweeper_pid == os.getpid():
+            return
+        with self._sweeper_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+            threading.Thread(target=self._sweep_loop, name='session-sweeper', daemon=True).start()
+    
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                deleted = self.purge_expired_sessions()
+                if deleted:
+                    logger.info(f"Удалено просроченных сессий: {deleted}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки сессий: {e}")
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий и промахов кэша сессий и разрешений"""
+        return self.cache.stats()
+    
     def logout(self, session_token: str):
         """Выход пользователя (удаление сессии)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('DELETE FROM user_sessions WHERE session_token = ?', (session_token,))
+                self._bump_cache_epoch(cursor)
                 conn.commit()
+            self.cache.invalidate_session(session_token)
                 
         except Exception as e:
             logger.error(f"Ошибка выхода: {e}")
@@ -253,7 +555,7 @@ class UserAuth:
     def get_user_by_telegram_id(self, telegram_id: int) -> Optional[Dict[str, Any]]:
         """Получение пользователя по Telegram ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -285,7 +587,7 @@ class UserAuth:
     def update_user(self, user_id: int, **kwargs) -> bool:
         """Обновление данных пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 
                 # Формируем SQL запрос
@@ -304,9 +606,12 @@ class UserAuth:
                 sql = f"UPDATE users SET {', '.join(fields)} WHERE id = ?"
                 
                 cursor.execute(sql, values)
+                updated = cursor.rowcount > 0
+                self._bump_cache_epoch(cursor)
                 conn.commit()
+                self.cache.invalidate_user(user_id)
                 
-                return cursor.rowcount > 0
+                return updated
                 
         except Exception as e:
             logger.error(f"Ошибка обновления пользователя: {e}")
@@ -315,7 +620,7 @@ class UserAuth:
     def grant_permission(self, user_id: int, permission: str) -> bool:
         """Предоставление разрешения пользователю"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 
                 # Проверяем, есть ли уже такое разрешение
@@ -327,7 +632,9 @@ class UserAuth:
                 
                 cursor.execute('INSERT INTO user_permissions (user_id, permission) VALUES (?, ?)',
                              (user_id, permission))
+                self._bump_cache_epoch(cursor)
                 conn.commit()
+                self.cache.invalidate_permissions(user_id)
                 
                 return True
                 
@@ -336,15 +643,18 @@ class UserAuth:
             return False
     
     def check_permission(self, user_id: int, permission: str) -> bool:
-        """Проверка наличия разрешения у пользователя"""
+        """Проверка наличия разрешения у пользователя (набор разрешений кэшируется)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('SELECT id FROM user_permissions WHERE user_id = ? AND permission = ?',
-                             (user_id, permission))
-                
-                return cursor.fetchone() is not None
+            epoch = self._sync_cache()
+            permissions = self.cache.get_permissions(user_id)
+            if permissions is not None:
+                return permission in permissions
+            
+            rows = self._connection().execute('SELECT permission FROM user_permissions WHERE user_id = ?',
+                                              (user_id,)).fetchall()
+            permissions = frozenset(row[0] for row in rows)
+            self.cache.put_permissions(user_id, permissions, epoch)
+            return permission in permissions
                 
         except Exception as e:
             logger.error(f"Ошибка проверки разрешения: {e}")
@@ -353,7 +663,7 @@ class UserAuth:
     def get_all_users(self) -> List[Dict[str, Any]]:
         """Получение списка всех пользователей"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''